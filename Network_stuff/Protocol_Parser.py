@@ -1,62 +1,34 @@
 #!/usr/bin/env python3
 
-from struct import unpack, pack
-from tkinter import END
-
-class PacketDefaultPayload():
+from struct import unpack, unpack_from, pack, error as StructError
+from time import perf_counter_ns
+from metrics import METRICS
+from frame_lengths import LENGTHS
+from packet_schema import U8, U16, U32, F32, UInt, Blob, Pad, String, Payload, SlotsMeta, compile_payload, make_payload
+# tkinter.END: text widgets are given by the GUI, the parser does not need Tk
+END = 'end'
+
+class PacketDefaultPayload(Payload):
     # class template tu use for a new object
-    def __init__(self, payload) :
-        self.payload = payload
+    FIELDS = (Blob('payload'),)
 
-    @staticmethod
-    def parse(payload):
-        return PacketDefaultPayload(payload)
-    
-    def encode(self):
-        return self.payload
-    
     def __str__(self) -> str:
         return f"Unknown payload: {self.payload.hex()}"
 
-class PacketNewInventoryPayload():
+# not registered to a packet type: compiled here
+compile_payload(PacketDefaultPayload)
+
+class PacketNewInventoryPayload(Payload):
     # class template tu use for a new object
-    def __init__(self, name_len, name, qty) :
-        self.name_len = name_len
-        self.name = name
-        self.quantity = qty
+    FIELDS = (String('name', 'name_len'), U32('quantity'))
 
-    @staticmethod
-    def parse(payload):
-        name_len = int.from_bytes(payload[:2], 'little')
-        name = payload[2:2+name_len].decode()
-        qty = int.from_bytes(payload[2+name_len:2+name_len+4],'little')
-        return PacketNewInventoryPayload(name_len, name, qty)
-    
-    def encode(self):
-        return self.name_len.to_bytes(2, 'little') + self.name.encode() + self.quantity.to_bytes(4,'little')
-    
     def __str__(self) -> str:
         return f"New inventory: {self.name} {self.quantity}"
 
-class PacketAttackStatePayload():
+class PacketAttackStatePayload(Payload):
     # class template tu use for a new object
-    def __init__(self, id, name_len, name, tag) :
-        self.id = id
-        self.name_len = name_len
-        self.name = name
-        self.tag = tag
+    FIELDS = (U32('id'), String('name', 'name_len'), U32('tag'))
 
-    @staticmethod
-    def parse(payload):
-        id = int.from_bytes(payload[:4], 'little')
-        name_len = int.from_bytes(payload[4:6], 'little')
-        name = payload[6:6+name_len].decode()
-        tag = int.from_bytes(payload[6+name_len:6+name_len+4], 'little')
-        return PacketAttackStatePayload(id, name_len, name, tag)
-    
-    def encode(self):
-        return self.id.to_bytes(4,'little') + self.name_len.to_bytes(2,'little') + self.name.encode() + self.tag.to_bytes(4,'little')
-    
     def __str__(self) -> str:
         return f"Chg Attack state: {self.id} {self.name} {self.tag}"
 
@@ -79,15 +51,28 @@ class PacketRegistry:
 class packet_type:
     """
     Class decoraroe to register packet parser/forge classes
+    The codec of the payload is generated from its FIELDS.
+    With fields, the payload class is created: a new packet is one declaration
+        @packet_type(0x3031, fields=(String('name', 'name_len'), Blob('data')))
+        class DoorPacket(Packet): pass
     """
-    def __init__(self, pkt_type):
+    __slots__ = ('pkt_type', 'fields')
+
+    def __init__(self, pkt_type, fields = None):
         self.pkt_type = pkt_type
+        self.fields = fields
     
     def __call__(self, clazz):
+        if self.fields is not None:
+            clazz.PAYLOAD = make_payload(clazz.__name__ + 'Payload', self.fields)
+        compile_payload(clazz.PAYLOAD)
+        clazz.TYPE = self.pkt_type
         PacketRegistry.register(self.pkt_type, clazz)
         return clazz
 
 class PacketHeader():
+    __slots__ = ('type',)
+
     def __init__(self,pkt_hdr = None, type = 0):
         if pkt_hdr is not None:
             self.type = unpack(">H", pkt_hdr)[0]
@@ -105,212 +90,87 @@ class PacketHeader():
     def __str__(self) -> str:
         return f"0x{self.type:x}"
 
-class PacketItemPickPayload():
+class PacketItemPickPayload(Payload):
     # class template tu use for a new object
-    def __init__(self, id) :
-        self.id = id
+    FIELDS = (U32('id'),)
 
-    @staticmethod
-    def parse(payload):
-        return PacketItemPickPayload(int.from_bytes(payload[:4],'little'))
-    
-    def encode(self):
-        return self.id.to_bytes(4,'little')
-    
     def __str__(self) -> str:
         return f"Item pickup: {self.id}"
 
-class PacketRemoveElmtPayload():
+class PacketRemoveElmtPayload(Payload):
     # class template tu use for a new object
-    def __init__(self, id) :
-        self.id = id
+    FIELDS = (U32('id'),)
 
-    @staticmethod
-    def parse(payload):
-        return PacketRemoveElmtPayload(int.from_bytes(payload[:4],'little'))
-    
-    def encode(self):
-        return self.id.to_bytes(4,'little')
-    
     def __str__(self) -> str:
         return f"Remove element: {self.id}"
 
-class PacketPlayerStatePayload():
+class PacketPlayerStatePayload(Payload):
     # class template tu use for a new object
-    def __init__(self, id, name_len, name) :
-        self.id = id
-        self.name_len = name_len
-        self.name = name
-
-    @staticmethod
-    def parse(payload):
-        id = int.from_bytes(payload[:4],'little')
-        name_len = int.from_bytes(payload[4:6],'little')
-        name = payload[6:6+name_len].decode()
+    # a null byte follows the name
+    FIELDS = (U32('id'), String('name', 'name_len'), Pad(1))
 
-        return PacketPlayerStatePayload(id, name_len, name)
-    
-    def encode(self):
-        return self.id.to_bytes(4,'little') + self.name_len.to_bytes(2, 'little') + self.name.encode() + b'\x00'
-    
     def __str__(self) -> str:
         return f"Player change state:  {self.id} {self.name}"
 
-class PacketNewElmtPayload():
+class PacketNewElmtPayload(Payload):
     # class template tu use for a new object
-    def __init__(self, id, unk1, name_len, name, X, Y, Z, unk2) :
-        self.id = id
-        self.unk1 = unk1
-        self.name_len = name_len
-        self.name = name
-        self.X = X
-        self.Y = Y
-        self.Z = Z
-        self.unk2 = unk2
+    FIELDS = (U32('id'), Blob('unk1', 5), String('name', 'name_len'), F32('X'), F32('Y'), F32('Z'), Blob('unk2', 10))
 
-    @staticmethod
-    def parse(payload):
-        id = int.from_bytes(payload[:4],'little')
-        unk1 = payload[4:9]
-        name_len = int.from_bytes(payload[9:9+2],'little')
-        name = payload[11:11+name_len].decode()
-        X, Y, Z = unpack("fff",payload[11+name_len:11+name_len+12])
-        unk2 = payload[11+name_len+12:11+name_len+12+10]
-        return PacketNewElmtPayload(id, unk1, name_len, name, X, Y, Z, unk2)
-    
-    def encode(self):
-        ret = self.id.to_bytes(4,'little') + self.unk1
-        ret += self.name_len.to_bytes(2,'little') + self.name.encode()
-        ret += pack("fff", self.X, self.Y, self.Z)
-        ret += self.unk2
-        return ret
-    
     def __str__(self) -> str:
         return f"New element: {self.id}:{self.name} {self.X} / {self.Y} / {self.Z} {self.unk2.hex()}"
 
-class PacketFastTravelPayload():
+class PacketFastTravelPayload(Payload):
     # class template tu use for a new object
-    def __init__(self, src_name_len,src_name,dst_name_len,dst_name) :
-        self.src_name_len: int = src_name_len
-        self.src_name = src_name
-        self.dst_name_len: int = dst_name_len
-        self.dst_name = dst_name
+    FIELDS = (String('src_name', 'src_name_len'), String('dst_name', 'dst_name_len'))
 
-    @staticmethod
-    def parse(payload):
-        src_name_len = int.from_bytes(payload[:2], 'little')
-        src_name = payload[2:2+src_name_len].decode()
-        dst_name_len = int.from_bytes(payload[2+src_name_len:2+src_name_len+2], 'little')
-        dst_name = payload[2+src_name_len+2:2+src_name_len+2+dst_name_len].decode()
-        return PacketFastTravelPayload(src_name_len,src_name,dst_name_len,dst_name)
-    
-    def encode(self):
-        return self.src_name_len.to_bytes(2,'little') + self.src_name.encode() + self.dst_name_len.to_bytes(2,'little') + self.dst_name.encode()
-    
     def __str__(self) -> str:
         return f"Fast Travel: {self.src_name} -> {self.dst_name}"
 
-class PacketPositionPayload():
+class PacketPositionPayload(Payload):
     '''
     Payload of Position type
     '''
     POSITION_SIZE = 20
-    def __init__(self, X, Y, Z, look, unk, key):
-        self.X = X
-        self.Y = Y
-        self.Z = Z
-        self.look = look
-        self.unk = unk
-        self.key = key
+    FIELDS = (F32('X'), F32('Y'), F32('Z'), U32('look'), U16('unk'), U16('key'))
 
-    @staticmethod
-    def parse(payload):
-        X, Y, Z, look, unk, key = unpack("fffIHH",payload[:PacketPositionPayload.POSITION_SIZE])
-        return PacketPositionPayload(X, Y, Z, look, unk, key)
-    
-    def encode(self):
-        return pack("fffIHH", self.X, self.Y, self.Z, self.look, self.unk, self.key)
-    
     def __str__(self) -> str:
         return f"Position packet: {self.X} / {self.Y} / {self.Z} / {self.look}"
 
 
-class PacketEnemyPosPayload():
+class PacketEnemyPosPayload(Payload):
     '''
     Payload of Position type of an Enemy
     '''
-    def __init__(self, id, X, Y, Z, payload):
-        self.id = id
-        self.X = X
-        self.Y = Y
-        self.Z = Z
-        self.payload = payload
+    ENEMY_POS_SIZE = 28
+    FIELDS = (U32('id'), F32('X'), F32('Y'), F32('Z'), Blob('payload', 12))
 
-    @staticmethod
-    def parse(payload):
-        id, X, Y, Z= unpack("Ifff",payload[:16])
-        return PacketEnemyPosPayload(id, X, Y, Z, payload[16:])
-    
-    def encode(self):
-        return pack("Ifff", self.id, self.X, self.Y, self.Z) + self.payload
-
-   
     def __str__(self) -> str:
         return f"EnemyPos: ID:{self.id} {self.X} / {self.Y} / {self.Z} {self.payload[:10].hex()} ..."
 
-class PacketReloadPayload():
+class PacketReloadPayload(Payload):
     '''
     Payload of Reload of weapon type
     '''
-    def __init__(self) :
-        self.payload = b''
+    FIELDS = ()
 
-    @staticmethod
-    def parse(payload):
-        return PacketReloadPayload()
-    
-    def encode(self):
-        return self.payload
-    
     def __str__(self) -> str:
         return f"Reload"
 
-class PacketBeaconPayload():
+class PacketBeaconPayload(Payload):
     '''
     Payload of Beacon type: check the connectivity
     '''
-    def __init__(self, payload) :
-        self.payload = payload
+    FIELDS = (Blob('payload', 35),)
 
-    @staticmethod
-    def parse(payload):
-        return PacketBeaconPayload(payload[:35])
-    
-    def encode(self):
-        return self.payload
-    
     def __str__(self) -> str:
         return f"Beacon: {self.payload.hex()}"
 
-class PacketShootPayload():
+class PacketShootPayload(Payload):
     '''
     Payload of Shoot type from the player
     '''
-    def __init__(self, name_size, name, payload) :
-        self.payload = payload 
-        self.name_size = name_size
-        self.name = name
+    FIELDS = (String('name', 'name_size'), Blob('payload', 12))
 
-    @staticmethod
-    def parse(payload):
-        name_size = int.from_bytes(payload[:2], 'little')
-        name = ''.join(chr(x) for x in payload[2:2+name_size])
-        other = payload[2+name_size:2+name_size+12]
-        return PacketShootPayload(name_size,name,other)
-    
-    def encode(self):
-        return self.name_size.to_bytes(2, "little") + self.name.encode() + self.payload
-    
     def __str__(self) -> str:
         return f"Shoot Arme:{self.name} Data:{self.payload.hex()}"
 
@@ -318,30 +178,41 @@ class ChangeToolPayload():
     '''
     Payload of Tool in hand of the user type
     '''
+    SIZE = 1
+    __slots__ = ('nb', 'size')
+
     def __init__(self, nb) :
         self.nb = nb
 
     @staticmethod
     def parse(payload):
-        return ChangeToolPayload((payload[0]+1)%10)
+        pl = ChangeToolPayload((payload[0]+1)%10)
+        pl.size = 1
+        return pl
     
     def encode(self):
-        return self.nb.to_bytes(1,'big')
+        # inverse of parse: slots are numbered from 1 on screen
+        return ((self.nb-1)%10).to_bytes(1,'big')
     
     def __str__(self) -> str:
         return f"Change Tool: {self.nb}"
 
 class JumpPacketPayload():
     '''Jump packet payload'''
+    SIZE = 1
+    __slots__ = ('action', 'size')
+
     def __init__(self, action) :
         self.action = action
 
     @staticmethod
     def parse(payload):
         if payload[0] == 1:
-            return JumpPacketPayload("Up")
+            pl = JumpPacketPayload("Up")
         else:
-            return JumpPacketPayload("Down")
+            pl = JumpPacketPayload("Down")
+        pl.size = 1
+        return pl
     
     def encode(self):
         if self.action == "Up":
@@ -353,130 +224,191 @@ class JumpPacketPayload():
         return f"Jump: {self.action}"
 
 
-class PacketBurstPayload():
+class PacketBurstPayload(Payload):
     '''Burst packet to inform of the start and end of a burst'''
-    def __init__(self, action) :
-        self.action = action
+    FIELDS = (U8('action'),)
 
-    @staticmethod
-    def parse(payload):
-        action = payload[0]
-        return PacketBurstPayload(action)
-    
-    def encode(self):
-        return self.action.to_bytes(1, "little")
-    
     def __str__(self) -> str:
         return f"Burst : {self.action}"
 
 
-class PacketShootServerPayload():
+class PacketShootServerPayload(Payload):
     '''Shoot packet from the server payload'''
-    def __init__(self, payload) :
-        self.payload = payload
+    FIELDS = (Blob('payload'),)
 
-    @staticmethod
-    def parse(payload):
-        return PacketShootServerPayload(payload)
-    
-    def encode(self):
-        return self.payload
-    
     def __str__(self) -> str:
         return f"ShootServer: {self.payload.hex()}"
 
 
-class PacketHPmodifPayload():
+class PacketHPmodifPayload(Payload):
     '''Health Point packet'''
-    def __init__(self, id, level) :
-        self.id = id
-        self.level = level
+    FIELDS = (U32('id'), U32('level'))
 
-    @staticmethod
-    def parse(payload):
-        id = int.from_bytes(payload[:4],'little')
-        level = int.from_bytes(payload[4:8],'little')
-        return PacketHPmodifPayload(id, level)
-    
-    def encode(self):
-        return self.id.to_bytes(4,'little') + self.level.to_bytes(4,'little')
-    
     def __str__(self) -> str:
         return f"HP modification: {self.id} {self.level}"
 
 
-class PacketSellPayload():
+class PacketSellPayload(Payload):
     '''Sell on object packet'''
-    def __init__(self, id, lenght_name, name, quantity) :
-        self.id = id
-        self.lenght_name = lenght_name
-        self.name = name
-        self.quantity = quantity
+    FIELDS = (U32('id'), String('name', 'lenght_name'), U32('quantity'))
 
-    @staticmethod
-    def parse(payload):
-        id = int.from_bytes(payload[0:4], 'little')
-        lenght_name = int.from_bytes(payload[4:6], 'little')
-        name = payload[6:lenght_name + 6].decode()
-        quantity = int.from_bytes(payload[lenght_name + 6: lenght_name + 10], 'little')
-
-        
-        return PacketSellPayload(id, lenght_name, name, quantity)
-    
-    def encode(self):
-        return self.id.to_bytes(4, "little") + self.lenght_name.to_bytes(2, "little") + self.name.encode() + self.quantity.to_bytes(4, "little")
-    
     def __str__(self) -> str:
         return f"Sell: id {self.id} {self.name} {self.quantity}"
 
-class PacketXchangePayload():
+class PacketXchangePayload(Payload):
     ''' Exchange packet after buying or selling an object'''
-    def __init__(self, lenght_name, name, quantity, data, lenghtxname, xname, coins) :
-        self.lenght_name = lenght_name
-        self.name = name
-        self.quantity = quantity
-        self.data = data
-        self.lenghtxname = lenghtxname
-        self.xname = xname
-        self.coins = coins
+    FIELDS = (String('name', 'lenght_name'), U32('quantity'), Blob('data', 2), String('xname', 'lenghtxname'), UInt('coins', 6))
 
-
-    @staticmethod
-    def parse(payload):
-        lenght_name = int.from_bytes(payload[0:2], "little")
-        name = payload[2:lenght_name + 2].decode()
-        quantity = int.from_bytes(payload[lenght_name + 2: lenght_name + 6], 'little')
-        data = payload[lenght_name + 6: lenght_name + 8]
-        lenghtxname = int.from_bytes(payload[lenght_name + 8: lenght_name + 10], 'little')
-        xname = payload[lenght_name + 10:lenghtxname + lenght_name + 10].decode()
-        coins = int.from_bytes(payload[lenghtxname + lenght_name + 10: lenghtxname + lenght_name + 16], 'little')
-        return PacketXchangePayload(lenght_name, name, quantity, data, lenghtxname, xname, coins)
-    
-    def encode(self):
-        return self.lenght_name.to_bytes(2, "little") + self.name.encode() + self.quantity.to_bytes(4, "little") + self.data + self.lenghtxname.to_bytes(2, "little") + self.xname.encode() + self.coins.to_bytes(6, "little")
-    
     def __str__(self) -> str:
         return f"Xchange: {self.name} {self.quantity} {self.xname} {self.coins}"
 
-class Packet:
+class IncompletePacket(Exception):
+    """The buffer ends in the middle of a packet"""
+
+
+class Packet(metaclass=SlotsMeta):
+    # subclasses get empty __slots__ from the metaclass
+    __slots__ = ('header', '_payload', 'raw', '_baseline')
     HEADER_SIZE = 2
+    PAYLOAD = PacketDefaultPayload
 
-    def __init__(self, header, payload):
+    def __init__(self, header, payload = None, raw = None):
         self.header = header
-        self.payload = payload
-
+        self._payload = payload
+        # bytes of the packet on the wire, None for a forged packet
+        self.raw = raw
+        # payload decoded from raw and encoded again, computed once when it differs from raw
+        self._baseline = None
+
+    @property
+    def payload(self):
+        """Payload, decoded on first access"""
+        if self._payload is None:
+            body = self.raw[Packet.HEADER_SIZE:]
+            # timed here: only the packets somebody reads are decoded
+            start = perf_counter_ns() if METRICS.time_decodes else 0
+            try:
+                self._payload = self.PAYLOAD.parse(body)
+            except (StructError, IndexError, ValueError):
+                self._payload = PacketDefaultPayload.parse(body)
+            if start:
+                METRICS.decoded(self.header.type, self.PAYLOAD.__name__, perf_counter_ns() - start)
+        return self._payload
+
+    @payload.setter
+    def payload(self, payload):
+        self._payload = payload
+        self.raw = None
+        self._baseline = None
+
+    @property
+    def size(self):
+        """Number of bytes of the packet on the wire"""
+        if self.raw is not None:
+            return len(self.raw)
+        return Packet.HEADER_SIZE + len(self._payload.encode())
+
+    @staticmethod
+    def length(packet):
+        """
+        Size of the packet at the start of packet, read from its header and
+        length fields only.
+        Raise IncompletePacket if the buffer is too short to hold it.
+        """
+        size = Packet.needed(packet)
+        if size > len(packet):
+            raise IncompletePacket()
+        return size
+
+    @staticmethod
+    def needed(packet):
+        """
+        Size of the packet at the start of packet, even if the buffer does not
+        hold all of it yet.
+        Raise IncompletePacket if its header or length fields are not there yet.
+        """
+        if len(packet) < Packet.HEADER_SIZE:
+            raise IncompletePacket()
+        pkt_type = unpack_from('>H', packet)[0]
+        pkt_clazz = PacketRegistry.get(pkt_type)
+        try:
+            if pkt_clazz is None:
+                # unknown type: learned length, or the rest of the buffer
+                size = LENGTHS.length(pkt_type, packet[Packet.HEADER_SIZE:])
+                if size is None:
+                    size = len(packet) - Packet.HEADER_SIZE
+            else:
+                size = getattr(pkt_clazz.PAYLOAD, 'SIZE', None)
+                if size is None:
+                    size = pkt_clazz.PAYLOAD.length(packet[Packet.HEADER_SIZE:])
+        except (StructError, IndexError, ValueError) as err:
+            raise IncompletePacket() from err
+        return size + Packet.HEADER_SIZE
 
     @staticmethod
     def parse( packet):
+        """
+        Parse the packet at the start of packet (bytes or memoryview).
+        Only the header and the size are read: the payload is decoded when
+        it is first used.
+        Raise IncompletePacket if the buffer is too short to hold it.
+        """
+        size = Packet.length(packet)
         header = PacketHeader(packet[:Packet.HEADER_SIZE])
         pkt_clazz = PacketRegistry.get(header.type)
         if pkt_clazz is None:
-            return Packet(header, PacketDefaultPayload.parse(packet[Packet.HEADER_SIZE:]))
-        else:
-            return pkt_clazz.parse(packet)
+            pkt_clazz = Packet
+        return pkt_clazz(header, raw=packet[:size])
+
+    def compact(self):
+        """
+        Copy the packet out of the receive buffer before keeping it for a
+        long time: views on the buffer are replaced by small bytes objects
+        and the buffer can be freed.
+        """
+        if self.raw is not None:
+            self.raw = bytes(self.raw)
+        if self._payload is not None:
+            for cls in type(self._payload).__mro__:
+                for name in cls.__dict__.get('__slots__', ()):
+                    value = getattr(self._payload, name, None)
+                    if isinstance(value, memoryview):
+                        setattr(self._payload, name, bytes(value))
+        return self
 
     def encode(self) -> bytes:
-        return self.header.encode() + self.payload.encode()
+        """
+        Bytes of the packet: the bytes received while the payload is not modified,
+        so fields a payload does not keep (padding, ...) are forwarded as they came
+        """
+        if self._payload is None:
+            # never decoded so never modified
+            return bytes(self.raw)
+        payload = self._payload.encode()
+        if self.raw is not None and not self._changed(payload):
+            return bytes(self.raw)
+        return self.header.encode() + payload
+
+    def modified(self):
+        """True when the payload decoded from raw was changed since"""
+        if self._payload is None:
+            return False
+        return self.raw is None or self._changed(self._payload.encode())
+
+    def _changed(self, payload):
+        """True when payload, the payload encoded, is not the one received in raw"""
+        body = self.raw[Packet.HEADER_SIZE:]
+        if payload == body:
+            # the same bytes whatever was changed
+            return False
+        if self._baseline is None:
+            # fields the payload does not keep (padding...): raw decoded and encoded again, once
+            try:
+                self._baseline = type(self._payload).parse(body).encode()
+            except (StructError, IndexError, ValueError):
+                return True
+        # compared encoded: NaN fields are equal to themselves
+        return payload != self._baseline
 
     def __str__(self):
         return f"{self.header} {self.payload}"
@@ -488,222 +420,318 @@ class Packet:
 class NewElmtPacket(Packet):
     """New element"""
     TYPE = 0x6d6b
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketNewElmtPayload.parse(packet[Packet.HEADER_SIZE:])
-        return NewElmtPacket(header, payload)
+    PAYLOAD = PacketNewElmtPayload
 
 
 @packet_type(0x6d76)
 class PositionPacket(Packet):
     TYPE = 0x6d76
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketPositionPayload.parse(packet[Packet.HEADER_SIZE:])
-        return PositionPacket(header, payload)
+    PAYLOAD = PacketPositionPayload
 
 @packet_type(0x7073)
 class EnemyPosPacket(Packet):
     TYPE = 0x7073
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketEnemyPosPayload.parse(packet[Packet.HEADER_SIZE:])
-        return EnemyPosPacket(header, payload)
+    PAYLOAD = PacketEnemyPosPayload
 
 @packet_type(0x6674)
 class FastTravelPacket(Packet):
     TYPE = 0x6674
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketFastTravelPayload.parse(packet[Packet.HEADER_SIZE:])
-        return FastTravelPacket(header, payload)
+    PAYLOAD = PacketFastTravelPayload
 
 @packet_type(0x1703)
 class BeaconPacket(Packet):
     TYPE = 0x1703 
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketBeaconPayload.parse(packet[Packet.HEADER_SIZE:])
-        return BeaconPacket(header, payload)
+    PAYLOAD = PacketBeaconPayload
 
 @packet_type(0x6a70)
 class JumpPacket(Packet):
     TYPE = 0x6a70
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = JumpPacketPayload.parse(packet[Packet.HEADER_SIZE:])
-        return JumpPacket(header, payload)
+    PAYLOAD = JumpPacketPayload
 
 @packet_type(0x733D)
 class ChangeTool(Packet):
     TYPE = 0x733D
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = ChangeToolPayload.parse(packet[Packet.HEADER_SIZE:])
-        return ChangeTool(header, payload)
+    PAYLOAD = ChangeToolPayload
 
 @packet_type(0x726c)
 class ReloadPacket(Packet):
     TYPE = 0x726c
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketReloadPayload.parse(packet[Packet.HEADER_SIZE:])
-        return ReloadPacket(header, payload)
+    PAYLOAD = PacketReloadPayload
 
 @packet_type(0x2a69)
 class ShootPacket(Packet):
     TYPE = 0x2a69
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketShootPayload.parse(packet[Packet.HEADER_SIZE:])
-        return ShootPacket(header, payload)
+    PAYLOAD = PacketShootPayload
 
 
 @packet_type(0x6672)
 class BurstPacket(Packet):
     TYPE = 0x6672
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketBurstPayload.parse(packet[Packet.HEADER_SIZE:])
-        return BurstPacket(header, payload)
+    PAYLOAD = PacketBurstPayload
 
 
 @packet_type(0x6c61)
 class PacketShootServer(Packet):
     TYPE = 0x6c61
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketShootServerPayload.parse(packet[Packet.HEADER_SIZE:])
-        return PacketShootServer(header, payload)
+    PAYLOAD = PacketShootServerPayload
 
 @packet_type(0x2b2b)
 class HPmodifPacket(Packet):
     TYPE = 0x2b2b
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketHPmodifPayload.parse(packet[Packet.HEADER_SIZE:])
-        return HPmodifPacket(header, payload)
+    PAYLOAD = PacketHPmodifPayload
 
 @packet_type(0x2473)
 class SellPacket(Packet):
     TYPE = 0x2473
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketSellPayload.parse(packet[Packet.HEADER_SIZE:])
-        return SellPacket(header, payload)
+    PAYLOAD = PacketSellPayload
 
 @packet_type(0x726d)
 class XchangePacket(Packet):
     TYPE = 0x726d
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketXchangePayload.parse(packet[Packet.HEADER_SIZE:])
-        return XchangePacket(header, payload)
+    PAYLOAD = PacketXchangePayload
 
 @packet_type(0x7374)
 class PlayerStatePacket(Packet):
     TYPE = 0x7374
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketPlayerStatePayload.parse(packet[Packet.HEADER_SIZE:])
-        return PlayerStatePacket(header, payload)
+    PAYLOAD = PacketPlayerStatePayload
 
 @packet_type(0x7472)
 class AttackStatePacket(Packet):
     TYPE = 0x7472
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketAttackStatePayload.parse(packet[Packet.HEADER_SIZE:])
-        return AttackStatePacket(header, payload)
+    PAYLOAD = PacketAttackStatePayload
 
 @packet_type(0X6565)
 class ItemPickPacket(Packet):
     TYPE = 0X6565
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketItemPickPayload.parse(packet[Packet.HEADER_SIZE:])
-        return ItemPickPacket(header, payload)
+    PAYLOAD = PacketItemPickPayload
 
 @packet_type(0x7878)
 class RemoveElmtPacket(Packet):
     TYPE = 0x7878
-
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketRemoveElmtPayload.parse(packet[Packet.HEADER_SIZE:])
-        return RemoveElmtPacket(header, payload)
+    PAYLOAD = PacketRemoveElmtPayload
 
 @packet_type(0x6370)
 class NewInventoryPacket(Packet):
     TYPE = 0x6370
+    PAYLOAD = PacketNewInventoryPayload
 
-    @staticmethod
-    def parse(packet):
-        header = PacketHeader.parse(packet[:Packet.HEADER_SIZE])
-        payload = PacketNewInventoryPayload.parse(packet[Packet.HEADER_SIZE:])
-        return RemoveElmtPacket(header, payload)
+def distance(payload, X, Y, Z):
+    """Distance between a payload with a position and a point"""
+    return ((payload.X - X) ** 2 + (payload.Y - Y) ** 2 + (payload.Z - Z) ** 2) ** 0.5
 
-FILTERS_DICT = {
-    'Show only unknown': 'pkt.header.type not in PacketRegistry.TYPE_TO_CLASS',
-    'Whitelist': 'pkt.header.type in whitelist',
-    'Blacklist': 'pkt.header.type not in blacklist'
-}
+class PacketFilter:
+    """
+    Filter compiled once, when it is created.
+    The packet types accepted are kept in a bitmap of the 65536 types so a
+    packet is rejected from its header, before its payload is decoded.
+    predicate is an expression on pkt, compiled to a function, which is
+    only evaluated on the packets of an accepted type.
+    """
+    __slots__ = ('bitmap', 'predicate')
+
+    def __init__(self, types = None, exclude = (), predicate = None):
+        if types is None:
+            self.bitmap = bytearray(b'\x01' * 0x10000)
+        else:
+            self.bitmap = bytearray(0x10000)
+            for pkt_type in types:
+                self.bitmap[pkt_type] = 1
+        for pkt_type in exclude:
+            self.bitmap[pkt_type] = 0
+        self.predicate = None
+        if predicate is not None:
+            self.predicate = eval(compile(f"lambda pkt: {predicate}", f"<filter {predicate}>", 'eval'))
+
+    def accept_type(self, pkt_type):
+        return self.bitmap[pkt_type]
+
+    def match(self, pkt):
+        if not self.bitmap[pkt.header.type]:
+            return False
+        return self.predicate is None or self.predicate(pkt)
 
 blacklist = [PositionPacket.TYPE, BeaconPacket.TYPE, EnemyPosPacket.TYPE, JumpPacket.TYPE ]
 whitelist = [ItemPickPacket.TYPE, NewInventoryPacket.TYPE]
+# position of the standalone data in reverse_protocol.md
+spot = (-38962.0, -22055.0, 2807.5)
+
+FILTERS_DICT = {
+    'Show only unknown': PacketFilter(exclude=PacketRegistry.TYPE_TO_CLASS),
+    'Whitelist': PacketFilter(types=whitelist),
+    'Blacklist': PacketFilter(exclude=blacklist),
+    'Enemy 3493': PacketFilter(types=[EnemyPosPacket.TYPE], predicate='pkt.payload.id == 3493'),
+    'Enemies near spot': PacketFilter(types=[EnemyPosPacket.TYPE], predicate='distance(pkt.payload, *spot) < 5000'),
+}
 
 FILTERS = list(FILTERS_DICT.keys())
 
-def parse(data, conn_dir, window_text = None, filter_selected = None):
-    """Parse packet"""
-    if data == b'\x00\x00':
-        return
-    while len(data) != 0 :
-        pkt = Packet.parse(data)
-        data = data[len(pkt.encode()):]
+def frame(data, pkt_filter = None):
+    """
+    Cut data into packets.
+    The buffer is walked with an offset on a memoryview so nothing is copied
+    and payloads keep references to data.
+    Payloads are not decoded here.
+    With a PacketFilter, only the packets of the types it accepts are
+    returned, the others are skipped.
+    Return the packets and the number of bytes consumed: a packet cut by
+    the end of the buffer is left unconsumed.
+    """
+    view = memoryview(data)
+    end = len(view)
+    offset = 0
+    packets = []
+    while offset < end:
+        if pkt_filter is not None and end - offset >= Packet.HEADER_SIZE:
+            if not pkt_filter.accept_type(unpack_from('>H', view, offset)[0]):
+                try:
+                    offset += Packet.length(view[offset:])
+                except IncompletePacket:
+                    break
+                continue
+        try:
+            pkt = Packet.parse(view[offset:])
+        except IncompletePacket:
+            break
+        if pkt.__class__ is Packet:
+            after = offset + pkt.size
+            if after == end:
+                # unknown packet taking the rest of the buffer: a sample of its length
+                if LENGTHS.learn(pkt.header.type, pkt.raw[Packet.HEADER_SIZE:], whole):
+                    continue
+            elif pkt.header.type in LENGTHS.rules and end - after >= Packet.HEADER_SIZE:
+                # framed by a learned rule: the next packet tells if the rule holds
+                next_type = unpack_from('>H', view, after)[0]
+                if not LENGTHS.check(pkt.header.type, PacketRegistry.get(next_type) is not None or next_type in LENGTHS.rules):
+                    continue
+        packets.append(pkt)
+        offset += pkt.size
+    return packets, offset
+
+def whole(data):
+    """True when data is made of whole packets of known types (or of types with a learned length)"""
+    view = memoryview(data)
+    end = len(view)
+    offset = 0
+    while offset < end:
+        if end - offset < Packet.HEADER_SIZE:
+            return False
+        pkt_type = unpack_from('>H', view, offset)[0]
+        if PacketRegistry.get(pkt_type) is None and pkt_type not in LENGTHS.rules:
+            return False
+        try:
+            offset += Packet.length(view[offset:])
+        except IncompletePacket:
+            return False
+    return True
+
+class StreamBuffer:
+    """
+    Reassemble the packets of one direction of a connection.
+    TCP does not keep packet boundaries: the tail of a recv cut in the
+    middle of a packet is kept and joined with the next recv.
+    """
+    # give up on a packet that never completes
+    MAX_PENDING = 0x10000
+    # the consumed start of pending is removed once it is this large
+    COMPACT = 0x4000
+    __slots__ = ('pending', 'start', 'need', 'gap', 'session')
+
+    def __init__(self, session=None):
+        # bytes not framed yet: pending[start:]
+        self.pending = bytearray()
+        self.start = 0
+        # size of the packet at the front of pending, 0 when not known yet
+        self.need = 0
+        # set when data of the stream was dropped
+        self.gap = False
+        # name of the session of the connection, for the sinks
+        self.session = session
+
+    def _reset(self):
+        self.pending.clear()
+        self.start = 0
+        self.need = 0
+
+    def feed(self, data, framer=None):
+        """
+        Add received data, return the complete packets.
+        framer is the frame function to use, the one of this module by
+        default: a parser hot reloaded passes its own.
+        """
+        if framer is None:
+            framer = frame
+        if self.gap:
+            # the tail can not be completed anymore
+            self.gap = False
+            self._reset()
+        buffered = len(self.pending) > self.start
+        if buffered:
+            self.pending += data
+            if len(self.pending) - self.start < self.need:
+                # a big packet still coming: only appended, not framed again
+                return []
+            # payloads keep views on the buffer: frame a snapshot so the
+            # bytearray can still be resized
+            data = bytes(memoryview(self.pending)[self.start:])
+        elif data == b'\x00\x00':
+            return []
+        packets, consumed = framer(data)
+        rest = len(data) - consumed
+        if rest == 0:
+            self._reset()
+        elif rest > StreamBuffer.MAX_PENDING:
+            print(f"Dropping {rest} bytes of incomplete packet")
+            self._reset()
+        else:
+            if buffered:
+                self.start += consumed
+                if self.start >= StreamBuffer.COMPACT:
+                    del self.pending[:self.start]
+                    self.start = 0
+            else:
+                self.pending += memoryview(data)[consumed:]
+            try:
+                self.need = Packet.needed(memoryview(data)[consumed:])
+            except IncompletePacket:
+                self.need = 0
+        return packets
+
+def parse(data, conn_dir, window_text = None, filter_selected = None, stream = None, packet_sink = None):
+    """
+    Parse packet, return the number of bytes consumed.
+    With a StreamBuffer, an incomplete packet at the end of data is kept
+    for the next call.
+    With packet_sink, the packets are given to packet_sink(pkt, conn_dir)
+    instead of being formatted and displayed. With filter_selected, only
+    the packets it matches are displayed or given to packet_sink.
+    """
+    pkt_filter = None
+    if filter_selected is not None:
+        pkt_filter = FILTERS_DICT[filter_selected]
+    if stream is not None:
+        packets = stream.feed(data, lambda chunk: frame(chunk, pkt_filter))
+        consumed = len(data)
+    elif data == b'\x00\x00':
+        return len(data)
+    else:
+        packets, consumed = frame(data, pkt_filter)
+    for pkt in packets:
+        if METRICS.enabled:
+            METRICS.packet(pkt.header.type, conn_dir, pkt.size, pkt.PAYLOAD.__name__)
+
         # if pkt.header.type not in PacketRegistry.TYPE_TO_CLASS:  # type == 'client' and  # unknown packets
         #   print(f"[{conn_dir}] {pkt}")
         
-        if filter_selected is not None:
-            condition = eval(FILTERS_DICT[filter_selected])
+        if pkt_filter is not None:
+            condition = pkt_filter.match(pkt)
         else:
             condition = True
 
+        if packet_sink is not None:
+            if condition:
+                packet_sink(pkt, conn_dir)
+            continue
+
         if condition: # do not show blacklisted packets
             txt = f"[{conn_dir}] {pkt}\n"
             if window_text is not None:
@@ -711,8 +739,15 @@ def parse(data, conn_dir, window_text = None, filter_selected = None):
                 window_text.see(END)
             else:
                 print(txt)
+    return consumed
+
+# server traffic captured on the proxy
+SAMPLE = bytes.fromhex("7073a50d0000832c49c6f57402c776b832450000c472000068ff330000007073a60d00002aeac7c5556908c74bb12e450000d4530000b5ff8d0000007073a70d0000addffbc5d99622c727244e450000388a00000000000000007073a80d00004e6108c3099323c75e9a1a450000c03e00000500a00000007073a90d0000767a014547e20bc714aa1145000070d7000057007aff00006d76a20d00003b5fc2c6ea7de3c6241c2545e7fffffffcf17073a30d0000d6b0b1c6f1c2d5c67e382e4500003c800000c0fefeff00007073a40d000006c5cbc6984511c7a27e43450000e9b80000e4ff62ff00000000")
 
 if __name__ == "__main__":
-    pkt = Packet.parse(bytes.fromhex("7073a50d0000832c49c6f57402c776b832450000c472000068ff330000007073a60d00002aeac7c5556908c74bb12e450000d4530000b5ff8d0000007073a70d0000addffbc5d99622c727244e450000388a00000000000000007073a80d00004e6108c3099323c75e9a1a450000c03e00000500a00000007073a90d0000767a014547e20bc714aa1145000070d7000057007aff00006d76a20d00003b5fc2c6ea7de3c6241c2545e7fffffffcf17073a30d0000d6b0b1c6f1c2d5c67e382e4500003c800000c0fefeff00007073a40d000006c5cbc6984511c7a27e43450000e9b80000e4ff62ff00000000"))
+    packets, _ = frame(SAMPLE)
 
-    print(pkt)
+    for pkt in packets:
+        print(pkt)
+        # decoded but not modified: encoded as received
+        assert pkt.encode() == bytes(pkt.raw), f"{pkt.header} is not encoded as received"
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to provide the tcp proxy on a single asyncio event loop:
+every port and every session share one thread instead of three threads per session
+"""
+
+import asyncio
+import functools
+from time import perf_counter_ns
+import Protocol_Parser
+from metrics import METRICS
+from rewrite import REWRITER, RewriteStream
+
+
+class AsyncProxy:
+    """
+    Proxy of several ports served by one event loop
+
+    Parameters
+    ----------
+    from_host : str
+        IP to listen to
+    to_host : str
+        IP of the server
+    ports : list of int
+        ports connect / listen
+    on_data : callable
+        hook called as on_data(data, port, conn_dir, stream) for every chunk forwarded,
+        stream being the Protocol_Parser.StreamBuffer of the direction
+    on_close : callable
+        hook called as on_close(stream) when the direction of the stream ends
+    port_offset : int
+        the server listens on port + port_offset
+    status : callable
+        called as status(*args) with the setup, connection and error messages, print by default
+
+    Attributes
+    ----------
+    from_host : str
+        IP to listen to
+    to_host : str
+        IP of the server
+    ports : list of int
+        ports of the connexions
+    on_data : callable
+        hook to parse / display data
+    on_close : callable
+        hook called at the end of a direction
+    port_offset : int
+        offset of the ports of the server
+    status : callable
+        prints the messages
+    """
+
+    def __init__(self, from_host, to_host, ports, on_data=None, on_close=None, port_offset=0, status=print) -> None:
+        self.from_host = from_host
+        self.to_host = to_host
+        self.ports = list(ports)
+        self.on_data = on_data
+        self.on_close = on_close
+        self.port_offset = port_offset
+        self.status = status
+
+    def run(self):
+        """Run the event loop until the proxy is stopped"""
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        """Listen on every port"""
+        servers = []
+        for port in self.ports:
+            server = await asyncio.start_server(functools.partial(self.handle, port), self.from_host, port)
+            servers.append(server)
+            self.status(f"[proxy({port})] setting up")
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+    async def handle(self, port, client_reader, client_writer):
+        """One session: connect to the server and relay both directions"""
+        try:
+            server_reader, server_writer = await asyncio.open_connection(self.to_host, port + self.port_offset)
+        except OSError as conn_err:
+            self.status(f'server[{port}]', conn_err)
+            client_writer.close()
+            return
+        session = REWRITER.new_session(port)
+        self.status(f"[proxy({port})] connection established: session {session}")
+        await asyncio.gather(
+            self.relay(client_reader, server_writer, client_writer, port, 'client', session),
+            self.relay(server_reader, client_writer, server_writer, port, 'server', session),
+        )
+
+    async def relay(self, reader, writer, source_writer, port, conn_dir, session=None):
+        """
+        Copy one direction of a session, giving every chunk to the hook.
+        source_writer is the writer of the side read: both sides are closed when it ends.
+        """
+        stream = Protocol_Parser.StreamBuffer(session)
+        rewrite = RewriteStream(conn_dir, session=session)
+        try:
+            while True:
+                data = await reader.read(4096)
+                if not data:
+                    break
+                start = perf_counter_ns()
+                data = rewrite.feed(data)
+                if not data:
+                    continue
+                # forward first, the hook runs while the data is on its way
+                writer.write(data)
+                if self.on_data is not None:
+                    try:
+                        self.on_data(data, port, conn_dir, stream)
+                    except Exception as o_err:
+                        self.status(f'{conn_dir}[{port}]', o_err)
+                await writer.drain()
+                METRICS.observe(f'forward {conn_dir}', perf_counter_ns() - start)
+        except Exception as err:
+            # OSError, IncompleteReadError, an error of a rewrite hook...: the session ends
+            self.status(f'{conn_dir}[{port}]', repr(err))
+        finally:
+            # the session is over when one side hangs up: the other relay stops reading too
+            writer.close()
+            source_writer.close()
+            rewrite.close()
+            if self.on_close is not None:
+                self.on_close(stream)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to decode runs of fixed-size packets (EnemyPos, Position...) at array speed.
+Server traffic is mostly back-to-back EnemyPos / Position packets: instead of one object per
+packet, a run of packets of the same type is viewed as a NumPy structured array, without copy.
+
+Columnar API:
+    for pkt_type, run in iter_runs(data): run['X'], run['id']...
+    columns = decode(data)  # {pkt_type: structured array}
+
+numpy is optional for the proxy, it is only needed by this module.
+"""
+
+from struct import unpack_from
+import sys
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from Protocol_Parser import Packet, PacketRegistry, IncompletePacket, EnemyPosPacket, PositionPacket
+from packet_schema import Number, UInt, Blob, Pad
+
+# types decoded in batch by default
+BATCH_TYPES = (EnemyPosPacket.TYPE, PositionPacket.TYPE)
+
+# struct code -> numpy little endian type
+NUMPY_TYPES = {'B': 'u1', 'H': '<u2', 'I': '<u4', 'i': '<i4', 'f': '<f4'}
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("batch decoding needs numpy: pip install numpy")
+
+
+def packet_dtype(pkt_type):
+    """
+    Structured dtype of a whole packet (header included) built from the schema of its payload.
+    Return None if the type has no fixed size schema.
+    """
+    _require_numpy()
+    payload_clazz = getattr(PacketRegistry.get(pkt_type), 'PAYLOAD', None)
+    fields = getattr(payload_clazz, 'FIELDS', None)
+    if fields is None or getattr(payload_clazz, 'SIZE', None) is None:
+        return None
+    # the header is big endian
+    dtype = [('type', '>u2')]
+    for i, field in enumerate(fields):
+        if isinstance(field, Number):
+            dtype.append((field.name, NUMPY_TYPES[field.fmt]))
+        elif isinstance(field, (Blob, UInt)):
+            dtype.append((field.name, f'V{field.size}'))
+        elif isinstance(field, Pad):
+            dtype.append((f'_pad{i}', f'V{field.size}'))
+    return np.dtype(dtype)
+
+
+def iter_runs(data, types=BATCH_TYPES):
+    """
+    Find the runs of consecutive packets of the same type among types.
+    Yield (type, structured array) for each run, in the order of data.
+    The arrays are views on data: nothing is copied.
+    """
+    _require_numpy()
+    dtypes = {pkt_type: packet_dtype(pkt_type) for pkt_type in types}
+    view = memoryview(data)
+    end = len(view)
+    offset = 0
+    while offset < end:
+        try:
+            size = Packet.length(view[offset:])
+        except IncompletePacket:
+            break
+        pkt_type = unpack_from('>H', view, offset)[0]
+        dtype = dtypes.get(pkt_type)
+        if dtype is None:
+            offset += size
+            continue
+        # headers of the following packets if the run goes on, compared at once
+        count = (end - offset) // size
+        headers = np.ndarray((count,), dtype='>u2', buffer=view, offset=offset, strides=(size,))
+        mismatch = np.flatnonzero(headers != pkt_type)
+        if len(mismatch):
+            count = int(mismatch[0])
+        yield pkt_type, np.ndarray((count,), dtype=dtype, buffer=view, offset=offset)
+        offset += count * size
+
+
+def decode(data, types=BATCH_TYPES):
+    """Decode every run of data, return {type: structured array of all its packets}"""
+    _require_numpy()
+    runs = {}
+    for pkt_type, run in iter_runs(data, types):
+        runs.setdefault(pkt_type, []).append(run)
+    return {pkt_type: np.concatenate(arrays) for pkt_type, arrays in runs.items()}
+
+
+if __name__ == "__main__":
+    # python3 batch_decode.py <hex dump>
+    if len(sys.argv) != 2:
+        print(f"Usage: python3 {sys.argv[0]} <hex>")
+        sys.exit(1)
+    for pkt_type, array in decode(bytes.fromhex(sys.argv[1])).items():
+        print(f"0x{pkt_type:x}: {len(array)} packets")
+        for name in array.dtype.names[1:]:
+            if array.dtype[name].kind != 'V':
+                print(f"    {name}: min {array[name].min()} max {array[name].max()}")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+Benchmark of the start of the proxy: each module is imported in a fresh interpreter, which
+reports the import time, the resident memory and the modules loaded.
+The headless modules must not load Tk: the exit status is 1 if one of them does.
+
+    import ms   time of the import statement
+    start ms    the whole process: interpreter start, import and exit
+    RSS MB      maximum resident memory of the process
+    modules     modules loaded by the import
+
+Usage: python3 bench_import.py [--runs N] [module...]
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+
+# the proxy and the tools which run without a display
+HEADLESS = ('Protocol_Parser', 'proxy', 'replay', 'capture')
+MODULES = HEADLESS + ('gui',)
+GUI_MODULES = ('tkinter', '_tkinter', 'customtkinter')
+RUNS = 5
+
+# json is imported after the measure: it is imported by some of the modules measured
+PROBE = """
+import resource, sys, time
+loaded = set(sys.modules)
+start = time.perf_counter()
+{import_line}
+elapsed = time.perf_counter() - start
+import json
+print(json.dumps({{
+    'import': elapsed,
+    'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': len(set(sys.modules) - loaded),
+    'gui': sorted(name for name in {gui_modules!r} if name in sys.modules),
+}}))
+"""
+
+
+def probe(module):
+    """Import module in a fresh interpreter, return its measures and the time of the process"""
+    code = PROBE.format(import_line=f"import {module}" if module else "pass", gui_modules=GUI_MODULES)
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout
+    elapsed = time.perf_counter() - start
+    # the last line: modules may print when they are imported
+    results = json.loads(out.strip().splitlines()[-1])
+    results['start'] = elapsed
+    return results
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv):
+    runs, modules = RUNS, []
+    args = iter(argv)
+    for arg in args:
+        if arg == '--runs':
+            runs = int(next(args))
+        elif not arg.startswith('--'):
+            modules.append(arg)
+        else:
+            print(__doc__)
+            return 1
+    modules = modules or list(MODULES)
+
+    status = 0
+    print(f"{'module':<18} {'import ms':>10} {'start ms':>9} {'RSS MB':>7} {'modules':>8}  GUI modules")
+    # the bare interpreter, the reference
+    for module in [''] + modules:
+        results = [probe(module) for _ in range(runs)]
+        gui = results[0]['gui']
+        # ru_maxrss is in kB on Linux
+        print(f"{module or '(python)':<18} {1e3 * median(r['import'] for r in results):>10.1f}"
+              f" {1e3 * median(r['start'] for r in results):>9.1f} {median(r['rss'] for r in results) / 1024:>7.1f}"
+              f" {median(r['modules'] for r in results):>8}  {' '.join(gui)}")
+        if module in HEADLESS and gui:
+            print(f"  {module} loads {', '.join(gui)}: it needs a display")
+            status = 1
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
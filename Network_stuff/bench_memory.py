@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+Benchmark of the memory used by a history of packets.
+A stream of EnemyPos packets is parsed, decoded and kept, and the bytes per retained packet
+are measured with the compact classes (__slots__) and with the same attributes stored in
+regular objects with a __dict__, as the classes were before.
+Packet.compact() also replaces the views on the receive buffers by small bytes objects.
+
+Usage: python3 bench_memory.py [number of packets]
+"""
+
+import gc
+import sys
+import tracemalloc
+from Protocol_Parser import frame
+
+# EnemyPos packets of the sample of Protocol_Parser
+SAMPLE = bytes.fromhex(
+    "7073a50d0000832c49c6f57402c776b832450000c472000068ff33000000"
+    "7073a60d00002aeac7c5556908c74bb12e450000d4530000b5ff8d000000"
+    "7073a70d0000addffbc5d99622c727244e450000388a0000000000000000"
+    "7073a80d00004e6108c3099323c75e9a1a450000c03e00000500a0000000"
+    "7073a90d0000767a014547e20bc714aa1145000070d7000057007aff0000"
+)
+# packets per recv, as read by the proxy
+CHUNK = SAMPLE * (4096 // len(SAMPLE))
+
+
+def plain_copy(obj, classes):
+    """Copy of a compact object into a regular object with a __dict__"""
+    if not hasattr(type(obj), '__slots__') or isinstance(obj, (bytes, memoryview)):
+        return obj
+    clazz = classes.get(type(obj))
+    if clazz is None:
+        clazz = classes[type(obj)] = type(type(obj).__name__, (), {})
+    copy = clazz()
+    for cls in reversed(type(obj).__mro__):
+        for name in cls.__dict__.get('__slots__', ()):
+            if hasattr(obj, name):
+                setattr(copy, name, plain_copy(getattr(obj, name), classes))
+    return copy
+
+
+def history(count, compact):
+    """Parse count packets and keep them, with their payload decoded as for display"""
+    packets = []
+    while len(packets) < count:
+        for pkt in frame(bytes(CHUNK))[0]:
+            pkt.payload
+            if compact:
+                pkt.compact()
+            packets.append(pkt)
+    return packets[:count]
+
+
+def measure(count, slots, compact=False):
+    gc.collect()
+    tracemalloc.start()
+    packets = history(count, compact)
+    if not slots:
+        classes = {}
+        packets = [plain_copy(pkt, classes) for pkt in packets]
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del packets
+    return used / count
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    before = measure(count, slots=False)
+    print(f"{count} EnemyPos packets retained")
+    print(f"with __dict__            : {before:.0f} bytes/packet")
+    for label, compact in (('with __slots__           ', False), ('with __slots__, compact()', True)):
+        after = measure(count, slots=True, compact=compact)
+        print(f"{label}: {after:.0f} bytes/packet ({100 * (before - after) / before:.0f}% less)")
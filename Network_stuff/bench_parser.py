@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+Benchmark of the throughput of the parser, to catch regressions of the hot path.
+
+A synthetic stream is generated with every type of PacketRegistry: real packets of the sample of
+Protocol_Parser and of the dumps of reverse_protocol.md, and packets built from the schema of each
+payload, in the proportions of the types seen in the sample and the dumps.
+Measured, in packets/s and MB/s:
+    frame      the stream cut in recv-sized chunks and framed by a StreamBuffer (payloads not decoded)
+    parse      Protocol_Parser.parse() on the same chunks, packets formatted as for display
+    <type>     for each type: payload parse, payload encode and round trip (Packet.parse + encode)
+
+Results are compared with the baseline file when it exists, --save replaces it. Benchmarks slower
+than the baseline by more than the threshold (10% by default) are reported and the exit status is 1.
+
+Usage: python3 bench_parser.py [--packets N] [--baseline <file>] [--threshold 0.1] [--save]
+"""
+
+import json
+import os
+import random
+import sys
+import time
+from collections import Counter
+import Protocol_Parser
+from Protocol_Parser import Packet, PacketRegistry, StreamBuffer, frame
+from packet_schema import Number, UInt, Blob, Pad, String
+from replay import read_dump
+from frame_lengths import LENGTHS
+
+# the streams are framed the same way whatever the proxy learned
+LENGTHS.learning = False
+LENGTHS.rules = {}
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_parser.json')
+DUMP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reverse_protocol.md')
+# slower than the baseline by more than this is reported as a regression
+THRESHOLD = 0.10
+# bytes per recv, as read by the proxy
+CHUNK = 4096
+NAMES = ('Pistol', 'GreatBallsOfFire', 'FinalStage', 'Rifle', 'Mana')
+# runs of each benchmark: at least REPEAT and MIN_TIME seconds, the best one is kept
+REPEAT = 5
+MIN_TIME = 0.2
+
+
+def synthetic_payload(clazz, rng):
+    """Encoded payload with random values, built from the FIELDS of the payload class"""
+    fields = getattr(clazz, 'FIELDS', None)
+    if fields is None:
+        # hand-written payload
+        return rng.randbytes(getattr(clazz, 'SIZE', 0) or 0)
+    values = {}
+    for field in fields:
+        if isinstance(field, Number):
+            if field.fmt == 'f':
+                values[field.name] = rng.uniform(-40000, 40000)
+            else:
+                values[field.name] = rng.randrange(1 << (8 * field.size - 1))
+        elif isinstance(field, UInt):
+            values[field.name] = rng.randrange(1 << (8 * field.size))
+        elif isinstance(field, Blob):
+            values[field.name] = rng.randbytes(field.size or 12)
+        elif isinstance(field, String):
+            name = rng.choice(NAMES)
+            values[field.name] = name
+            values[field.len_name] = len(name.encode())
+        elif not isinstance(field, Pad):
+            raise TypeError(f"no generator for {type(field).__name__}")
+    attrs = [name for field in fields for name in field.attrs()]
+    return clazz(*[values[name] for name in attrs]).encode()
+
+
+def real_packets():
+    """Packets of the sample and the dumps which frame as a single known packet"""
+    raws = [bytes(pkt.raw) for pkt in frame(Protocol_Parser.SAMPLE)[0]]
+    if os.path.exists(DUMP):
+        raws += [raw for _, raw in read_dump(DUMP)]
+    packets = []
+    for raw in raws:
+        pkt_type = int.from_bytes(raw[:2], 'big')
+        if pkt_type in PacketRegistry.TYPE_TO_CLASS and Packet.parse(raw).size == len(raw):
+            packets.append(raw)
+    return packets
+
+
+def packet_pools(rng, synthetic=64):
+    """Return {type: raw packets} and {type: weight in the stream}"""
+    pools = {pkt_type: [] for pkt_type in PacketRegistry.TYPE_TO_CLASS}
+    for raw in real_packets():
+        pools[int.from_bytes(raw[:2], 'big')].append(raw)
+    weights = {pkt_type: max(len(pool), 1) for pkt_type, pool in pools.items()}
+    for pkt_type, clazz in PacketRegistry.TYPE_TO_CLASS.items():
+        for _ in range(synthetic):
+            pools[pkt_type].append(pkt_type.to_bytes(2, 'big') + synthetic_payload(clazz.PAYLOAD, rng))
+    return pools, weights
+
+
+def delimited(raw):
+    """False for the packets whose payload takes the rest of the buffer: they end a stream"""
+    return Packet.length(raw + bytes(64)) == len(raw)
+
+
+def stream(pools, weights, count, rng):
+    """Stream of count packets in the proportions of weights"""
+    types = [pkt_type for pkt_type in weights if delimited(pools[pkt_type][0])]
+    picks = Counter(rng.choices(types, [weights[t] for t in types], k=count))
+    packets = [rng.choice(pools[pkt_type]) for pkt_type, n in picks.items() for _ in range(n)]
+    rng.shuffle(packets)
+    return b''.join(packets)
+
+
+def measure(fn, count, nbytes):
+    """Best run of fn, return (packets/s, MB/s)"""
+    best = float('inf')
+    runs, total = 0, 0.0
+    while runs < REPEAT or total < MIN_TIME:
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+        runs, total = runs + 1, total + elapsed
+    return count / best, nbytes / best / 1e6
+
+
+class _Sink:
+    """Text widget receiving the display of parse()"""
+    def __init__(self):
+        self.lines = []
+
+    def insert(self, _index, txt):
+        self.lines.append(txt)
+
+    def see(self, _index):
+        pass
+
+
+def bench_stream(data, count):
+    chunks = [data[i:i + CHUNK] for i in range(0, len(data), CHUNK)]
+
+    def run_frame():
+        buffer = StreamBuffer()
+        for chunk in chunks:
+            buffer.feed(chunk)
+
+    def run_parse():
+        buffer, sink = StreamBuffer(), _Sink()
+        for chunk in chunks:
+            Protocol_Parser.parse(chunk, 'server', sink, None, buffer)
+
+    return {'frame': measure(run_frame, count, len(data)),
+            'parse': measure(run_parse, count, len(data))}
+
+
+def bench_type(clazz, raws):
+    """Payload parse, encode and round trip of a batch of packets of a type"""
+    parse = clazz.PAYLOAD.parse
+    views = [memoryview(raw)[Packet.HEADER_SIZE:] for raw in raws]
+    payloads = [parse(view) for view in views]
+    nbytes = sum(len(raw) for raw in raws)
+
+    def run_parse():
+        for view in views:
+            parse(view)
+
+    def run_encode():
+        for payload in payloads:
+            payload.encode()
+
+    def run_roundtrip():
+        for raw in raws:
+            Packet.parse(raw).payload.encode()
+
+    name = clazz.__name__
+    return {f'{name}.parse': measure(run_parse, len(raws), nbytes),
+            f'{name}.encode': measure(run_encode, len(raws), nbytes),
+            f'{name}.roundtrip': measure(run_roundtrip, len(raws), nbytes)}
+
+
+def main(argv):
+    count, baseline_path, threshold, save = 100000, BASELINE, THRESHOLD, False
+    args = iter(argv)
+    for arg in args:
+        if arg == '--packets':
+            count = int(next(args))
+        elif arg == '--baseline':
+            baseline_path = next(args)
+        elif arg == '--threshold':
+            threshold = float(next(args))
+        elif arg == '--save':
+            save = True
+        else:
+            print(__doc__)
+            return 1
+
+    # same stream on every run
+    rng = random.Random(0x5041)
+    pools, weights = packet_pools(rng)
+    data = stream(pools, weights, count, rng)
+    assert len(frame(data)[0]) == count, "synthetic stream misframed"
+    results = bench_stream(data, count)
+    batch = max(count // 20, 100)
+    for pkt_type, clazz in PacketRegistry.TYPE_TO_CLASS.items():
+        results.update(bench_type(clazz, [rng.choice(pools[pkt_type]) for _ in range(batch)]))
+
+    baseline = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as baseline_file:
+            baseline = json.load(baseline_file)
+    regressions = 0
+    print(f"{'benchmark':<32} {'packets/s':>12} {'MB/s':>8} {'baseline':>9}")
+    for name, (pkts, mbytes) in results.items():
+        delta = ''
+        if name in baseline:
+            ratio = pkts / baseline[name]['packets/s'] - 1
+            delta = f"{100 * ratio:+.0f}%"
+            if ratio < -threshold:
+                delta += ' REGRESSION'
+                regressions += 1
+        print(f"{name:<32} {pkts:>12.0f} {mbytes:>8.1f} {delta:>9}")
+
+    if save:
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump({name: {'packets/s': pkts, 'MB/s': mbytes} for name, (pkts, mbytes) in results.items()},
+                      baseline_file, indent=1)
+        print(f"Baseline saved to {baseline_path}")
+    return 1 if regressions and not save else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+Benchmark of the proxy end to end, on loopback, to size how many sessions a proxy host can carry.
+
+A stand-in game server echoes everything it receives, scripted clients connect to the proxy
+(sessions spread over the ports of proxy.PORTS, several per port beyond 7) and send a synthetic stream of packets (see bench_parser.py).
+The proxy runs in its own process so its CPU time is measured alone.
+For each mode:
+    latency     round trip client -> proxy -> server -> proxy -> client of a small batch of packets,
+                p50 / p99, and what the proxy adds to the direct round trip
+    throughput  the stream sent at once, echoed, in MB/s and packets/s (all sessions)
+    cpu         CPU time of the proxy per session and per packet relayed
+
+Modes:
+    direct          no proxy, the reference
+    forward         the data is only forwarded (--no-parse), with os.splice on Linux
+    forward-copy    the data is only forwarded, copied by Python (--no-parse --no-splice)
+    print           parsed and printed to the console by the relays (redirected to /dev/null)
+    parse           parsed and logged to the console by the log writer thread (redirected to /dev/null)
+    filter          as parse, with the Blacklist filter: its types are skipped by the framing
+    log             parsed and logged to a binary log compressed with zlib (a temporary file)
+    gui             parsed and written to the shared memory ring of the GUI (no GUI attached)
+    forward-first   forwarded then parsed by the pipeline (--forward-first)
+    asyncio         parsed, every session on one event loop (--asyncio)
+
+Usage: python3 bench_proxy.py [--sessions N] [--packets N] [--rounds N] [--batch N]
+                              [--types 0x7073,0x6d76] [--preconnect N] [mode...]
+"""
+
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+from threading import Thread
+from bench_parser import packet_pools, stream
+
+HOST = '127.0.0.1'
+# the stand-in server listens on port + PORT_OFFSET
+PORT_OFFSET = 10000
+CHUNK = 4096
+
+MODES = {
+    'direct': None,
+    'forward': {'parse': False},
+    'forward-copy': {'parse': False, 'splice': False},
+    'print': {'log': None},
+    'parse': {'log': 'text'},
+    'filter': {'log': 'text', 'filter': 'Blacklist'},
+    'log': {'log': 'binary'},
+    'gui': {'ring': True},
+    'forward-first': {'pipeline': 'drop-oldest'},
+    'asyncio': {'asyncio': True},
+}
+
+
+def run_proxy(options, ports, conn):
+    """Proxy process: start the proxy, answer the CPU time it used until 'stop'"""
+    sys.stdout = open(os.devnull, 'w')
+    import proxy
+    from pipeline import ParsePipeline
+    proxy.PARSE = options.get('parse', True)
+    proxy.SPLICE = options.get('splice', proxy.SPLICE)
+    proxy.FILTER = options.get('filter')
+    # every session in the mode measured, 3333 included
+    proxy.PASSTHROUGH_PORTS.clear()
+    if options.get('ring'):
+        from shm_ring import RingWriter
+        proxy.RING = RingWriter(name=f'pwn3_bench_{os.getpid()}')
+    log_path = None
+    if options.get('log'):
+        from log_writer import LogWriter
+        if options['log'] == 'binary':
+            log_path = os.path.join(tempfile.gettempdir(), f'pwn3_bench_{os.getpid()}.log')
+            proxy.LOG = LogWriter(log_path, fmt='binary', compress='zlib')
+        else:
+            proxy.LOG = LogWriter(fmt=options['log'])
+    if options.get('pipeline'):
+        proxy.PIPELINE = ParsePipeline(proxy.display, policy=options['pipeline'])
+    proxy.start(HOST, ports, listen=HOST, use_asyncio=options.get('asyncio', False), port_offset=PORT_OFFSET,
+                preconnect=options.get('preconnect', 0))
+    while conn.recv() != 'stop':
+        conn.send(time.process_time())
+    if proxy.RING is not None:
+        proxy.RING.close()
+    if proxy.LOG is not None:
+        proxy.LOG.close()
+        if log_path is not None:
+            os.remove(proxy.LOG.path)
+
+
+def echo(sock):
+    with sock:
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            sock.sendall(data)
+
+
+def echo_server(port):
+    """Stand-in game server: echo every session"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((HOST, port))
+    listener.listen(128)
+
+    def accept():
+        while True:
+            sock, _addr = listener.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Thread(target=echo, args=(sock,), daemon=True).start()
+    Thread(target=accept, daemon=True).start()
+
+
+def connect(port, timeout=5.0):
+    """Connect to the proxy, waiting for it to listen"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            sock = socket.create_connection((HOST, port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return sock
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def receive(sock, size, buffer):
+    while size > 0:
+        received = sock.recv_into(buffer, min(size, len(buffer)))
+        if not received:
+            raise ConnectionError("session closed")
+        size -= received
+
+
+class Session(Thread):
+    """
+    Scripted client: round trips of ping, then data sent at once
+
+    Attributes
+    ----------
+    rtts : list of float
+        round trip times in seconds
+    elapsed : float
+        time to send and receive back data
+    """
+
+    def __init__(self, sock, ping, rounds, data) -> None:
+        super().__init__()
+        self.sock = sock
+        self.ping = ping
+        self.rounds = rounds
+        self.data = data
+        self.rtts = []
+        self.elapsed = None
+        self.error = None
+
+    def run(self):
+        buffer = bytearray(65536)
+        try:
+            for _ in range(self.rounds):
+                start = time.perf_counter()
+                self.sock.sendall(self.ping)
+                receive(self.sock, len(self.ping), buffer)
+                self.rtts.append(time.perf_counter() - start)
+            start = time.perf_counter()
+            sender = Thread(target=self.send, daemon=True)
+            sender.start()
+            receive(self.sock, len(self.data), buffer)
+            self.elapsed = time.perf_counter() - start
+        except OSError as err:
+            self.error = err
+
+    def send(self):
+        view = memoryview(self.data)
+        for i in range(0, len(view), CHUNK):
+            self.sock.sendall(view[i:i + CHUNK])
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+def run_mode(name, ports, session_ports, ping, rounds, data, preconnect=0):
+    """Run the sessions (one per port of session_ports) through the proxy in a mode, return the measures"""
+    options = MODES[name]
+    proc = None
+    if options is not None:
+        options = dict(options, preconnect=preconnect)
+        conn, child_conn = multiprocessing.Pipe()
+        proc = multiprocessing.get_context('spawn').Process(target=run_proxy, args=(options, ports, child_conn), daemon=True)
+        proc.start()
+        targets = session_ports
+    else:
+        targets = [port + PORT_OFFSET for port in session_ports]
+    socks = [connect(port, timeout=15.0) for port in targets]
+    if proc is not None:
+        conn.send('cpu')
+        cpu = conn.recv()
+    wall = time.perf_counter()
+    sessions = [Session(sock, ping, rounds, data) for sock in socks]
+    for session in sessions:
+        session.start()
+    for session in sessions:
+        session.join()
+    wall = time.perf_counter() - wall
+    if proc is not None:
+        conn.send('cpu')
+        cpu = conn.recv() - cpu
+        conn.send('stop')
+        proc.join(1)
+        if proc.is_alive():
+            proc.terminate()
+            proc.join()
+    # closed once the proxy is gone: nothing is left to relay
+    for sock in socks:
+        sock.close()
+    for session in sessions:
+        if session.error is not None:
+            raise session.error
+    rtts = [rtt for session in sessions for rtt in session.rtts]
+    elapsed = max(session.elapsed for session in sessions)
+    results = {
+        'p50': percentile(rtts, 0.5), 'p99': percentile(rtts, 0.99),
+        'MB/s': len(data) * len(sessions) / elapsed / 1e6,
+    }
+    if proc is not None:
+        results['cpu'] = cpu
+        results['cpu%'] = 100 * cpu / wall
+    return results
+
+
+def main(argv):
+    sessions, count, rounds, batch, types, preconnect, modes = 1, 50000, 2000, 4, None, 0, []
+    args = iter(argv)
+    for arg in args:
+        if arg == '--sessions':
+            sessions = int(next(args))
+        elif arg == '--packets':
+            count = int(next(args))
+        elif arg == '--rounds':
+            rounds = int(next(args))
+        elif arg == '--batch':
+            batch = int(next(args))
+        elif arg == '--types':
+            types = [int(pkt_type, 16) for pkt_type in next(args).split(',')]
+        elif arg == '--preconnect':
+            preconnect = int(next(args))
+        elif arg in MODES:
+            modes.append(arg)
+        else:
+            print(__doc__)
+            return 1
+    modes = modes or list(MODES)
+    if 'direct' not in modes:
+        modes.insert(0, 'direct')
+    import proxy
+    ports = proxy.PORTS[:sessions]
+    # beyond one per port, the ports get several sessions each
+    session_ports = [ports[k % len(ports)] for k in range(sessions)]
+
+    rng = random.Random(0x5041)
+    pools, weights = packet_pools(rng)
+    if types is not None:
+        weights = {pkt_type: weights[pkt_type] for pkt_type in types}
+    ping = stream(pools, weights, batch, rng)
+    data = stream(pools, weights, count, rng)
+    # packets relayed by the proxy per session, both ways
+    relayed = 2 * (batch * rounds + count)
+
+    for port in ports:
+        echo_server(port + PORT_OFFSET)
+
+    print(f"{sessions} session(s), {rounds} round trips of {batch} packets, then {count} packets ({len(data)} bytes)")
+    print(f"{'mode':<14} {'p50 µs':>8} {'p99 µs':>8} {'+p50 µs':>8} {'+p99 µs':>8} {'MB/s':>7} {'kpkt/s':>7}"
+          f" {'cpu ms/session':>15} {'cpu µs/pkt':>11} {'cpu %':>6}")
+    direct = None
+    for name in modes:
+        results = run_mode(name, ports, session_ports, ping, rounds, data, preconnect)
+        if direct is None:
+            direct = results
+        line = (f"{name:<14} {1e6 * results['p50']:>8.0f} {1e6 * results['p99']:>8.0f}"
+                f" {1e6 * (results['p50'] - direct['p50']):>8.0f} {1e6 * (results['p99'] - direct['p99']):>8.0f}"
+                f" {results['MB/s']:>7.1f} {results['MB/s'] * 1e3 * count / len(data):>7.0f}")
+        if 'cpu' in results:
+            line += (f" {1e3 * results['cpu'] / sessions:>15.0f} {1e6 * results['cpu'] / (relayed * sessions):>11.1f}"
+                     f" {results['cpu%']:>6.0f}")
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to record the sessions of the proxy in a binary capture file, for offline analysis
+
+Capture file (.pa3cap): magic, then one record per chunk received
+    record header: timestamp (f64), stream (u32), port (u16), direction (u8), length (u32)
+    record data: the raw bytes of the chunk
+    a record without data is a gap: chunks of the stream were dropped, no packet spans it and
+    the next record is indexed from the first offset where packets of known types follow
+Index file (.pa3cap.idx): magic, then one entry per packet
+    record offset (u64), offset in the record data (u32), size (u32), type (u16), flags (u8), pad (u8)
+    a packet split across chunks has the SPLIT flag: its end is in the next records of its stream
+
+Entries have a fixed size so the index is read with mmap: any packet of a long capture is
+found without reading the whole file.
+"""
+
+import mmap
+import os
+import queue
+import sys
+import time
+from struct import Struct
+from threading import Lock, Thread
+from hot_reload import PARSER
+
+CAPTURE_MAGIC = b'PA3CAP\x00\x01'
+INDEX_MAGIC = b'PA3IDX\x00\x01'
+RECORD = Struct('<dIHBI')
+ENTRY = Struct('<QIIHBx')
+SPLIT = 1
+DIRECTIONS = ('client', 'server')
+# bytes of a record searched for a packet boundary after a gap
+MAX_RESYNC = 1024
+
+
+def _boundary(parser, view):
+    """
+    First offset of view from which it is made of packets of known types, the last one
+    possibly cut by the end of view. None if there is none.
+    """
+    for start in range(min(len(view), MAX_RESYNC)):
+        pos, count = start, 0
+        while len(view) - pos >= parser.Packet.HEADER_SIZE:
+            pkt_type = int.from_bytes(view[pos:pos + 2], 'big')
+            if parser.PacketRegistry.get(pkt_type) is None and pkt_type not in parser.LENGTHS.rules:
+                break
+            try:
+                pos += parser.Packet.length(view[pos:])
+            except parser.IncompletePacket:
+                # the last packet, continued in the next record
+                pos = len(view)
+                break
+            count += 1
+        if count and len(view) - pos < parser.Packet.HEADER_SIZE:
+            return start
+    return None
+
+
+class _Indexer:
+    """
+    Cut the records of each stream into packets and write their index entries
+
+    Parameters
+    ----------
+    index : file
+        index file opened for writing, after its magic
+    """
+
+    def __init__(self, index) -> None:
+        self.index = index
+        # stream -> (bytes of the incomplete packet, record offset, offset in the record)
+        self.pending = {}
+        # streams after a gap, until a packet boundary is found
+        self.lost = set()
+
+    def add(self, record_offset, stream, data):
+        """Index the packets starting in a record"""
+        Packet = PARSER.get().Packet
+        tail, tail_record, tail_offset = self.pending.pop(stream, (b'', 0, 0))
+        if not data:
+            # gap: the incomplete packet can not be completed, framing starts again after it
+            self.lost.add(stream)
+            return
+        joined = memoryview(tail + data) if tail else memoryview(data)
+        pos = 0
+        if stream in self.lost:
+            pos = _boundary(PARSER.get(), joined)
+            if pos is None:
+                return
+            self.lost.discard(stream)
+        while pos < len(joined):
+            try:
+                size = Packet.length(joined[pos:])
+            except PARSER.get().IncompletePacket:
+                break
+            pkt_type = int.from_bytes(joined[pos:pos + 2], 'big')
+            if pos < len(tail):
+                # started in a previous record of the stream
+                entry = ENTRY.pack(tail_record, tail_offset + pos, size, pkt_type, SPLIT)
+            else:
+                entry = ENTRY.pack(record_offset, pos - len(tail), size, pkt_type, 0)
+            self.index.write(entry)
+            pos += size
+        if pos < len(joined):
+            if pos < len(tail):
+                self.pending[stream] = (bytes(joined[pos:]), tail_record, tail_offset + pos)
+            else:
+                self.pending[stream] = (bytes(joined[pos:]), record_offset, pos - len(tail))
+
+
+class CaptureWriter:
+    """
+    Append-only capture of the chunks relayed by the proxy
+
+    record() only queues the chunk: a background thread writes the capture and its index,
+    so the relays never wait for the disk. When the queue is full, chunks are dropped and counted.
+
+    Parameters
+    ----------
+    path : str
+        capture file, the index is path + '.idx'
+    maxsize : int
+        number of chunks the queue can hold
+
+    Attributes
+    ----------
+    dropped : int
+        number of chunks not recorded because the queue was full
+    """
+
+    def __init__(self, path, maxsize=0x10000) -> None:
+        self.path = path
+        self.dropped = 0
+        self.chunks = queue.Queue(maxsize)
+        # stream object of the relay -> [stream number in the capture, gap], until it is closed.
+        # Keyed by the object, not its id: an id can be reused once the stream is freed
+        self.streams = {}
+        self.count = 0
+        # the relays of every session add streams
+        self.lock = Lock()
+        self.thread = Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def record(self, data, port, conn_dir, stream):
+        """Queue a chunk of a stream (any object identifying one direction of a session)"""
+        state = self.streams.get(stream)
+        if state is None:
+            with self.lock:
+                # [number, a chunk was dropped since the last one queued]
+                state = self.streams[stream] = [self.count, False]
+                self.count += 1
+        number, direction = state[0], DIRECTIONS.index(conn_dir)
+        try:
+            if state[1]:
+                self.chunks.put_nowait((time.time(), number, port, direction, b''))
+                state[1] = False
+            self.chunks.put_nowait((time.time(), number, port, direction, data))
+        except queue.Full:
+            state[1] = True
+            with self.lock:
+                self.dropped += 1
+
+    def close_stream(self, stream):
+        """The connection of a stream is closed: forget it"""
+        with self.lock:
+            state = self.streams.pop(stream, None)
+        if state is not None:
+            try:
+                # the writer forgets the incomplete packet of the stream
+                self.chunks.put_nowait((time.time(), state[0], 0, 0, None))
+            except queue.Full:
+                pass
+
+    def close(self):
+        """Write what is queued and close the files"""
+        self.chunks.put(None)
+        self.thread.join()
+
+    def _write(self):
+        """Writer main loop"""
+        with open(self.path, 'wb', buffering=1 << 20) as capture, \
+             open(self.path + '.idx', 'wb', buffering=1 << 16) as index:
+            capture.write(CAPTURE_MAGIC)
+            index.write(INDEX_MAGIC)
+            indexer = _Indexer(index)
+            while True:
+                item = self.chunks.get()
+                if item is None:
+                    break
+                timestamp, stream, port, direction, data = item
+                if data is None:
+                    indexer.pending.pop(stream, None)
+                    indexer.lost.discard(stream)
+                    continue
+                record_offset = capture.tell()
+                capture.write(RECORD.pack(timestamp, stream, port, direction, len(data)))
+                capture.write(data)
+                indexer.add(record_offset, stream, data)
+                if self.chunks.empty():
+                    # idle: make the capture readable by offline tools
+                    capture.flush()
+                    index.flush()
+
+
+def _index_records(reader, indexer):
+    for record_offset, _timestamp, stream, _port, _conn_dir, data in reader.records():
+        indexer.add(record_offset, stream, data)
+
+
+def build_index(path):
+    """Rebuild the index of a capture, ex: after new packet types were reversed"""
+    with open(path + '.idx', 'wb') as index:
+        index.write(INDEX_MAGIC)
+        reader = CaptureReader(path, index=False)
+        # in a function: no view on the mapping is left when it is closed
+        _index_records(reader, _Indexer(index))
+        reader.close()
+
+
+class CaptureReader:
+    """
+    Read a capture through mmap
+
+    Parameters
+    ----------
+    path : str
+        capture file
+    index : bool
+        map the index too, built first if it does not exist
+    """
+
+    def __init__(self, path, index=True) -> None:
+        self.path = path
+        if index and not os.path.exists(path + '.idx'):
+            build_index(path)
+        with open(path, 'rb') as capture:
+            self.data = mmap.mmap(capture.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a capture")
+        self.index = None
+        if index:
+            with open(path + '.idx', 'rb') as index_file:
+                self.index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        self.data.close()
+        if self.index is not None:
+            self.index.close()
+
+    def record(self, record_offset):
+        """Return (timestamp, stream, port, conn_dir, data) of the record at record_offset"""
+        timestamp, stream, port, direction, length = RECORD.unpack_from(self.data, record_offset)
+        start = record_offset + RECORD.size
+        return timestamp, stream, port, DIRECTIONS[direction], memoryview(self.data)[start:start + length]
+
+    def records(self):
+        """Iterate over the records: (record offset, timestamp, stream, port, conn_dir, data)"""
+        offset = len(CAPTURE_MAGIC)
+        end = len(self.data)
+        while offset + RECORD.size <= end:
+            record = self.record(offset)
+            # record being written
+            if offset + RECORD.size + len(record[4]) > end:
+                break
+            yield (offset,) + record
+            offset += RECORD.size + len(record[4])
+
+    def __len__(self):
+        """Number of packets indexed"""
+        return (len(self.index) - len(INDEX_MAGIC)) // ENTRY.size
+
+    def entry(self, i):
+        """Return (record offset, offset in the record, size, type, flags) of the packet i"""
+        return ENTRY.unpack_from(self.index, len(INDEX_MAGIC) + i * ENTRY.size)
+
+    def types(self):
+        """Iterate over the type of every packet, without reading the capture"""
+        for i in range(len(self)):
+            yield self.entry(i)[3]
+
+    def packet(self, i):
+        """Return (timestamp, port, conn_dir, type, raw bytes) of the packet i"""
+        record_offset, offset, size, pkt_type, flags = self.entry(i)
+        timestamp, stream, port, conn_dir, data = self.record(record_offset)
+        if not flags & SPLIT:
+            return timestamp, port, conn_dir, pkt_type, data[offset:offset + size]
+        # the end of the packet is in the next records of the stream
+        raw = bytearray(data[offset:])
+        next_offset = record_offset + RECORD.size + len(data)
+        while len(raw) < size and next_offset + RECORD.size <= len(self.data):
+            _, next_stream, _, _, next_data = self.record(next_offset)
+            if next_stream == stream:
+                raw += next_data[:size - len(raw)]
+            next_offset += RECORD.size + len(next_data)
+        return timestamp, port, conn_dir, pkt_type, bytes(raw)
+
+
+if __name__ == "__main__":
+    # python3 capture.py <capture> [first packet] [count]: list packets of a capture
+    if len(sys.argv) < 2:
+        print(f"Usage: python3 {sys.argv[0]} <capture> [first] [count]")
+        sys.exit(1)
+    reader = CaptureReader(sys.argv[1])
+    first = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    Packet = PARSER.get().Packet
+    print(f"{len(reader)} packets")
+    for i in range(first, min(first + count, len(reader))):
+        timestamp, port, conn_dir, _, raw = reader.packet(i)
+        print(f"{i} {time.strftime('%H:%M:%S', time.localtime(timestamp))} [{port}][{conn_dir}] {Packet.parse(raw)}")
+    reader.close()
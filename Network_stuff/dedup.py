@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to fold the runs of identical packets before they are displayed or logged:
+a player standing still sends the same Position packet again and again, and the Beacon
+keepalives repeat constantly.
+
+The first packet of a run goes to the sink as usual. The next ones, the same frame byte for
+byte, of the same type, in the same stream (one direction of a session), are only counted:
+the sink gets one record for them, sink(pkt, conn_dir, repeat) with the number of packets
+folded, when a different frame of the type ends the run, every INTERVAL seconds while it
+goes on, and when the connection is closed. Packets of other types in between do not end a run.
+Live, a timer thread flushes the runs even when no packet comes anymore; offline (replay.py),
+the times of the packets drive the flushes.
+This module is not hot reloaded with the parser.
+"""
+
+import time
+from threading import Lock, Thread
+
+# seconds between two records of a run which goes on
+INTERVAL = 1.0
+# seconds without packet after which a stream is forgotten
+IDLE = 60.0
+
+
+class _Run:
+    """Last frame of a type in a stream, and the copies of it not handed to the sink yet"""
+    __slots__ = ('clazz', 'header', 'raw', 'count', 'since')
+
+    def __init__(self, pkt, raw, now):
+        self.start(pkt, raw, now)
+
+    def start(self, pkt, raw, now):
+        """A new frame of the type"""
+        self.clazz = type(pkt)
+        self.header = pkt.header
+        # copied: the packet keeps a view on the whole chunk
+        self.raw = bytes(raw)
+        self.count = 0
+        self.since = now
+
+    def packet(self):
+        return self.clazz(self.header, raw=self.raw)
+
+
+class _Stream:
+    __slots__ = ('runs', 'sink', 'conn_dir', 'seen', 'swept', 'lock')
+
+    def __init__(self, now):
+        # type -> _Run
+        self.runs = {}
+        self.sink = None
+        self.conn_dir = None
+        self.seen = now
+        self.swept = now
+        # the relay of the stream and the timer flush its runs
+        self.lock = Lock()
+
+
+class RunFolder:
+    """
+    Fold the consecutive identical frames of each type and stream into one record
+
+    Parameters
+    ----------
+    interval : float
+        seconds between two records of a run which goes on
+    idle : float
+        seconds without packet after which a stream is forgotten, its runs are flushed
+
+    Attributes
+    ----------
+    enabled : bool
+        when unset, sink() hands the packets straight to the sink
+    folded : int
+        packets not handed to the sinks one by one
+    streams : dict
+        stream -> runs of its types
+    timer : Thread
+        flushes the runs every interval seconds, started by sink()
+    """
+
+    def __init__(self, interval=INTERVAL, idle=IDLE) -> None:
+        self.enabled = True
+        self.interval = interval
+        self.idle = idle
+        self.folded = 0
+        self.streams = {}
+        # the relays of every session add streams, the oldest are removed
+        self.lock = Lock()
+        self.swept = time.monotonic()
+        self.timer = None
+
+    def sink(self, sink, stream):
+        """packet_sink of parse() for the packets of stream, they go through the folder to sink"""
+        if not self.enabled:
+            return sink
+        if self.timer is None:
+            self.start()
+        return lambda pkt, conn_dir: self.packet(pkt, conn_dir, stream, sink)
+
+    def start(self):
+        """Start the timer thread, which flushes the runs every interval seconds (live use)"""
+        with self.lock:
+            if self.timer is not None:
+                return
+            self.timer = Thread(target=self._tick, daemon=True)
+        self.timer.start()
+
+    def _tick(self):
+        while True:
+            time.sleep(self.interval)
+            now = time.monotonic()
+            with self.lock:
+                states = list(self.streams.values())
+            for state in states:
+                with state.lock:
+                    state.swept = now
+                    self._flush(state, now - self.interval)
+            if now - self.swept >= self.idle:
+                self._forget(now)
+
+    def packet(self, pkt, conn_dir, stream, sink, now=None):
+        """
+        Hand pkt to sink(pkt, conn_dir) unless it repeats the last frame of its type in stream.
+        stream is any hashable object for one direction of a session, now a time in seconds
+        (time.monotonic() by default).
+        """
+        if now is None:
+            now = time.monotonic()
+        state = self.streams.get(stream)
+        if state is None:
+            with self.lock:
+                state = self.streams.setdefault(stream, _Stream(now))
+        raw = pkt.raw if pkt.raw is not None else pkt.encode()
+        with state.lock:
+            state.sink = sink
+            state.conn_dir = conn_dir
+            state.seen = now
+            run = state.runs.get(pkt.header.type)
+            if run is not None and raw == run.raw:
+                run.count += 1
+                self.folded += 1
+            elif run is None:
+                state.runs[pkt.header.type] = _Run(pkt, raw, now)
+                sink(pkt, conn_dir)
+            else:
+                if run.count:
+                    sink(run.packet(), conn_dir, run.count)
+                run.start(pkt, raw, now)
+                sink(pkt, conn_dir)
+            if now - state.swept >= self.interval:
+                state.swept = now
+                self._flush(state, now - self.interval)
+        if now - self.swept >= self.idle:
+            self._forget(now)
+
+    def _flush(self, state, before=None):
+        """Hand the copies counted to the sink, for the runs started before a time, state.lock held"""
+        for run in state.runs.values():
+            if run.count and (before is None or run.since <= before):
+                state.sink(run.packet(), state.conn_dir, run.count)
+                run.count = 0
+                run.since = state.seen
+
+    def _forget(self, now):
+        with self.lock:
+            self.swept = now
+            idle = [stream for stream, state in self.streams.items() if now - state.seen >= self.idle]
+            states = [self.streams.pop(stream) for stream in idle]
+        for state in states:
+            with state.lock:
+                self._flush(state)
+
+    def close(self, stream):
+        """The connection of stream is closed: hand its copies counted to the sink and forget it"""
+        with self.lock:
+            state = self.streams.pop(stream, None)
+        if state is not None:
+            with state.lock:
+                self._flush(state)
+
+    def flush(self):
+        """Hand every copy counted to the sinks, ex: before the logs are closed"""
+        with self.lock:
+            states = list(self.streams.values())
+        for state in states:
+            with state.lock:
+                self._flush(state)
+
+
+FOLDER = RunFolder()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to learn the length of the packets of unknown types, so that an unknown
+packet does not swallow the rest of the buffer and the packets after it are still decoded.
+
+An unknown packet is read up to the end of the buffer. The packets after it are found by
+looking for the first offset from which the rest of the buffer is made of whole packets of
+known types: this is one sample of the length of its payload. When MIN_SAMPLES samples of a
+type agree, a rule is learned:
+    fixed       every payload has the same size
+    prefixed    the size is a little-endian u16 of the payload (the length of a string) plus a constant
+The rules are saved in frame_lengths.json (next to this file) and loaded at start, they can
+be edited or removed there. A rule after which the next packet is not of a known type
+MAX_FAILURES times in a row is dropped, and learned again. A type whose length is not
+learned after MAX_ATTEMPTS searches is given up: the relays stop searching it.
+This module is not hot reloaded with the parser.
+"""
+
+import os
+from struct import unpack_from
+from threading import Lock
+from metrics import METRICS
+
+TABLE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'frame_lengths.json')
+# samples agreeing before a rule is learned
+MIN_SAMPLES = 3
+# samples kept per type while no rule explains them
+MAX_SAMPLES = 32
+# bytes of the payload kept per sample: the u16 of a prefixed rule is read in them
+SAMPLE_PREFIX = 64
+# longest payload searched for the start of the next packet
+MAX_SCAN = 1024
+# packets in a row not followed by a known type before a rule is dropped
+MAX_FAILURES = 3
+# searches of the length of a type without rule before it is given up, until it is forgotten
+MAX_ATTEMPTS = 64
+
+
+class LengthRule:
+    """
+    Length of the payloads of a type
+
+    Attributes
+    ----------
+    offset : int
+        offset in the payload of the u16 giving its length, None for a fixed size
+    extra : int
+        size of the payload (fixed) or what is added to the u16 (prefixed)
+    """
+    __slots__ = ('offset', 'extra')
+
+    def __init__(self, offset, extra):
+        self.offset = offset
+        self.extra = extra
+
+    def length(self, payload):
+        """Size of the payload at the start of payload, struct.error if it is too short to tell"""
+        if self.offset is None:
+            return self.extra
+        return self.extra + unpack_from('<H', payload, self.offset)[0]
+
+    def __str__(self) -> str:
+        if self.offset is None:
+            return f"fixed {self.extra} bytes"
+        return f"u16 at {self.offset} + {self.extra} bytes"
+
+
+def infer(samples):
+    """Rule explaining every (payload prefix, length) sample, None if there is none"""
+    lengths = {size for _prefix, size in samples}
+    if len(lengths) == 1:
+        return LengthRule(None, lengths.pop())
+    shortest = min(min(len(prefix), size) for prefix, size in samples)
+    for offset in range(shortest - 1):
+        extras = {size - unpack_from('<H', prefix, offset)[0] for prefix, size in samples}
+        if len(extras) == 1:
+            return LengthRule(offset, extras.pop())
+    return None
+
+
+class LengthTable:
+    """
+    Rules learned for the unknown types, and the samples of the types still learned
+
+    Parameters
+    ----------
+    path : str
+        JSON file of the rules, None to keep them in memory only
+
+    Attributes
+    ----------
+    learning : bool
+        when unset, the rules are used but no sample is taken and the file is not written
+    rules : dict
+        type -> LengthRule
+    samples : dict
+        type -> list of (payload prefix, payload length)
+    failures : dict
+        type -> packets in a row framed by its rule and not followed by a known type
+    attempts : dict
+        type -> searches of its length since it has no rule
+    """
+
+    def __init__(self, path=TABLE) -> None:
+        self.path = path
+        self.learning = True
+        self.rules = {}
+        self.samples = {}
+        self.failures = {}
+        self.attempts = {}
+        # the relays of every session learn
+        self.lock = Lock()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def length(self, pkt_type, payload):
+        """Size of the payload of an unknown packet, None when its type has no rule"""
+        rule = self.rules.get(pkt_type)
+        if rule is None:
+            return None
+        return rule.length(payload)
+
+    def learn(self, pkt_type, payload, whole):
+        """
+        Add a sample from an unknown packet running to the end of the buffer.
+        whole(view) tells if view is made of whole packets of known types.
+        Return True when a rule was learned for the type.
+        """
+        if not self.learning or pkt_type in self.rules:
+            return False
+        with self.lock:
+            attempts = self.attempts.get(pkt_type, 0)
+            if attempts >= MAX_ATTEMPTS:
+                return False
+            self.attempts[pkt_type] = attempts + 1
+        # the smallest size after which the rest of the buffer is packets: the packet running
+        # to the end of the buffer tells nothing about its length
+        end = len(payload)
+        for size in range(min(end - 1, MAX_SCAN) + 1):
+            if whole(payload[size:]):
+                break
+        else:
+            # no packet after it, or it may start beyond the search
+            return False
+        with self.lock:
+            samples = self.samples.setdefault(pkt_type, [])
+            samples.append((bytes(payload[:SAMPLE_PREFIX]), size))
+            if len(samples) > MAX_SAMPLES:
+                del samples[0]
+            if len(samples) < MIN_SAMPLES:
+                return False
+            rule = infer(samples)
+            if rule is None:
+                return False
+            rules = dict(self.rules)
+            rules[pkt_type] = rule
+            # replaced at once: the framers read it without lock
+            self.rules = rules
+            del self.samples[pkt_type]
+            self.attempts.pop(pkt_type, None)
+            self.save()
+        print(f"[lengths] 0x{pkt_type:04x}: {rule} learned from {len(samples)} packets")
+        METRICS.add('lengths learned')
+        return True
+
+    def check(self, pkt_type, resynced):
+        """
+        Record if a packet framed by the rule of its type is followed by a packet of a known type.
+        Return False when the rule was dropped: the packet has to be framed again.
+        """
+        with self.lock:
+            if resynced:
+                self.failures.pop(pkt_type, None)
+                return True
+            failures = self.failures.get(pkt_type, 0) + 1
+            self.failures[pkt_type] = failures
+        if failures < MAX_FAILURES or pkt_type not in self.rules:
+            return True
+        print(f"[lengths] 0x{pkt_type:04x}: {self.rules[pkt_type]} dropped, {failures} packets not followed by a known type")
+        METRICS.add('lengths dropped')
+        self.forget(pkt_type)
+        return False
+
+    def forget(self, pkt_type):
+        """Remove the rule of a type, it is learned again"""
+        with self.lock:
+            rules = dict(self.rules)
+            rules.pop(pkt_type, None)
+            self.rules = rules
+            self.failures.pop(pkt_type, None)
+            self.attempts.pop(pkt_type, None)
+            self.save()
+
+    def load(self):
+        # imported here: without a table the proxy starts without json
+        import json
+        try:
+            with open(self.path) as table:
+                rules = {int(pkt_type, 16): LengthRule(rule['offset'], rule['extra'])
+                         for pkt_type, rule in json.load(table).items()}
+        except (OSError, ValueError, KeyError, TypeError) as err:
+            print(f"[lengths] {self.path} not loaded: {err}")
+            return
+        self.rules = rules
+
+    def save(self):
+        import json
+        if self.path is None or not self.learning:
+            return
+        table = {f"0x{pkt_type:04x}": {'offset': rule.offset, 'extra': rule.extra}
+                 for pkt_type, rule in sorted(self.rules.items())}
+        # written aside then renamed: a crash does not leave half a table
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as table_file:
+                json.dump(table, table_file, indent=1)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            print(f"[lengths] {self.path} not saved: {err}")
+
+    def report(self):
+        """Text table of the rules"""
+        lines = [f"0x{pkt_type:04x} {rule}" for pkt_type, rule in sorted(self.rules.items())]
+        lines += [f"0x{pkt_type:04x} learning ({len(samples)} samples)" for pkt_type, samples in sorted(self.samples.items())
+                  if self.attempts.get(pkt_type, 0) < MAX_ATTEMPTS]
+        lines += [f"0x{pkt_type:04x} given up after {attempts} searches" for pkt_type, attempts in sorted(self.attempts.items())
+                  if attempts >= MAX_ATTEMPTS]
+        return '\n'.join(lines)
+
+
+LENGTHS = LengthTable()
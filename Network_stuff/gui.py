@@ -5,12 +5,165 @@
 Authors: Dvorhack & K8pl3r
 
 GUI for cheet tools
+
+It runs in its own process and reads the packets parsed by the proxy from a shared memory ring
+(see shm_ring.py): start the proxy with --gui, or with --ring and then python3 gui.py.
+Closing the window detaches the GUI, the proxy goes on.
 """
 
+import sys
+import time
+from collections import deque
+from threading import Thread
 from tkinter import *
 import customtkinter
-import importlib
-import Protocol_Parser
+from hot_reload import PARSER
+import shm_ring
+
+class LogSink:
+    """
+    Bounded log between the packet threads and a textbox
+
+    The packet threads append lines to a ring buffer (deque appends are thread safe, no lock
+    against Tk) and a tick of the Tk loop moves them to the textbox by batches, trimming the
+    oldest lines: memory and display cost stay the same however long the session runs.
+    It has the insert / see methods of a text widget, so it can be given to parse().
+
+    Parameters
+    ----------
+    textbox : CTkTextbox
+        textbox displaying the lines
+    capacity : int
+        lines waiting in the ring buffer, the oldest are dropped beyond
+    max_lines : int
+        lines kept in the textbox
+    batch : int
+        lines moved to the textbox per tick
+    interval : int
+        ms between two ticks
+
+    Attributes
+    ----------
+    dropped : int
+        lines dropped because the ring buffer was full
+    """
+    def __init__(self, textbox, capacity=10000, max_lines=5000, batch=500, interval=50):
+        self.textbox = textbox
+        self.lines = deque(maxlen=capacity)
+        self.max_lines = max_lines
+        self.batch = batch
+        self.interval = interval
+        self.dropped = 0
+        self.reported = 0
+
+    def insert(self, _index, txt):
+        """Queue a line, from any thread: lines are always appended at the end"""
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(txt)
+
+    def see(self, _index):
+        """The textbox scrolls to the end at each flush"""
+
+    def start(self):
+        """Start the ticks, from the Tk thread"""
+        self.textbox.after(self.interval, self._tick)
+
+    def flush(self):
+        """Move a batch of lines to the textbox, from the Tk thread. Return the number of lines moved"""
+        batch = []
+        dropped = self.dropped - self.reported
+        if dropped:
+            self.reported += dropped
+            batch.append(f"[log] {dropped} lines dropped\n")
+        try:
+            for _ in range(self.batch):
+                batch.append(self.lines.popleft())
+        except IndexError:
+            pass
+        if not batch:
+            return 0
+        self.textbox.insert(END, ''.join(batch))
+        lines = int(self.textbox.index("end-1c").split('.')[0])
+        if lines > self.max_lines:
+            self.textbox.delete("1.0", f"{lines - self.max_lines + 1}.0")
+        self.textbox.see(END)
+        return len(batch)
+
+    def _tick(self):
+        self.flush()
+        self.textbox.after(self.interval, self._tick)
+
+class RingFeed(Thread):
+    """
+    Reader of the ring of the proxy: formats the packets for the log, keeps the last metrics
+
+    The packets are filtered and formatted here, with the filter selected in the log frame,
+    so the proxy only copies them to the ring. The thread never reads the widgets: the Tk
+    thread sets filter_name.
+
+    Parameters
+    ----------
+    reader : shm_ring.RingReader
+        ring attached
+    log_frame : LogFrame
+        frame of the log
+    interval : float
+        seconds between two reads when the ring is empty
+
+    Attributes
+    ----------
+    report : str
+        last metrics published by the proxy
+    filter_name : str
+        name of the filter in FILTERS_DICT, None to show every packet
+    """
+    def __init__(self, reader, log_frame, interval=0.02):
+        super().__init__(daemon=True)
+        self.reader = reader
+        self.log_frame = log_frame
+        self.interval = interval
+        self.report = ""
+        self.filter_name = None
+        self.running = True
+
+    def run(self):
+        sink = self.log_frame.sink
+        skipped = 0
+        while self.running:
+            records = self.reader.read()
+            if not records:
+                if self.reader.closed:
+                    sink.insert(END, "[ring] the proxy exited\n")
+                    return
+                time.sleep(self.interval)
+                continue
+            if self.reader.skipped != skipped:
+                sink.insert(END, f"[ring] the GUI fell behind, {self.reader.skipped - skipped} skips ahead\n")
+                skipped = self.reader.skipped
+            parser = PARSER.get()
+            filter_name = self.filter_name
+            pkt_filter = None if filter_name is None else parser.FILTERS_DICT.get(filter_name)
+            for kind, conn_dir, pkt_type, _date, data in records:
+                if kind == shm_ring.PACKET or kind == shm_ring.REPEAT:
+                    repeat = 1
+                    if kind == shm_ring.REPEAT:
+                        repeat = shm_ring.COUNT.unpack_from(data)[0]
+                        data = data[shm_ring.COUNT.size:]
+                    pkt_clazz = parser.PacketRegistry.get(pkt_type) or parser.Packet
+                    pkt = pkt_clazz(parser.PacketHeader(data[:parser.Packet.HEADER_SIZE]), raw=data)
+                    if pkt_filter is None or pkt_filter.match(pkt):
+                        sink.insert(END, f"[{conn_dir}] {pkt} ×{repeat}\n" if repeat != 1 else f"[{conn_dir}] {pkt}\n")
+                elif kind == shm_ring.TEXT:
+                    sink.insert(END, data.decode())
+                elif kind == shm_ring.STATS:
+                    self.report = data.decode()
+
+    def stop(self):
+        """Stop reading and detach from the ring"""
+        self.running = False
+        self.join()
+        self.reader.close()
 
 class LogFrame(customtkinter.CTkFrame):
     """Frame for logs"""
@@ -30,9 +183,12 @@ class LogFrame(customtkinter.CTkFrame):
         # Textbox for displaying logs
         self.textbox = customtkinter.CTkTextbox(master=self)
         self.textbox.grid(row=0, column=0, columnspan=3, padx=10, pady=(20, 0), sticky="nsew")
+        # packet threads write to the sink, never to the textbox
+        self.sink = LogSink(self.textbox)
+        self.sink.start()
 
         # Combobox for defautl filters
-        self.combobox = customtkinter.CTkComboBox(master=self, values=Protocol_Parser.FILTERS)
+        self.combobox = customtkinter.CTkComboBox(master=self, values=PARSER.get().FILTERS)
         self.combobox.grid(row=1, column=0, padx=10, pady=10, sticky="ew")
 
         # Button for filtering
@@ -55,9 +211,9 @@ class LogFrame(customtkinter.CTkFrame):
     
     def active_filter_callback(self):
         """Activate filter callback"""
-        importlib.reload(Protocol_Parser)
-        self.combobox.configure(values=Protocol_Parser.FILTERS)
-        self.combobox.set(Protocol_Parser.FILTERS[0])
+        parser = PARSER.reload()
+        self.combobox.configure(values=parser.FILTERS)
+        self.combobox.set(parser.FILTERS[0])
 
 class CmdInput(customtkinter.CTkFrame):
     """Frame for logs"""
@@ -78,11 +234,39 @@ class CmdInput(customtkinter.CTkFrame):
         """Callback when button pressed"""
         print("insert", self.entry.get() + "\n")
 
+class StatsFrame(customtkinter.CTkFrame):
+    """Frame for the live metrics of the proxy, refreshed every interval ms"""
+    def __init__(self, *args, feed=None, interval=1000, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.feed = feed
+        self.interval = interval
+
+        self.grid_rowconfigure(0, weight=1)
+        self.grid_columnconfigure(0, weight=1)
+
+        self.textbox = customtkinter.CTkTextbox(master=self, font=("Courier", 11), wrap="none")
+        self.textbox.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
+
+        self.after(self.interval, self.refresh)
+
+    def refresh(self):
+        """Show the current metrics"""
+        if self.feed is not None:
+            self.textbox.delete("1.0", END)
+            self.textbox.insert(END, self.feed.report)
+        self.after(self.interval, self.refresh)
+
 class MainWin(customtkinter.CTk):
     """
     Main window
+
+    Parameters
+    ----------
+    reader : shm_ring.RingReader
+        ring of the proxy, None to show nothing
     """
-    def __init__(self):
+    def __init__(self, reader=None):
         super().__init__()
 
         self.geometry("800x600")
@@ -93,12 +277,46 @@ class MainWin(customtkinter.CTk):
         # Create 2X1 grid
         self.grid_columnconfigure(1, weight=2)
         self.grid_columnconfigure(0, weight=1)
-        self.grid_rowconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=0)
+        self.grid_rowconfigure(1, weight=1)
 
         self.log_frame = LogFrame(self, header_name="RadioButtonFrame 1")
         self.log_frame.grid(row=0, rowspan=2,column=1, sticky="nsew")
 
         self.cmd_input = CmdInput(self, header_name="RadioButtonFrame 1")
-        self.cmd_input.grid(row=0, rowspan=2,column=0)
+        self.cmd_input.grid(row=0, column=0)
+
+        self.feed = None
+        if reader is not None:
+            self.feed = RingFeed(reader, self.log_frame)
+            self.feed.start()
+            self.protocol("WM_DELETE_WINDOW", self.detach)
+            self.poll_filter()
+
+        self.stats_frame = StatsFrame(self, feed=self.feed)
+        self.stats_frame.grid(row=1, column=0, sticky="nsew")
 
         print(self.grid_size())
+
+    def poll_filter(self, interval=200):
+        """Hand the filter selected to the feed thread, every interval ms"""
+        self.feed.filter_name = self.log_frame.combobox.get() if self.log_frame.activate_filter else None
+        self.after(interval, self.poll_filter)
+
+    def detach(self):
+        """Close the window, the proxy goes on"""
+        self.feed.stop()
+        self.destroy()
+
+if __name__ == "__main__":
+    # python3 gui.py [--ring=<name>] [--from-start]
+    name = shm_ring.NAME
+    for arg in sys.argv[1:]:
+        if arg.startswith("--ring="):
+            name = arg.partition("=")[2]
+    try:
+        reader = shm_ring.RingReader(name, from_start="--from-start" in sys.argv)
+    except FileNotFoundError:
+        print("No proxy to attach to: start it with --gui or --ring")
+        sys.exit(1)
+    MainWin(reader).mainloop()
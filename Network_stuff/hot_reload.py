@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to reload Protocol_Parser when it is edited, without reloading it for every packet
+"""
+
+import importlib.util
+import os
+import sys
+import time
+from threading import Lock
+import Protocol_Parser
+
+
+class ModuleReloader:
+    """
+    Hot reload of a module when its file is modified
+
+    The file is checked with a stat at most every interval seconds.
+    A new version is executed in a fresh module object which is swapped in with one
+    assignment: every thread sees either the old or the new parser, never a half built one.
+    A version that fails to load is reported and the old one is kept.
+
+    Parameters
+    ----------
+    module : module
+        module to watch
+    interval : float
+        minimum time between two checks of the file, in seconds
+
+    Attributes
+    ----------
+    module : module
+        current version of the module
+    path : str
+        file of the module
+    mtime : int
+        modification time of the file loaded, in ns
+    """
+
+    def __init__(self, module, interval=0.5) -> None:
+        self.module = module
+        self.path = module.__file__
+        self.interval = interval
+        self.mtime = os.stat(self.path).st_mtime_ns
+        self.next_check = time.monotonic() + interval
+        self.lock = Lock()
+
+    def get(self):
+        """Return the current module, reloaded first if the file changed"""
+        now = time.monotonic()
+        # only one thread checks, the others keep going with the current module
+        if now >= self.next_check and self.lock.acquire(blocking=False):
+            try:
+                self.next_check = now + self.interval
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime != self.mtime:
+                    self.mtime = mtime
+                    self._load()
+            finally:
+                self.lock.release()
+        return self.module
+
+    def reload(self):
+        """Reload the module now"""
+        with self.lock:
+            self.mtime = os.stat(self.path).st_mtime_ns
+            self._load()
+        return self.module
+
+    def _load(self):
+        start = time.perf_counter()
+        name = self.module.__name__
+        spec = importlib.util.spec_from_file_location(name, self.path)
+        module = importlib.util.module_from_spec(spec)
+        try:
+            spec.loader.exec_module(module)
+        except Exception as err:
+            print(f"[reload] {name} not reloaded: {err}")
+            return
+        self.module = module
+        sys.modules[name] = module
+        print(f"[reload] {name} reloaded in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+
+PARSER = ModuleReloader(Protocol_Parser)
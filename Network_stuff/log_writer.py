@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to log every packet without slowing down the relays: parse() hands the
+packets to a LogWriter, which formats each one into a small record, and a background thread
+writes the records by batches
+
+Formats:
+    text        [client] / [server] lines, as printed by parse()
+    jsonl       one JSON object per packet, as replay.py --jsonl
+    binary      magic, then per packet: timestamp (f64), direction (u8), repeat (u32), size (u32), raw bytes
+A record stands for repeat identical packets in a row (see dedup.py), text lines show it as ×N.
+The files can be rotated by size and compressed (zlib: .gz, lzma: .xz).
+Binary logs are read back with read_log(), or by replay.py.
+"""
+
+import os
+import sys
+import time
+from collections import deque
+from struct import Struct
+from threading import Lock, Thread
+
+LOG_MAGIC = b'PA3LOG\x00\x02'
+RECORD = Struct('<dBII')
+DIRECTIONS = ('client', 'server')
+# compression -> suffix of the files
+SUFFIXES = {None: '', 'zlib': '.gz', 'lzma': '.xz'}
+
+
+def fields(payload):
+    """Attributes of a payload, bytes as hex"""
+    values = {}
+    for cls in reversed(type(payload).__mro__):
+        for name in cls.__dict__.get('__slots__', ()):
+            if name == 'size' or not hasattr(payload, name):
+                continue
+            value = getattr(payload, name)
+            if isinstance(value, (bytes, memoryview)):
+                value = bytes(value).hex()
+            values[name] = value
+    return values
+
+
+def to_json(timestamp, conn_dir, pkt, port=None, repeat=1):
+    """JSON object of a packet, repeat is only written for a run of identical packets"""
+    # imported here: the proxy logs text by default
+    import json
+    record = {'ts': timestamp}
+    if port is not None:
+        record['port'] = port
+    record.update({
+        'dir': conn_dir, 'type': f"0x{pkt.header.type:04x}", 'class': type(pkt).__name__,
+        'size': pkt.size, 'fields': fields(pkt.payload),
+    })
+    if repeat != 1:
+        record['repeat'] = repeat
+    return json.dumps(record)
+
+
+def format_text(_timestamp, conn_dir, pkt, repeat):
+    if repeat != 1:
+        return f"[{conn_dir}] {pkt} ×{repeat}\n"
+    return f"[{conn_dir}] {pkt}\n"
+
+
+def format_jsonl(timestamp, conn_dir, pkt, repeat):
+    return to_json(timestamp, conn_dir, pkt, repeat=repeat) + '\n'
+
+
+def format_binary(timestamp, conn_dir, pkt, repeat):
+    raw = pkt.raw if pkt.raw is not None else pkt.encode()
+    return RECORD.pack(timestamp, DIRECTIONS.index(conn_dir), repeat, len(raw)) + raw
+
+
+FORMATTERS = {'text': format_text, 'jsonl': format_jsonl, 'binary': format_binary}
+
+
+def _opener(path):
+    """open function of a file, from its suffix"""
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open
+    if path.endswith('.xz'):
+        import lzma
+        return lzma.open
+    return open
+
+
+class LogWriter:
+    """
+    Log of the packets written by a background thread
+
+    packet() formats the packet and appends the record to a deque: the queue holds no packet,
+    so no chunk received is kept alive by the log. The thread empties it every interval seconds
+    and does the writes (and the compression) by batches. When the queue is full, packets are
+    dropped and counted: the relays never wait for the log.
+
+    Parameters
+    ----------
+    path : str
+        log file, None for the console (text or jsonl)
+    fmt : str
+        one of FORMATTERS
+    rotate : int
+        size of the file (compressed) after which it is rotated, 0 to never rotate
+    backups : int
+        rotated files kept: path.1 (the newest) to path.<backups>
+    compress : str
+        None, 'zlib' or 'lzma': its suffix is added to the files
+    maxsize : int
+        number of records the queue can hold
+    batch : int
+        records written at once
+    interval : float
+        seconds the thread waits when the queue is empty
+
+    Attributes
+    ----------
+    dropped : int
+        number of packets not logged because the queue was full
+    """
+
+    def __init__(self, path=None, fmt='text', rotate=0, backups=5, compress=None, maxsize=0x10000, batch=512,
+                 interval=0.05) -> None:
+        if fmt not in FORMATTERS:
+            raise ValueError(f"Unknown log format {fmt}, use one of {list(FORMATTERS)}")
+        if compress not in SUFFIXES:
+            raise ValueError(f"Unknown compression {compress}, use one of {list(SUFFIXES)}")
+        if path is None and (fmt == 'binary' or compress is not None):
+            raise ValueError("The console only takes text or jsonl logs")
+        if path is not None and not path.endswith(SUFFIXES[compress]):
+            path += SUFFIXES[compress]
+        self.path = path
+        self.fmt = fmt
+        self.formatter = FORMATTERS[fmt]
+        self.rotate = rotate
+        self.backups = backups
+        self.compress = compress
+        self.batch = batch
+        self.interval = interval
+        self.maxsize = maxsize
+        self.dropped = 0
+        self.running = True
+        self.records = deque()
+        # the relays of every session queue records
+        self.lock = Lock()
+        self.thread = Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def packet(self, pkt, conn_dir, repeat=1):
+        """Queue the record of a packet (repeat times in a row), from any thread: the packet sink of parse()"""
+        try:
+            record = self.formatter(time.time(), conn_dir, pkt, repeat)
+        except Exception as err:
+            print(f"[log] {err}")
+            return
+        with self.lock:
+            if len(self.records) >= self.maxsize:
+                self.dropped += 1
+            else:
+                self.records.append(record)
+
+    def close(self):
+        """Write what is queued and close the file"""
+        self.running = False
+        self.thread.join()
+
+    def _open(self):
+        if self.path is None:
+            return sys.stdout
+        binary = self.fmt == 'binary'
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        out = _opener(self.path)(self.path, 'ab' if binary else 'at', **({} if binary else {'encoding': 'utf-8'}))
+        if binary and new:
+            out.write(LOG_MAGIC)
+        return out
+
+    def _rotate(self, out):
+        """path -> path.1 -> ... -> path.<backups>, then a new path"""
+        out.close()
+        base, suffix = self.path[:len(self.path) - len(SUFFIXES[self.compress])], SUFFIXES[self.compress]
+        for k in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{base}.{k}{suffix}"):
+                os.replace(f"{base}.{k}{suffix}", f"{base}.{k + 1}{suffix}")
+        os.replace(self.path, f"{base}.1{suffix}")
+        return self._open()
+
+    def _write(self):
+        """Writer main loop"""
+        out = self._open()
+        empty = b'' if self.fmt == 'binary' else ''
+        pop = self.records.popleft
+        while True:
+            # read before the queue is emptied: what close() queued before is written
+            running = self.running
+            if not self.records:
+                if not running:
+                    break
+                time.sleep(self.interval)
+                continue
+            records = []
+            try:
+                while len(records) < self.batch:
+                    records.append(pop())
+            except IndexError:
+                pass
+            out.write(empty.join(records))
+            if not self.records:
+                out.flush()
+            # the size on disk: compressed, and text encoded
+            if self.rotate and self.path is not None and os.path.getsize(self.path) >= self.rotate:
+                out = self._rotate(out)
+        if self.path is not None:
+            out.close()
+
+
+def is_log(path):
+    try:
+        with _opener(path)(path, 'rb') as source:
+            return source.read(len(LOG_MAGIC)) == LOG_MAGIC
+    except (OSError, EOFError):
+        return False
+
+
+def read_log(path):
+    """Packets of a binary log: list of (timestamp, conn_dir, raw bytes, repeat)"""
+    with _opener(path)(path, 'rb') as source:
+        data = source.read()
+    packets = []
+    view = memoryview(data)
+    pos = len(LOG_MAGIC)
+    while pos + RECORD.size <= len(view):
+        timestamp, direction, repeat, size = RECORD.unpack_from(view, pos)
+        pos += RECORD.size
+        if pos + size > len(view):
+            # cut by a crash
+            break
+        packets.append((timestamp, DIRECTIONS[direction], bytes(view[pos:pos + size]), repeat))
+        pos += size
+    return packets
+
@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to measure the traffic live: packets and bytes per type and direction,
+time spent decoding each payload class, forwarding latency, queue depths.
+Payloads are decoded lazily: the decoding time is measured where a payload is decoded (by the
+display, the world, a filter...), the metrics never decode one themselves. Timing a decode
+costs about as much as the decode, so it is off unless time_decodes is set.
+
+Counters are written without lock: each thread owns a shard (its own dicts) and the shards
+are only summed when the numbers are read. A thread which ends (the relay of a session)
+retires its shard: it is added to the totals of the finished threads.
+Durations go to histograms with fixed buckets, bucket k counting the durations of less than 2**k ns.
+This module is not hot reloaded with the parser, so the numbers survive a reload.
+"""
+
+import threading
+
+# bucket 39: more than 9 minutes
+BUCKETS = 40
+
+
+def bucket(ns):
+    """Histogram bucket of a duration in ns"""
+    return min(ns.bit_length(), BUCKETS - 1)
+
+
+def quantile(histogram, q):
+    """Upper bound in ns of the quantile q of a histogram, None if it is empty"""
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for k, count in enumerate(histogram):
+        seen += count
+        if seen >= rank:
+            return 1 << k
+    return 1 << (BUCKETS - 1)
+
+
+class _Shard:
+    """Counters of one thread"""
+    __slots__ = ('packets', 'decodes', 'histograms', 'counters')
+
+    def __init__(self):
+        # (type, direction) -> [packets, bytes, payload class]
+        self.packets = {}
+        # type -> [payloads decoded, decoding ns, payload class]
+        self.decodes = {}
+        # name -> list of BUCKETS counts
+        self.histograms = {}
+        # name -> value
+        self.counters = {}
+
+    def merge(self, shard):
+        """Add the counts of another shard"""
+        for key, (count, size, payload_name) in shard.packets.items():
+            stat = self.packets.setdefault(key, [0, 0, payload_name])
+            stat[0] += count
+            stat[1] += size
+        for key, (count, ns, payload_name) in shard.decodes.items():
+            stat = self.decodes.setdefault(key, [0, 0, payload_name])
+            stat[0] += count
+            stat[1] += ns
+        for name, histogram in shard.histograms.items():
+            merged = self.histograms.setdefault(name, [0] * BUCKETS)
+            for k, count in enumerate(histogram):
+                merged[k] += count
+        for name, value in shard.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+class Metrics:
+    """
+    Live metrics of the proxy
+
+    Attributes
+    ----------
+    enabled : bool
+        when unset, the parser does not measure anything
+    time_decodes : bool
+        when set, the payloads decoded are counted and timed
+    """
+
+    def __init__(self) -> None:
+        self.enabled = True
+        self.time_decodes = False
+        self.local = threading.local()
+        self.shards = []
+        # counts of the threads which ended
+        self.retired = _Shard()
+        # shards registered and retired while the numbers are summed
+        self.lock = threading.Lock()
+        # name -> function returning the current value
+        self.gauges = {}
+
+    def _shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = _Shard()
+            with self.lock:
+                self.shards.append(shard)
+            return shard
+
+    def retire(self):
+        """The calling thread ends: its counts are added to the totals of the finished threads"""
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            return
+        del self.local.shard
+        with self.lock:
+            self.shards.remove(shard)
+            self.retired.merge(shard)
+
+    def _all(self):
+        """Shards to sum, self.lock held"""
+        return self.shards + [self.retired]
+
+    def packet(self, pkt_type, conn_dir, size, payload_name):
+        """Count a packet"""
+        shard = self._shard()
+        stat = shard.packets.get((pkt_type, conn_dir))
+        if stat is None:
+            stat = shard.packets[(pkt_type, conn_dir)] = [0, 0, payload_name]
+        stat[0] += 1
+        stat[1] += size
+
+    def decoded(self, pkt_type, payload_name, ns):
+        """Count a payload decoded and the time it took"""
+        shard = self._shard()
+        stat = shard.decodes.get(pkt_type)
+        if stat is None:
+            stat = shard.decodes[pkt_type] = [0, 0, payload_name]
+        stat[0] += 1
+        stat[1] += ns
+        self._observe(shard, 'decode ' + payload_name, ns)
+
+    def observe(self, name, ns):
+        """Add a duration to the histogram name"""
+        self._observe(self._shard(), name, ns)
+
+    @staticmethod
+    def _observe(shard, name, ns):
+        histogram = shard.histograms.get(name)
+        if histogram is None:
+            histogram = shard.histograms[name] = [0] * BUCKETS
+        histogram[bucket(ns)] += 1
+
+    def add(self, name, value=1):
+        """Add to the counter name"""
+        counters = self._shard().counters
+        counters[name] = counters.get(name, 0) + value
+
+    def gauge(self, name, read):
+        """Register a value read when the metrics are shown, ex: the depth of a queue"""
+        self.gauges[name] = read
+
+    def packets(self):
+        """Return {(type, direction): [packets, bytes, payload class]} for every thread"""
+        total = {}
+        with self.lock:
+            for shard in self._all():
+                # copied at once: the thread of the shard may add keys meanwhile
+                for key, (count, size, payload_name) in list(shard.packets.items()):
+                    stat = total.setdefault(key, [0, 0, payload_name])
+                    stat[0] += count
+                    stat[1] += size
+        return total
+
+    def decodes(self):
+        """Return {type: [payloads decoded, decoding ns, payload class]} for every thread"""
+        total = {}
+        with self.lock:
+            for shard in self._all():
+                for key, (count, ns, payload_name) in list(shard.decodes.items()):
+                    stat = total.setdefault(key, [0, 0, payload_name])
+                    stat[0] += count
+                    stat[1] += ns
+        return total
+
+    def histograms(self):
+        """Return {name: list of BUCKETS counts} for every thread"""
+        total = {}
+        with self.lock:
+            for shard in self._all():
+                for name, histogram in list(shard.histograms.items()):
+                    merged = total.setdefault(name, [0] * BUCKETS)
+                    for k, count in enumerate(list(histogram)):
+                        merged[k] += count
+        return total
+
+    def counters(self):
+        """Return {name: value} for every thread"""
+        total = {}
+        with self.lock:
+            for shard in self._all():
+                for name, value in list(shard.counters.items()):
+                    total[name] = total.get(name, 0) + value
+        return total
+
+    def report(self):
+        """Text tables of the metrics: types sorted by bytes, then by decoding time"""
+        lines = [f"{'type':>6} {'dir':<6} {'payload':<28} {'packets':>9} {'bytes':>10}"]
+        packets = sorted(self.packets().items(), key=lambda item: -item[1][1])
+        for (pkt_type, conn_dir), (count, size, payload_name) in packets:
+            lines.append(f"0x{pkt_type:04x} {conn_dir:<6} {payload_name:<28} {count:>9} {size:>10}")
+        if self.time_decodes:
+            lines.append("")
+            lines.append(f"{'type':>6} {'payload':<35} {'decoded':>9} {'decode ms':>10} {'µs/pkt':>7}")
+            decodes = sorted(self.decodes().items(), key=lambda item: -item[1][1])
+            for pkt_type, (count, ns, payload_name) in decodes:
+                lines.append(f"0x{pkt_type:04x} {payload_name:<35} {count:>9} {ns / 1e6:>10.1f} {ns / count / 1e3:>7.1f}")
+        lines.append("")
+        lines.append(f"{'histogram':<36} {'count':>9} {'p50 µs':>8} {'p99 µs':>8}")
+        for name, histogram in sorted(self.histograms().items()):
+            lines.append(f"{name:<36} {sum(histogram):>9} {quantile(histogram, 0.5) / 1e3:>8.1f}"
+                         f" {quantile(histogram, 0.99) / 1e3:>8.1f}")
+        counters = self.counters()
+        if counters or self.gauges:
+            lines.append("")
+        for name, value in sorted(counters.items()):
+            lines.append(f"{name:<36} {value:>9}")
+        for name, read in self.gauges.items():
+            try:
+                value = read()
+            except Exception as err:
+                value = err
+            lines.append(f"{name:<36} {value:>9}")
+        return '\n'.join(lines)
+
+
+METRICS = Metrics()
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to describe payloads with a list of fields instead of hand-written offsets.
+From the fields of a payload, the parse / length / encode methods are generated once:
+consecutive fixed-size fields are read with a single struct.Struct and the whole payload
+is decoded in one pass.
+
+Example, for a payload with an id, a name prefixed by its length and a position:
+    FIELDS = (U32('id'), String('name', 'name_len'), F32('X'), F32('Y'), F32('Z'))
+"""
+
+from struct import Struct
+
+
+class Field:
+    """
+    Field of a payload
+
+    Attributes
+    ----------
+    name : str
+        attribute of the payload
+    fmt : str
+        struct code of the field, None if it is not read by struct
+    size : int
+        size in bytes, None for a variable size
+    """
+    fmt = None
+    size = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def attrs(self):
+        """Attributes of the payload holding the field"""
+        return [self.name]
+
+
+class Number(Field):
+    """Little endian number read by struct"""
+    def __init__(self, name, fmt):
+        super().__init__(name)
+        self.fmt = fmt
+        self.size = Struct('<' + fmt).size
+
+
+def U8(name):
+    return Number(name, 'B')
+
+def U16(name):
+    return Number(name, 'H')
+
+def U32(name):
+    return Number(name, 'I')
+
+def I32(name):
+    return Number(name, 'i')
+
+def F32(name):
+    return Number(name, 'f')
+
+
+class UInt(Field):
+    """Little endian unsigned int of any width (ex: 6 bytes)"""
+    def __init__(self, name, size):
+        super().__init__(name)
+        self.size = size
+
+
+class Blob(Field):
+    """Opaque bytes, kept as a view on the buffer. Without size, takes the rest of the payload"""
+    def __init__(self, name, size=None):
+        super().__init__(name)
+        self.size = size
+
+
+class Pad(Field):
+    """Bytes ignored when decoding, zeros when encoding"""
+    def __init__(self, size):
+        super().__init__(None)
+        self.size = size
+
+    def attrs(self):
+        return []
+
+
+class String(Field):
+    """utf-8 string prefixed by its length on 2 bytes, stored in the attribute len_name"""
+    def __init__(self, name, len_name):
+        super().__init__(name)
+        self.len_name = len_name
+
+    def attrs(self):
+        return [self.len_name, self.name]
+
+
+class _Offset:
+    """Offset in the buffer while generating code: variable part + constant part"""
+    def __init__(self):
+        self.var = None
+        self.const = 0
+
+    def __str__(self):
+        if self.var is None:
+            return str(self.const)
+        if self.const == 0:
+            return self.var
+        return f"{self.var} + {self.const}"
+
+
+def _runs(fields):
+    """
+    Group the fields in runs read by a single struct: numbers and fixed size
+    fields (as pad bytes), plus the length prefix of the string which ends the run.
+    Yield (run fields, fmt, string or blob ending the run or None)
+    """
+    run, fmt = [], ''
+    for field in fields:
+        if isinstance(field, String):
+            yield run, fmt + 'H', field
+            run, fmt = [], ''
+        elif isinstance(field, Blob) and field.size is None:
+            yield run, fmt, field
+            run, fmt = [], ''
+        else:
+            run.append(field)
+            fmt += field.fmt if field.fmt else f'{field.size}x'
+    if run:
+        yield run, fmt, None
+
+
+def _gen_parse(clazz, fields, env):
+    lines = ["def parse(_buf):"]
+    off = _Offset()
+    for i, (run, fmt, tail) in enumerate(_runs(fields)):
+        names = [f.name for f in run if f.fmt]
+        if isinstance(tail, String):
+            names.append(tail.len_name)
+        if names:
+            env[f'_S{i}'] = Struct('<' + fmt)
+            lines.append(f"    {', '.join(names)}, = _S{i}.unpack_from(_buf, {off})")
+        # fields not read by struct: slices at a known offset
+        for field in run:
+            if isinstance(field, Blob):
+                lines.append(f"    {field.name} = _buf[{off}:{off} + {field.size}]")
+            elif isinstance(field, UInt):
+                lines.append(f"    {field.name} = int.from_bytes(_buf[{off}:{off} + {field.size}], 'little')")
+            off.const += field.size
+        if isinstance(tail, String):
+            off.const += 2
+            lines.append(f"    _s = {off}")
+            lines.append(f"    _o = _s + {tail.len_name}")
+            lines.append(f"    {tail.name} = str(_buf[_s:_o], 'utf-8')")
+            off.var, off.const = '_o', 0
+        elif isinstance(tail, Blob):
+            lines.append(f"    {tail.name} = _buf[{off}:]")
+            off.var, off.const = 'len(_buf)', 0
+    lines.append("    _pl = _new(_cls)")
+    for name in _attrs(fields):
+        lines.append(f"    _pl.{name} = {name}")
+    lines.append(f"    _pl.size = {off}")
+    lines.append("    return _pl")
+    return lines
+
+
+def _gen_length(fields):
+    lines = ["def length(_buf):"]
+    off = _Offset()
+    for field in fields:
+        if isinstance(field, String):
+            lines.append(f"    _o = {off} + 2 + _H.unpack_from(_buf, {off})[0]")
+            off.var, off.const = '_o', 0
+        elif isinstance(field, Blob) and field.size is None:
+            lines.append("    return len(_buf)")
+            return lines
+        else:
+            off.const += field.size
+    lines.append(f"    return {off}")
+    return lines
+
+
+def _gen_encode(fields, env):
+    parts = []
+    fmt, names = '', []
+    for field in fields:
+        if field.fmt:
+            fmt += field.fmt
+            names.append(f"self.{field.name}")
+            continue
+        if fmt:
+            env[f'_E{len(parts)}'] = Struct('<' + fmt)
+            parts.append(f"_E{len(parts)}.pack({', '.join(names)})")
+            fmt, names = '', []
+        if isinstance(field, String):
+            parts.append(f"_H.pack(self.{field.len_name})")
+            parts.append(f"self.{field.name}.encode()")
+        elif isinstance(field, UInt):
+            parts.append(f"self.{field.name}.to_bytes({field.size}, 'little')")
+        elif isinstance(field, Pad):
+            parts.append(repr(bytes(field.size)))
+        else:
+            parts.append(f"self.{field.name}")
+    if fmt:
+        env[f'_E{len(parts)}'] = Struct('<' + fmt)
+        parts.append(f"_E{len(parts)}.pack({', '.join(names)})")
+    return ["def encode(self):", f"    return b''.join(({', '.join(parts)}{',' if len(parts) == 1 else ''}))"]
+
+
+def _attrs(fields):
+    return [name for field in fields for name in field.attrs()]
+
+
+def _str(self):
+    values = []
+    for name in _attrs(self.FIELDS):
+        value = getattr(self, name)
+        if isinstance(value, (bytes, memoryview)):
+            value = value.hex()
+        values.append(f"{name}={value}")
+    return f"{type(self).__name__}: {' '.join(values)}"
+
+
+class SlotsMeta(type):
+    """
+    Metaclass giving __slots__ to the classes which do not declare them, so their
+    instances have no __dict__: the attributes of the FIELDS plus size for a payload,
+    no new attribute otherwise.
+    """
+    def __new__(mcs, name, bases, namespace):
+        if '__slots__' not in namespace:
+            fields = namespace.get('FIELDS')
+            namespace['__slots__'] = () if fields is None else tuple(_attrs(fields)) + ('size',)
+        return super().__new__(mcs, name, bases, namespace)
+
+
+class Payload(metaclass=SlotsMeta):
+    """Base of the payloads: compact instances without __dict__"""
+    __slots__ = ()
+
+
+def compile_payload(clazz):
+    """
+    Generate __init__, parse, length and encode of a payload class from its FIELDS.
+    SIZE is set when the payload has a fixed size.
+    A class without FIELDS or already compiled is left untouched.
+    """
+    fields = getattr(clazz, 'FIELDS', None)
+    if fields is None or clazz.__dict__.get('_compiled'):
+        return clazz
+    env = {'_cls': clazz, '_new': object.__new__, '_H': Struct('<H')}
+    attrs = _attrs(fields)
+    source = [f"def __init__(self, {', '.join(attrs)}):" if attrs else "def __init__(self):"]
+    source += [f"    self.{name} = {name}" for name in attrs] or ["    pass"]
+    source += _gen_parse(clazz, fields, env)
+    source += _gen_length(fields)
+    source += _gen_encode(fields, env)
+    exec(compile('\n'.join(source), f"<schema {clazz.__name__}>", 'exec'), env)
+    clazz.__init__ = env['__init__']
+    clazz.parse = staticmethod(env['parse'])
+    clazz.length = staticmethod(env['length'])
+    clazz.encode = env['encode']
+    if all(field.size is not None for field in fields):
+        clazz.SIZE = sum(field.size for field in fields)
+    if '__str__' not in clazz.__dict__:
+        clazz.__str__ = _str
+    clazz._compiled = True
+    return clazz
+
+
+def make_payload(name, fields):
+    """Create and compile a payload class from its fields"""
+    return compile_payload(SlotsMeta(name, (Payload,), {'FIELDS': tuple(fields)}))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to forward the connections which are not parsed without copying the data
+through Python: os.splice moves it from one socket to the other through a pipe, in the kernel (Linux).
+"""
+
+import errno
+import os
+import select
+import socket
+from threading import Lock
+from metrics import METRICS
+
+# unset as well when the kernel refuses to splice sockets (some sandboxes)
+AVAILABLE = hasattr(os, 'splice')
+# bytes moved per splice, the size of a pipe
+CHUNK = 0x10000
+# seconds between two checks of keep_going() on an idle connection, when nobody calls wake()
+POLL = 0.2
+
+# write ends of the wakeup pipes of the relays splicing
+_WAKERS = set()
+_LOCK = Lock()
+
+
+def wake():
+    """Make the relays splicing check keep_going() right away, ex: after a port is parsed again"""
+    with _LOCK:
+        wakers = list(_WAKERS)
+    for fd in wakers:
+        try:
+            os.write(fd, b'\0')
+        except OSError:
+            # pipe full: a wakeup is already pending, or the relay just left
+            pass
+
+
+def splice_relay(src, dst, keep_going, conn_dir='client'):
+    """
+    Forward src to dst with os.splice while keep_going() is true.
+    keep_going is checked before each chunk, after waiting at most POLL seconds for data or
+    until wake() is called: no chunk is spliced once it is false, even on an idle connection.
+    Return False when src is closed (dst is then shut down), True otherwise, and None when
+    sockets can not be spliced: nothing was moved and AVAILABLE is unset.
+    """
+    global AVAILABLE
+    pipe_r, pipe_w = os.pipe()
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+    with _LOCK:
+        _WAKERS.add(wake_w)
+    moved = False
+    try:
+        while keep_going():
+            readable, _, _ = select.select([src, wake_r], [], [], POLL)
+            if wake_r in readable:
+                os.read(wake_r, 0x100)
+            # the state may have changed while waiting
+            if src not in readable or not keep_going():
+                continue
+            try:
+                size = os.splice(src.fileno(), pipe_w, CHUNK, os.SPLICE_F_MOVE)
+            except OSError as err:
+                if moved or err.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                    raise
+                print(f"[passthrough] os.splice not supported ({err}), data is copied")
+                AVAILABLE = False
+                return None
+            moved = True
+            if size == 0:
+                try:
+                    dst.shutdown(socket.SHUT_WR)
+                except OSError:
+                    pass
+                return False
+            left = size
+            while left:
+                left -= os.splice(pipe_r, dst.fileno(), left, os.SPLICE_F_MOVE)
+            METRICS.add(f'passthrough bytes {conn_dir}', size)
+        return True
+    finally:
+        with _LOCK:
+            _WAKERS.discard(wake_w)
+        for fd in (pipe_r, pipe_w, wake_r, wake_w):
+            os.close(fd)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to move the parsing and the display of packets off the forwarding path:
+relays forward first, then push a copy of the data on a bounded queue drained by workers
+"""
+
+import queue
+from threading import Lock, Thread
+
+
+class ParsePipeline:
+    """
+    Bounded queues drained by parser threads
+
+    The chunks of one direction are always handled by the same worker so they are
+    parsed in order. When a queue is full, the policy decides what is lost:
+
+    - 'drop-newest': the chunk pushed is dropped
+    - 'drop-oldest': the oldest chunk of the queue is dropped
+    - 'block': the relay waits (back-pressure on the game connection)
+
+    Parameters
+    ----------
+    handler : callable
+        called as handler(data, conn_dir, stream) by the workers
+    workers : int
+        number of parser threads
+    maxsize : int
+        number of chunks each queue can hold
+    policy : str
+        overflow policy, one of ParsePipeline.POLICIES
+
+    Attributes
+    ----------
+    dropped : int
+        number of chunks dropped since the start
+    """
+
+    POLICIES = ('drop-newest', 'drop-oldest', 'block')
+
+    def __init__(self, handler, workers=1, maxsize=1024, policy='drop-oldest') -> None:
+        if policy not in ParsePipeline.POLICIES:
+            raise ValueError(f"Unknown policy {policy}, use one of {ParsePipeline.POLICIES}")
+        self.handler = handler
+        self.policy = policy
+        self.dropped = 0
+        # the relays of every session drop
+        self.lock = Lock()
+        self.queues = [queue.Queue(maxsize) for _ in range(workers)]
+        for chunks in self.queues:
+            Thread(target=self._work, args=(chunks,), daemon=True).start()
+
+    def push(self, data, conn_dir, stream):
+        """Queue a copy of forwarded data, never blocks unless policy is 'block'"""
+        chunks = self.queues[hash(stream) % len(self.queues)]
+        item = (data, conn_dir, stream)
+        if self.policy == 'block':
+            chunks.put(item)
+            return
+        try:
+            chunks.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        if self.policy == 'drop-oldest':
+            try:
+                self._drop(chunks.get_nowait()[2])
+            except queue.Empty:
+                pass
+            try:
+                chunks.put_nowait(item)
+                return
+            except queue.Full:
+                pass
+        self._drop(stream)
+
+    def depth(self):
+        """Number of chunks waiting to be parsed"""
+        return sum(chunks.qsize() for chunks in self.queues)
+
+    def _drop(self, stream):
+        with self.lock:
+            self.dropped += 1
+        # the packet being reassembled is lost with the chunk
+        stream.gap = True
+
+    def _work(self, chunks):
+        """Worker main loop"""
+        while True:
+            data, conn_dir, stream = chunks.get()
+            try:
+                self.handler(data, conn_dir, stream)
+            except Exception as o_err:
+                print(f'parser[{conn_dir}]', o_err)
@@ -7,22 +7,288 @@ Authors: Dvorhack & K8pl3r
 This file is aimed to provide a tcp proxy for different ports
 """
 
-from threading import Thread
-from tkinter import END
+from threading import Thread, Lock, Event
 import os
+import queue
+import select
 import socket
 import sys
-import importlib
+import time
+from time import perf_counter_ns
 import Protocol_Parser
-import gui
+from hot_reload import PARSER
+from pipeline import ParsePipeline
+from capture import CaptureWriter
+from metrics import METRICS
+from world import WORLDS
+from frame_lengths import LENGTHS
+from rewrite import REWRITER, RewriteStream
+from log_writer import LogWriter
+from dedup import FOLDER
+import passthrough
+from passthrough import splice_relay
+
+# when set, the packets parsed are written to the shared memory ring read by the GUI process
+RING = None
+# when set, the packets parsed are logged by a background thread instead of printed by the relays
+LOG = None
+# when set, data is forwarded before being parsed by the pipeline workers
+PIPELINE = None
+# when set, every chunk is recorded in a capture file
+CAPTURE = None
+# when unset, data is only forwarded
+PARSE = True
+# name of the filter of Protocol_Parser.FILTERS_DICT applied to the packets shown and logged, None for all
+FILTER = None
+
+SERVER_IP = 'pentest.hackutt.uttnetgroup.fr'
+MASTER_PORT = 3333
+GAME_PORTS = list(range(3000, 3006))
+PORTS = [MASTER_PORT] + GAME_PORTS
+# ports only forwarded, not parsed, ex: --passthrough=3333 for the master server
+PASSTHROUGH_PORTS = set()
+# forward the connections not parsed with os.splice (Linux)
+SPLICE = passthrough.AVAILABLE
+# connections to the server opened in advance per port
+PRECONNECT = 0
+
+
+def passthrough_active(port, conn_dir, rewrite=None):
+    """
+    True when a direction of a port only needs forwarding: not parsed, no capture
+    and nothing to rewrite or to inject in its RewriteStream
+    """
+    if CAPTURE is not None or REWRITER.hooks[conn_dir] or (rewrite is not None and rewrite.injected):
+        return False
+    return not PARSE or port in PASSTHROUGH_PORTS
+
+
+def display(data, conn_dir, stream):
+    """
+    Parse data and hand the packets to the log and to the GUI process
+
+    Parameters
+    ----------
+    data : bytes
+        chunk received
+    conn_dir : str
+        'client' or 'server'
+    stream : Protocol_Parser.StreamBuffer
+        reassembly buffer of the direction
+    """
+    if not PARSE:
+        return
+    # The parser is reloaded when its file is edited in order to be dynamic
+    parser = PARSER.get()
+    if RING is None and LOG is None:
+        sink = print_sink
+    elif LOG is None:
+        # formatted and filtered by the GUI process
+        sink = RING.packet
+    elif RING is None:
+        sink = LOG.packet
+    else:
+        sink = both_sinks
+    # the runs of identical packets are shown once, with their count
+    parser.parse(data, conn_dir, filter_selected=FILTER, stream=stream,
+                 packet_sink=FOLDER.sink(WORLDS.sink(sink, stream.session), stream))
+
+
+def status(*args):
+    """Print a message of the proxy (setup, connections, errors): the GUI log shows it too"""
+    line = ' '.join(str(arg) for arg in args)
+    print(line)
+    if RING is not None:
+        RING.text(line + '\n')
+
+
+def print_sink(pkt, conn_dir, repeat=1):
+    print(f"[{conn_dir}] {pkt} ×{repeat}\n" if repeat != 1 else f"[{conn_dir}] {pkt}\n")
 
-GUI = False
-root = None
+
+def both_sinks(pkt, conn_dir, repeat=1):
+    RING.packet(pkt, conn_dir, repeat)
+    LOG.packet(pkt, conn_dir, repeat)
+
+
+def open_ring(launch_gui=True):
+    """
+    Write the packets to the shared memory ring, the GUI attaches to it with python3 gui.py
+
+    Parameters
+    ----------
+    launch_gui : bool
+        start a GUI process too
+    """
+    global RING
+    # imported here: a headless proxy starts without them
+    import subprocess
+    from shm_ring import RingWriter
+    if RING is None:
+        try:
+            RING = RingWriter()
+        except FileExistsError as err:
+            # another proxy writes the ring: its GUI must not show these packets
+            print(f"[ring] {err}")
+            return
+        METRICS.gauge('ring dropped', lambda: RING.dropped)
+        Thread(target=publish_stats, daemon=True).start()
+    if launch_gui:
+        gui_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'gui.py')
+        subprocess.Popen([sys.executable, gui_path, f'--ring={RING.name}'])
+
+
+def publish_stats(interval=1.0):
+    """Write the metrics to the ring for the stats panel of the GUI"""
+    while RING is not None:
+        RING.stats(METRICS.report())
+        time.sleep(interval)
+
+
+def forwarded(data, port, conn_dir, stream):
+    """
+    Work done on a chunk once it is forwarded: capture it and queue it for the parser
+
+    Parameters
+    ----------
+    data : bytes
+        chunk forwarded
+    port : int
+        port of the connexion
+    conn_dir : str
+        'client' or 'server'
+    stream : Protocol_Parser.StreamBuffer
+        reassembly buffer of the direction
+    """
+    if CAPTURE is not None:
+        CAPTURE.record(data, port, conn_dir, stream)
+    if PIPELINE is not None:
+        PIPELINE.push(data, conn_dir, stream)
+
+
+def stream_closed(stream):
+    """The connection of a stream is closed"""
+    # the runs of identical packets folded in the stream are shown now
+    FOLDER.close(stream)
+    if stream.session is not None:
+        WORLDS.close(stream.session)
+        # a chunk still queued for the parser does not open the world again
+        stream.session = None
+    if CAPTURE is not None:
+        CAPTURE.close_stream(stream)
+
+
+def on_chunk(data, port, conn_dir, stream):
+    """Hook of the asyncio engine, called once the chunk is forwarded"""
+    if passthrough_active(port, conn_dir):
+        # not seen by the stream buffer: its tail can not be completed anymore
+        stream.gap = True
+        return
+    if PIPELINE is None:
+        display(data, conn_dir, stream)
+    forwarded(data, port, conn_dir, stream)
+
+
+class UpstreamPool:
+    """
+    Connections to the server opened in advance, so a session starts without waiting for the server
+
+    Parameters
+    ----------
+    host : str
+        IP of the server
+    port : int
+        port of the server
+    size : int
+        connections kept ready, 0 to connect at each session
+    max_idle : float
+        seconds a connection is kept unused before it is replaced
+
+    Attributes
+    ----------
+    idle : queue.Queue
+        (socket, time of the connection) ready to be used
+    """
+
+    def __init__(self, host, port, size=0, max_idle=30.0) -> None:
+        self.host = host
+        self.port = port
+        self.size = size
+        self.max_idle = max_idle
+        self.idle = queue.Queue()
+        self.wanted = Event()
+        if size:
+            Thread(target=self._fill, daemon=True).start()
+
+    def connect(self):
+        server = socket.create_connection((self.host, self.port))
+        # the game sends small packets: no Nagle delay on top of the client's
+        server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return server
+
+    def get(self):
+        """Connection to the server: a ready one if there is one, a new one otherwise"""
+        while True:
+            try:
+                sock, since = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            if self._usable(sock, since):
+                self.wanted.set()
+                return sock
+            sock.close()
+        self.wanted.set()
+        return self.connect()
+
+    def _usable(self, sock, since):
+        if time.monotonic() - since > self.max_idle:
+            return False
+        # readable while idle: closed by the server (or data to keep, the peek does not consume it)
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return True
+        try:
+            return sock.recv(1, socket.MSG_PEEK) != b''
+        except OSError:
+            return False
+
+    def _fill(self):
+        """Keep size connections ready, replace the old ones"""
+        while True:
+            ready = []
+            while True:
+                try:
+                    ready.append(self.idle.get_nowait())
+                except queue.Empty:
+                    break
+            for sock, since in ready:
+                if self._usable(sock, since):
+                    self.idle.put((sock, since))
+                else:
+                    sock.close()
+            while self.idle.qsize() < self.size:
+                try:
+                    self.idle.put((self.connect(), time.monotonic()))
+                except OSError as conn_err:
+                    status(f'server[{self.port}] pre-connect', conn_err)
+                    break
+            self.wanted.wait(self.max_idle / 2)
+            self.wanted.clear()
+
+
+def close_session(*socks):
+    """Close the sockets of a session, the relays blocked on them wake up"""
+    for sock in socks:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        sock.close()
 
 
 class Proxy(Thread):
     """
-    Class that contains one connexion from the Client>->Proxy and one connexion Proxy<->Server
+    Listener of one port: every client connecting gets its own session with the server
 
     Parameters
     ----------
@@ -32,6 +298,10 @@ class Proxy(Thread):
         IP of the server
     port : int
         port connect / listen
+    port_offset : int
+        the server listens on port + port_offset
+    preconnect : int
+        connections to the server opened in advance
 
     Attributes
     ----------
@@ -41,193 +311,363 @@ class Proxy(Thread):
         IP of the server
     port : int
         port of the connexion
-    c2p : Client2Proxy
-        Structure of Client<->Proxy connexion
-    p2s : Proxy2Server
-        Structure of Proxy<->Server connexion
+    listener : Socket
+        listening socket of the port, kept for the life of the proxy
+    pool : UpstreamPool
+        connections to the server
+    sessions : list
+        (Client2Proxy, Proxy2Server) of the sessions running
     """
+    # connections waiting to be accepted
+    BACKLOG = 128
 
-    def __init__(self, from_host, to_host, port) -> None:
-        super().__init__()
+    def __init__(self, from_host, to_host, port, port_offset=0, preconnect=0) -> None:
+        super().__init__(daemon=True)
         self.from_host = from_host
         self.to_host = to_host
         self.port = port
-        self.c2p = None
-        self.p2s = None
+        self.pool = UpstreamPool(to_host, port + port_offset, preconnect)
+        self.sessions = []
+        self.lock = Lock()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((from_host, port))
+        self.listener.listen(Proxy.BACKLOG)
+        METRICS.gauge(f'sessions {port}', self.active)
 
     def run(self):
         """
-        Main loop of Thread
+        Main loop of Thread: accept the clients
         """
+        status(f"[proxy({self.port})] setting up")
         while True:
-            if GUI:
-                root.log_frame.textbox.insert("0.0",f"[proxy({self.port})] setting up\n")
-            else:
-                print(f"[proxy({self.port})] setting up")
-            # Wait for a client to connect
-            self.c2p = Client2Proxy(self.from_host, self.port)
-            self.p2s = Proxy2Server(self.to_host, self.port)
-            print(f"[proxy({self.port})] connection established")
-
-            # Exchange file descriptor
-            self.c2p.server = self.p2s.server
-            self.p2s.client = self.c2p.client
-
-            self.c2p.start()
-            self.p2s.start()
-
-
-class Client2Proxy(Thread):
+            try:
+                client, _addr = self.listener.accept()
+            except OSError as err:
+                status(f'proxy[{self.port}]', err)
+                break
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # the server connection is opened aside: clients connecting at once do not wait for each other
+            Thread(target=self.open_session, args=(client,), daemon=True).start()
+
+    def open_session(self, client):
+        """Connect a client to the server and start relaying"""
+        try:
+            server = self.pool.get()
+        except OSError as conn_err:
+            status(f'server[{self.port}]', conn_err)
+            close_session(client)
+            return
+        session = REWRITER.new_session(self.port)
+        c2p = Client2Proxy(client, server, self.port, session)
+        p2s = Proxy2Server(server, client, self.port, session)
+        status(f"[proxy({self.port})] connection established: session {session}")
+        c2p.start()
+        p2s.start()
+        # started first: a session not started yet would look finished to the other setups
+        with self.lock:
+            self.sessions = [session for session in self.sessions if session[0].is_alive() or session[1].is_alive()]
+            self.sessions.append((c2p, p2s))
+
+    def active(self):
+        """Number of sessions running"""
+        return sum(1 for c2p, p2s in self.sessions if c2p.is_alive() or p2s.is_alive())
+
+    def close(self):
+        """Stop accepting clients, the sessions running go on"""
+        self.listener.close()
+
+
+class Relay(Thread):
     """
-    Class wrapping the connexion Client<->Proxy
+    One direction of a session: the data received on src is parsed and forwarded to dst.
+    When one side hangs up, the whole session is closed.
 
     Parameters
     ----------
-    host : str
-        IP to listen to
+    src : Socket
+        socket read
+    dst : Socket
+        socket written
     port : int
-        port connect / listen
+        port of the connexion
+    conn_dir : str
+        'client' or 'server', the side sending the data
+    session : str
+        name of the session, packets are injected with it
 
     Attributes
     ----------
-    server : Socket
-        Socket of Proxy<->Server connexion
-    host : str
-        IP to listen to
-    port : int
-        port of the connexion
-    sock : Client2Proxy
-        Socket of Client<->Proxy connexion
+    stream : Protocol_Parser.StreamBuffer
+        reassembly buffer of the direction
+    rewrite : RewriteStream
+        tampering of the direction
     """
 
-    def __init__(self, host, port):
-        super().__init__()
-        self.server = None  # real server socket not known yet
+    def __init__(self, src, dst, port, conn_dir, session=None):
+        super().__init__(daemon=True)
+        self.src = src
+        self.dst = dst
         self.port = port
-        self.host = host
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind((host, port))
-        sock.listen(1)
-        # waiting for a connection
-        self.client, _addr = sock.accept()
+        self.conn_dir = conn_dir
+        self.stream = Protocol_Parser.StreamBuffer(session)
+        self.rewrite = RewriteStream(conn_dir, session=session)
 
     def run(self):
         """ Thread main loop """
+        try:
+            self.relay()
+        finally:
+            close_session(self.src, self.dst)
+            self.rewrite.close()
+            stream_closed(self.stream)
+            # the thread ends: its metrics are kept in the totals
+            METRICS.retire()
+
+    def relay(self):
+        port, conn_dir = self.port, self.conn_dir
         while True:
             try:
-                data = self.client.recv(4096)
-                if data:
-                    # First, display data
-                    #print(f"[{self.port}] -> {data[:100].hex()}")
-
-                    # Reload the parser in order to be dynamic
-                    importlib.reload(Protocol_Parser)
-                    if not GUI:
-                        Protocol_Parser.parse(data, 'client')
-                    else:
-                        if root.log_frame.activate_filter:
-                            Protocol_Parser.parse(data, 'client',window_text=root.log_frame.textbox, filter_selected=root.log_frame.combobox.get())
-                        else:
-                            Protocol_Parser.parse(data, 'client',window_text=root.log_frame.textbox)
-
-                # Then, send data to real server
-                self.server.sendall(data)
-            except ConnectionError as con_err:
-                print('client[{self.port}]', con_err)
-                break
+                parsed = not passthrough_active(port, conn_dir, self.rewrite)
+                if not parsed and SPLICE and passthrough.AVAILABLE:
+                    self.dst.sendall(self.rewrite.flush())
+                    spliced = splice_relay(self.src, self.dst, lambda: passthrough_active(port, conn_dir, self.rewrite), conn_dir)
+                    if spliced is False:
+                        return
+                    # back to parsing: the data spliced was not seen by the stream buffer
+                    self.stream.gap = bool(spliced)
+                    continue
+                data = self.src.recv(4096)
+                if not data:
+                    # hung up
+                    return
+                start = perf_counter_ns()
+                if parsed:
+                    # tampered first: the packets displayed are the packets forwarded
+                    data = self.rewrite.feed(data)
+                    # First, display data: a sink failing must not keep the chunk from the other side
+                    if PIPELINE is None:
+                        try:
+                            display(data, conn_dir, self.stream)
+                        except Exception as o_err:
+                            status(f'{conn_dir}[{port}]', o_err)
+                else:
+                    # not seen by the stream buffer: its tail can not be completed anymore
+                    self.stream.gap = True
+
+                # Then, send data to the other side
+                self.dst.sendall(data)
+                if parsed and data:
+                    METRICS.observe(f'forward {conn_dir}', perf_counter_ns() - start)
+                    forwarded(data, port, conn_dir, self.stream)
+            except OSError as con_err:
+                # closed by the relay of the other direction: nothing to report
+                if self.src.fileno() != -1 and self.dst.fileno() != -1:
+                    status(f'{conn_dir}[{port}]', con_err)
+                return
             except Exception as o_err:
-                print('client[{self.port}]', o_err)
+                status(f'{conn_dir}[{port}]', o_err)
 
 
-class Proxy2Server(Thread):
+class Client2Proxy(Relay):
     """
-    Class wrapping the connexion Proxy<->Server
+    Class wrapping the connexion Client<->Proxy: relay of the data sent by the client
 
     Parameters
     ----------
-    host : str
-        IP to listen to
-    port : int
-        port connect / listen
-
-    Attributes
-    ----------
+    client : Socket
+        Socket of Client<->Proxy connexion
     server : Socket
         Socket of Proxy<->Server connexion
-    host : str
-        IP to listen to
     port : int
         port of the connexion
-    client : Client2Proxy
-        Socket of Client<->Proxy connexion
+    session : str
+        name of the session
     """
 
-    def __init__(self, host, port):
-        super().__init__()
-        self.client = None  # game client socket not known yet
-        self.port = port
-        self.host = host
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server.connect((host, port))
+    def __init__(self, client, server, port, session=None):
+        super().__init__(client, server, port, 'client', session)
+        self.client = client
+        self.server = server
 
-    # run in thread
-    def run(self):
-        """Thread main loop"""
-        while True:
-            try:
-                data = self.server.recv(4096)
-                if data:
-                    # First, display data
-                    #print(f"[{self.port}] <- {data[:100].hex()}")
-
-                    importlib.reload(Protocol_Parser)
-                    if not GUI:
-                        Protocol_Parser.parse(data, 'client')
-                    else:
-                        if root.log_frame.activate_filter:
-                            Protocol_Parser.parse(data, 'client',window_text=root.log_frame.textbox, filter_selected=root.log_frame.combobox.get())
-                        else:
-                            Protocol_Parser.parse(data, 'client',window_text=root.log_frame.textbox)
-
-                # Then, send data to real server
-                self.client.sendall(data)
-            except ConnectionError as conn_err:
-                print(f'client[{self.port}]', conn_err)
-                break
-            except Exception as o_err:
-                print(f'client[{self.port}]', o_err)
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print(f"Usage: python3 {sys.argv[0]} <server ip>")
-    else:
-        SERVER_IP = sys.argv[1]
+class Proxy2Server(Relay):
+    """
+    Class wrapping the connexion Proxy<->Server: relay of the data sent by the server
+
+    Parameters
+    ----------
+    server : Socket
+        Socket of Proxy<->Server connexion
+    client : Socket
+        Socket of Client<->Proxy connexion
+    port : int
+        port of the connexion
+    session : str
+        name of the session
+    """
 
-    GUI = bool("--gui" in sys.argv)
+    def __init__(self, server, client, port, session=None):
+        super().__init__(server, client, port, 'server', session)
+        self.server = server
+        self.client = client
 
-    if GUI:
-        root = gui.MainWin()
 
-    SERVER_IP = 'pentest.hackutt.uttnetgroup.fr'
-    MASTER_PORT = 3333
+def start(server_ip=SERVER_IP, ports=PORTS, listen='0.0.0.0', use_asyncio=False, port_offset=0, preconnect=PRECONNECT):
+    """
+    Start the proxy of every port, return the Proxy threads or the AsyncProxy
 
-    master_server = Proxy('0.0.0.0', SERVER_IP, MASTER_PORT)
-    master_server.start()
+    Parameters
+    ----------
+    server_ip : str
+        IP of the server
+    ports : list of int
+        ports to listen to
+    listen : str
+        IP to listen to
+    use_asyncio : bool
+        serve every port on one asyncio event loop
+    port_offset : int
+        the server listens on port + port_offset
+    preconnect : int
+        connections to the server opened in advance per port (threads only)
+    """
+    if use_asyncio:
+        # asyncio is the longest import of the proxy, only paid with --asyncio
+        from async_proxy import AsyncProxy
+        async_proxy = AsyncProxy(listen, server_ip, ports, on_data=on_chunk, on_close=stream_closed,
+                                 port_offset=port_offset, status=status)
+        # the main thread is kept for Tk or the prompt
+        Thread(target=async_proxy.run, daemon=True).start()
+        return async_proxy
+    proxies = []
+    for port in ports:
+        _proxy = Proxy(listen, server_ip, port, port_offset, preconnect)
+        _proxy.start()
+        proxies.append(_proxy)
+    return proxies
 
-    game_servers = []
-    for port_t in range(3000, 3006):
-        _game_server = Proxy('0.0.0.0', SERVER_IP, port_t)
-        _game_server.start()
-        game_servers.append(_game_server)
 
-    if GUI:
-        root.mainloop()
-    else:
-        while True:
-            try:
-                cmd = input('$ ')
-                if cmd[:4] == 'quit':
-                    os.exit(0)
-            except Exception as err:
-                print(err)
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if len(args) > 1:
+        print(f"Usage: python3 {sys.argv[0]} [server ip] [options]")
+        sys.exit(1)
+    if args:
+        SERVER_IP = args[0]
+
+    # one event loop for every port and session instead of threads
+    ASYNC = bool("--asyncio" in sys.argv)
+    # forward only
+    PARSE = bool("--no-parse" not in sys.argv)
+    # copy the data not parsed through Python instead of os.splice
+    if "--no-splice" in sys.argv:
+        SPLICE = False
+    # forward first, parse later: --forward-first[=drop-oldest|drop-newest|block]
+    for arg in sys.argv:
+        if arg.startswith("--forward-first"):
+            policy = arg.partition("=")[2] or 'drop-oldest'
+            PIPELINE = ParsePipeline(display, policy=policy)
+            METRICS.gauge('pipeline queue', PIPELINE.depth)
+            METRICS.gauge('pipeline dropped', lambda: PIPELINE.dropped)
+        # ports only forwarded: --passthrough=<port>, ex: 3333 hides the master server
+        if arg.startswith("--passthrough="):
+            PASSTHROUGH_PORTS.add(int(arg.partition("=")[2]))
+        # packets shown and logged: --filter=<name of Protocol_Parser.FILTERS_DICT>
+        if arg.startswith("--filter="):
+            FILTER = arg.partition("=")[2]
+            if FILTER not in Protocol_Parser.FILTERS_DICT:
+                print(f"Unknown filter {FILTER}, use one of {list(Protocol_Parser.FILTERS_DICT)}")
+                sys.exit(1)
+        # connections to the server opened in advance: --preconnect=<number per port>
+        if arg.startswith("--preconnect="):
+            PRECONNECT = int(arg.partition("=")[2])
+        # record the session: --capture=<file>
+        if arg.startswith("--capture="):
+            CAPTURE = CaptureWriter(arg.partition("=")[2])
+            METRICS.gauge('capture queue', CAPTURE.chunks.qsize)
+            METRICS.gauge('capture dropped', lambda: CAPTURE.dropped)
+    # every packet shown, the runs of identical packets too
+    FOLDER.enabled = bool("--no-dedup" not in sys.argv)
+    # model of the world of each session, for near / nearest
+    WORLDS.enabled = bool("--world" in sys.argv)
+    # decoding time per payload class in stats, costs about as much as the decoding
+    METRICS.time_decodes = bool("--time-decodes" in sys.argv)
+    METRICS.gauge('packets folded', lambda: FOLDER.folded)
+
+    # packets shown by a GUI process: --gui, or --ring to attach one later with python3 gui.py
+    if "--gui" in sys.argv or "--ring" in sys.argv:
+        open_ring(launch_gui="--gui" in sys.argv)
+
+    # packets logged: --log=<file> [--log-format=text|jsonl|binary] [--log-rotate=<MB>] [--log-compress=zlib|lzma],
+    # to the console by default without a GUI
+    options = dict(arg[2:].partition("=")[::2] for arg in sys.argv if arg.startswith("--log"))
+    if 'log' in options or RING is None:
+        LOG = LogWriter(options.get('log') or None, fmt=options.get('log-format', 'text'),
+                        rotate=int(float(options.get('log-rotate', 0)) * 1e6), compress=options.get('log-compress'))
+        METRICS.gauge('log queue', lambda: len(LOG.records))
+        METRICS.gauge('log dropped', lambda: LOG.dropped)
+
+    start(SERVER_IP, use_asyncio=ASYNC, preconnect=PRECONNECT)
+
+    while True:
+        try:
+            cmd = input('$ ')
+            words = cmd.split() or ['']
+            if words[0] == 'stats':
+                print(METRICS.report())
+            # near [radius] [session] / nearest [session]: entities around the player, of the last session by default
+            elif words[0] in ('near', 'nearest'):
+                session = words[1:] if words[0] == 'nearest' else words[2:]
+                world = WORLDS.get(session[0] if session else None)
+                if world is None:
+                    print("no world: start the proxy with --world" if not WORLDS.enabled else "no session")
+                elif words[0] == 'nearest':
+                    print(world.nearest_to_me())
+                else:
+                    radius = float(words[1]) if len(words) > 1 else 5000.0
+                    print(f"me: {world.me}")
+                    for distance, entity in world.around_me(radius):
+                        print(f"{distance:10.1f} {entity}")
+            # passthrough|parse <port>: stop / start parsing a port
+            elif words[0] == 'passthrough' and len(words) == 2:
+                PASSTHROUGH_PORTS.add(int(words[1]))
+            elif words[0] == 'parse' and len(words) == 2:
+                PASSTHROUGH_PORTS.discard(int(words[1]))
+                passthrough.wake()
+            # capture <file>|off: start / stop recording
+            elif words[0] == 'capture' and len(words) == 2:
+                if CAPTURE is not None:
+                    CAPTURE.close()
+                    CAPTURE = None
+                if words[1] != 'off':
+                    CAPTURE = CaptureWriter(words[1])
+                    passthrough.wake()
+            # sessions: names of the sessions running, for inject
+            elif words[0] == 'sessions':
+                print(' '.join(REWRITER.sessions()))
+            # inject <session> client|server <hex>: send forged packets in a session
+            elif words[0] == 'inject' and len(words) == 4:
+                REWRITER.inject(bytes.fromhex(words[3]), words[2], words[1])
+            # lengths [forget <type>]: lengths learned for the unknown types
+            elif words[0] == 'lengths':
+                if len(words) == 3 and words[1] == 'forget':
+                    LENGTHS.forget(int(words[2], 16))
+                print(LENGTHS.report())
+            # gui: start a GUI process, it can be closed and started again
+            elif words[0] == 'gui':
+                open_ring()
+            if cmd[:4] == 'quit':
+                FOLDER.flush()
+                if CAPTURE is not None:
+                    CAPTURE.close()
+                if RING is not None:
+                    RING.close()
+                if LOG is not None:
+                    LOG.close()
+                os._exit(0)
+        except EOFError:
+            # no console: the proxy runs until it is killed
+            Event().wait()
+        except Exception as err:
+            print(err)
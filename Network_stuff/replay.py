@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to analyse recorded traffic offline, on every core
+
+Sources are captures of the proxy (--capture), binary logs (--log-format=binary) or text hex dumps
+such as reverse_protocol.md:
+    [client] CMD: 0x3031 Unknown payload: 0a0046696e...   type + payload
+    [3001] 6d76 023218c7 2b4eacc6 6a792f45 30ff59a1 0000 0000   whole packets
+Sources are cut into chunks at packet boundaries (the index of a capture) or at line
+boundaries (a dump), and the chunks are read and parsed by a pool of processes.
+The lengths of the unknown types are not learned here (see frame_lengths.py): the rules
+learned by the proxy are used, the table is not written.
+
+Usage: python3 replay.py [--stats | --list | --jsonl] [--dedup] [--filter <name>] [--workers N] <capture, log or dump>...
+    --stats   packets and bytes per type (default)
+    --list    packets as printed by the proxy
+    --jsonl   one JSON object per packet
+    --dedup   runs of identical packets of a type and direction shown once with their count (×N),
+              as the proxy shows them. Captures keep every packet: they are folded here
+    --filter  only the packets accepted by a filter of Protocol_Parser.FILTERS_DICT
+"""
+
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import Protocol_Parser
+from capture import CaptureReader, CAPTURE_MAGIC
+from log_writer import to_json, is_log, read_log
+from dedup import RunFolder
+from frame_lengths import LENGTHS
+
+# offline: a dump must not change the rules of the proxy
+LENGTHS.learning = False
+
+# packets per chunk given to a worker
+CHUNK_PACKETS = 20000
+# bytes of a dump per chunk given to a worker
+CHUNK_BYTES = 1 << 20
+
+HEX_PACKET = re.compile(r"0x([0-9a-fA-F]{1,4})\b[^:]*:\s*([0-9a-fA-F ]+)$")
+HEX_TOKENS = re.compile(r"^(?:\[(\w+)\]\s*)?((?:[0-9a-fA-F]{2,}\s*)+)$")
+
+
+def dump_ranges(path, size=CHUNK_BYTES):
+    """Cut a dump in (start, stop) byte ranges of about size bytes, at line boundaries"""
+    end = os.path.getsize(path)
+    ranges = []
+    start = 0
+    with open(path, 'rb') as dump:
+        while start < end:
+            dump.seek(min(start + size, end))
+            dump.readline()
+            stop = min(dump.tell(), end)
+            ranges.append((start, stop))
+            start = stop
+    return ranges
+
+
+def read_dump(path, start=0, stop=None):
+    """Packets of the lines start to stop (byte offsets) of a text hex dump: list of (conn_dir, raw bytes)"""
+    packets = []
+    with open(path, 'rb') as dump:
+        dump.seek(start)
+        text = dump.read(-1 if stop is None else stop - start).decode('utf-8', errors='replace')
+        for line in text.splitlines():
+            line = line.strip()
+            conn_dir = 'server' if line.startswith('[server]') else 'client'
+            match = HEX_PACKET.search(line)
+            if match:
+                hex_payload = match.group(2).replace(' ', '')
+                if len(hex_payload) % 2 == 0:
+                    packets.append((conn_dir, int(match.group(1), 16).to_bytes(2, 'big') + bytes.fromhex(hex_payload)))
+                continue
+            match = HEX_TOKENS.match(line)
+            if match:
+                hex_data = match.group(2).replace(' ', '')
+                if len(hex_data) % 2:
+                    continue
+                # a line can hold several packets
+                pkts, _ = Protocol_Parser.frame(bytes.fromhex(hex_data))
+                packets += [(conn_dir, bytes(pkt.raw)) for pkt in pkts]
+    return packets
+
+
+def is_capture(path):
+    with open(path, 'rb') as source:
+        return source.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+
+
+def analyse(packets, mode, filter_name, dedup=False):
+    """
+    Parse packets: iterable of (timestamp, port, conn_dir, raw, repeat).
+    Return {type: [count, bytes]} for --stats, else the lines to print.
+    With dedup, the runs are folded within the packets given: a run cut by the end of a chunk
+    gives two lines.
+    """
+    pkt_filter = Protocol_Parser.FILTERS_DICT[filter_name] if filter_name else None
+    folder = RunFolder() if dedup else None
+    stats = {}
+    lines = []
+
+    def show(timestamp, port, pkt, conn_dir, repeat=1):
+        if mode == 'list':
+            # the binary logs do not keep the port
+            line = f"[{port}][{conn_dir}] {pkt}" if port is not None else f"[{conn_dir}] {pkt}"
+            lines.append(line + f" ×{repeat}" if repeat != 1 else line)
+        else:
+            lines.append(to_json(timestamp, conn_dir, pkt, port, repeat))
+
+    for timestamp, port, conn_dir, raw, repeat in packets:
+        pkt = Protocol_Parser.Packet.parse(raw)
+        if pkt_filter is not None and not pkt_filter.match(pkt):
+            continue
+        if mode == 'stats':
+            stat = stats.setdefault(pkt.header.type, [0, 0])
+            stat[0] += repeat
+            stat[1] += repeat * pkt.size
+        elif folder is None:
+            show(timestamp, port, pkt, conn_dir, repeat)
+        else:
+            # the time of the packet ends the runs, not the time of the analysis
+            folder.packet(pkt, conn_dir, (port, conn_dir), partial(show, timestamp, port), timestamp)
+    if folder is not None:
+        folder.flush()
+    return stats if mode == 'stats' else lines
+
+
+def _read_packets(reader, start, stop):
+    packets = []
+    for i in range(start, stop):
+        timestamp, port, conn_dir, _, raw = reader.packet(i)
+        packets.append((timestamp, port, conn_dir, bytes(raw), 1))
+    return packets
+
+
+def work_capture(path, start, stop, mode, filter_name, dedup):
+    """Worker: parse the packets start to stop of a capture"""
+    reader = CaptureReader(path)
+    # in a function: no view on the mapping is left when it is closed
+    packets = _read_packets(reader, start, stop)
+    reader.close()
+    return analyse(packets, mode, filter_name, dedup)
+
+
+def work_dump(path, start, stop, mode, filter_name, dedup):
+    """Worker: read and parse the lines start to stop (byte offsets) of a dump"""
+    packets = read_dump(path, start, stop)
+    return analyse(((0, None, conn_dir, raw, 1) for conn_dir, raw in packets), mode, filter_name, dedup)
+
+
+def jobs(executor, path, mode, filter_name, dedup=False):
+    """Submit the chunks of a source, return the futures in order"""
+    futures = []
+    if is_capture(path):
+        reader = CaptureReader(path)
+        count = len(reader)
+        reader.close()
+        for start in range(0, count, CHUNK_PACKETS):
+            futures.append(executor.submit(work_capture, path, start, min(start + CHUNK_PACKETS, count), mode, filter_name, dedup))
+    elif is_log(path):
+        packets = [(timestamp, None, conn_dir, raw, repeat) for timestamp, conn_dir, raw, repeat in read_log(path)]
+        for start in range(0, len(packets), CHUNK_PACKETS):
+            futures.append(executor.submit(analyse, packets[start:start + CHUNK_PACKETS], mode, filter_name, dedup))
+    else:
+        for start, stop in dump_ranges(path):
+            futures.append(executor.submit(work_dump, path, start, stop, mode, filter_name, dedup))
+    return futures
+
+
+def main(argv):
+    mode, filter_name, workers, dedup, sources = 'stats', None, os.cpu_count(), False, []
+    args = iter(argv)
+    for arg in args:
+        if arg in ('--stats', '--list', '--jsonl'):
+            mode = arg[2:]
+        elif arg == '--dedup':
+            dedup = True
+        elif arg == '--filter':
+            filter_name = next(args)
+            if filter_name not in Protocol_Parser.FILTERS_DICT:
+                print(f"Unknown filter {filter_name}, filters: {Protocol_Parser.FILTERS}")
+                return 1
+        elif arg == '--workers':
+            workers = int(next(args))
+        else:
+            sources.append(arg)
+    if not sources:
+        print(__doc__)
+        return 1
+
+    total = {}
+    with ProcessPoolExecutor(workers) as executor:
+        futures = [future for path in sources for future in jobs(executor, path, mode, filter_name, dedup)]
+        for future in futures:
+            result = future.result()
+            if mode != 'stats':
+                for line in result:
+                    print(line)
+                continue
+            for pkt_type, (count, size) in result.items():
+                stat = total.setdefault(pkt_type, [0, 0])
+                stat[0] += count
+                stat[1] += size
+
+    if mode == 'stats':
+        print(f"{'type':>8} {'class':<20} {'packets':>10} {'bytes':>12}")
+        for pkt_type, (count, size) in sorted(total.items(), key=lambda item: -item[1][0]):
+            clazz = Protocol_Parser.PacketRegistry.get(pkt_type)
+            name = clazz.__name__ if clazz is not None else 'unknown'
+            print(f"  0x{pkt_type:04x} {name:<20} {count:>10} {size:>12}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
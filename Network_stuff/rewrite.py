@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to tamper with the traffic on the relay path: change, drop or inject packets
+
+Hooks are registered per packet type and direction and called as hook(buf, pos, size, conn_dir)
+on the received data copied once in a bytearray, pos being the offset of the packet (header
+included) and size its length. A hook returns:
+    None        the packet is forwarded, patched in place if the hook wrote in buf
+    DROP        the packet is not forwarded
+    bytes       forwarded instead of the packet (one or several packets)
+Fixed-size fields are patched in place with field(), without decoding the payload:
+    X = field(PacketPositionPayload, 'X')
+    REWRITER.register(PositionPacket, lambda buf, pos, size, conn_dir: X.set(buf, pos, 0.0))
+    REWRITER.register(ChangeTool, lambda buf, pos, size, conn_dir: buf.__setitem__(pos + 2, 3))
+Forged packets (built with encode()) are injected in one session, before the next data of
+their direction. Sessions are named <port>.<number>, REWRITER.sessions() lists those running:
+    REWRITER.inject(ReloadPacket(PacketHeader(type=ReloadPacket.TYPE), PacketReloadPayload()), 'client', '3001.1')
+
+While a direction has hooks, only complete packets are forwarded: the end of a packet cut by
+a recv is held until the next one.
+"""
+
+from collections import deque
+from itertools import count
+from threading import Lock
+from struct import Struct
+from time import perf_counter_ns
+import passthrough
+from hot_reload import PARSER
+from metrics import METRICS
+from packet_schema import Number
+
+DROP = object()
+DIRECTIONS = ('client', 'server')
+# give up holding a packet that never completes
+MAX_PENDING = 0x10000
+
+
+class FieldRef:
+    """
+    Fixed-size field of a payload at a known offset of the packet
+
+    Attributes
+    ----------
+    offset : int
+        offset of the field from the start of the packet (header included)
+    struct : Struct
+        format of the field
+    """
+    __slots__ = ('offset', 'struct')
+
+    def __init__(self, offset, struct):
+        self.offset = offset
+        self.struct = struct
+
+    def get(self, buf, pos):
+        return self.struct.unpack_from(buf, pos + self.offset)[0]
+
+    def set(self, buf, pos, value):
+        self.struct.pack_into(buf, pos + self.offset, value)
+
+
+def field(payload_clazz, name):
+    """
+    FieldRef of a number of a payload described by FIELDS.
+    The field must come before the variable-size fields (strings...).
+    """
+    offset = PARSER.get().Packet.HEADER_SIZE
+    for schema_field in getattr(payload_clazz, 'FIELDS', ()):
+        if schema_field.name == name:
+            if not isinstance(schema_field, Number):
+                raise ValueError(f"{payload_clazz.__name__}.{name} is not a number")
+            return FieldRef(offset, Struct('<' + schema_field.fmt))
+        if schema_field.size is None:
+            break
+        offset += schema_field.size
+    raise ValueError(f"{payload_clazz.__name__}.{name} is not at a fixed offset")
+
+
+def clamp(payload_clazz, name, low, high):
+    """Hook keeping a field of a payload between low and high"""
+    ref = field(payload_clazz, name)
+
+    def hook(buf, pos, _size, _conn_dir):
+        value = ref.get(buf, pos)
+        if value < low:
+            ref.set(buf, pos, low)
+        elif value > high:
+            ref.set(buf, pos, high)
+    return hook
+
+
+def set_value(payload_clazz, name, value):
+    """Hook setting a field of a payload"""
+    ref = field(payload_clazz, name)
+
+    def hook(buf, pos, _size, _conn_dir):
+        ref.set(buf, pos, value)
+    return hook
+
+
+class Rewriter:
+    """
+    Hooks and injected packets of each direction
+
+    Attributes
+    ----------
+    hooks : dict
+        direction -> {packet type: list of hooks}
+    streams : dict
+        session -> {direction: RewriteStream} of the sessions running
+    """
+
+    def __init__(self) -> None:
+        self.hooks = {conn_dir: {} for conn_dir in DIRECTIONS}
+        self.streams = {}
+        self.numbers = count(1)
+        # the relays of every session open and close streams
+        self.lock = Lock()
+
+    def register(self, pkt_type, hook, conn_dir='client'):
+        """Call hook on the packets of pkt_type (a type or a Packet class), conn_dir None for both"""
+        pkt_type = getattr(pkt_type, 'TYPE', pkt_type)
+        for direction in (DIRECTIONS if conn_dir is None else (conn_dir,)):
+            hooks = dict(self.hooks[direction])
+            hooks[pkt_type] = hooks.get(pkt_type, []) + [hook]
+            # replaced at once: the relays read it without lock
+            self.hooks[direction] = hooks
+        # the directions spliced have to be parsed now
+        passthrough.wake()
+
+    def unregister(self, pkt_type, hook=None, conn_dir=None):
+        """Remove a hook, or every hook of pkt_type when hook is None"""
+        pkt_type = getattr(pkt_type, 'TYPE', pkt_type)
+        for direction in (DIRECTIONS if conn_dir is None else (conn_dir,)):
+            hooks = dict(self.hooks[direction])
+            kept = [h for h in hooks.get(pkt_type, []) if hook is not None and h is not hook]
+            if kept:
+                hooks[pkt_type] = kept
+            else:
+                hooks.pop(pkt_type, None)
+            self.hooks[direction] = hooks
+
+    def new_session(self, port):
+        """Name of a new session of port"""
+        return f"{port}.{next(self.numbers)}"
+
+    def sessions(self):
+        """Names of the sessions running"""
+        return sorted(self.streams, key=lambda session: tuple(int(n) for n in session.split('.')))
+
+    def inject(self, packet, conn_dir, session):
+        """Send a packet (a Packet or its bytes) in session, before the next data of conn_dir"""
+        if hasattr(packet, 'encode'):
+            packet = packet.encode()
+        stream = self.streams.get(session, {}).get(conn_dir)
+        if stream is None:
+            raise KeyError(f"no session {session} {conn_dir}, sessions: {' '.join(self.sessions())}")
+        stream.injected.append(bytes(packet))
+        passthrough.wake()
+
+    def _attach(self, stream):
+        with self.lock:
+            self.streams.setdefault(stream.session, {})[stream.conn_dir] = stream
+
+    def _detach(self, stream):
+        with self.lock:
+            streams = self.streams.get(stream.session)
+            if streams is not None and streams.get(stream.conn_dir) is stream:
+                del streams[stream.conn_dir]
+                if not streams:
+                    del self.streams[stream.session]
+
+
+REWRITER = Rewriter()
+
+
+class RewriteStream:
+    """
+    Rewriting of one direction of a session
+
+    Parameters
+    ----------
+    conn_dir : str
+        'client' or 'server'
+    rewriter : Rewriter
+        hooks, REWRITER by default
+    session : str
+        name of the session, packets can be injected in it until close(). None for a stream
+        nothing is injected in
+
+    Attributes
+    ----------
+    injected : deque
+        packets waiting to be sent
+    """
+    __slots__ = ('conn_dir', 'rewriter', 'session', 'injected', 'pending')
+
+    def __init__(self, conn_dir, rewriter=None, session=None):
+        self.conn_dir = conn_dir
+        self.rewriter = REWRITER if rewriter is None else rewriter
+        self.session = session
+        self.injected = deque()
+        # end of a packet cut by the previous recv
+        self.pending = b''
+        if session is not None:
+            self.rewriter._attach(self)
+
+    def close(self):
+        """The connection is closed: nothing can be injected anymore"""
+        if self.session is not None:
+            self.rewriter._detach(self)
+
+    def feed(self, data):
+        """Return the data to forward instead of data, b'' if nothing is to be sent yet"""
+        hooks = self.rewriter.hooks[self.conn_dir]
+        injected = self.injected
+        if not hooks and not injected and not self.pending:
+            return data
+        start = perf_counter_ns()
+        out = []
+        while injected:
+            out.append(injected.popleft())
+        if hooks:
+            out.append(self._rewrite(self.pending + data, hooks))
+        else:
+            out.append(self.pending + data)
+            self.pending = b''
+        METRICS.observe(f'rewrite {self.conn_dir}', perf_counter_ns() - start)
+        return b''.join(out)
+
+    def flush(self):
+        """Return the end of packet held and the packets waiting to be injected, to send them as they are"""
+        injected = self.injected
+        out = []
+        while injected:
+            out.append(injected.popleft())
+        out.append(self.pending)
+        self.pending = b''
+        return b''.join(out)
+
+    def _rewrite(self, data, hooks):
+        """Call the hooks on the complete packets of data, keep the incomplete end"""
+        parser = PARSER.get()
+        length = parser.Packet.length
+        buf = bytearray(data)
+        view = memoryview(buf)
+        end = len(buf)
+        pos = 0
+        # parts of buf to forward, with the replacements of the packets changed
+        parts = []
+        last = 0
+        while pos < end:
+            try:
+                size = length(view[pos:])
+            except parser.IncompletePacket:
+                break
+            pkt_hooks = hooks.get(buf[pos] << 8 | buf[pos + 1])
+            if pkt_hooks is not None:
+                for hook in pkt_hooks:
+                    result = hook(buf, pos, size, self.conn_dir)
+                    if result is None:
+                        continue
+                    parts.append(view[last:pos])
+                    if result is not DROP:
+                        parts.append(result)
+                    last = pos + size
+                    break
+            pos += size
+        if end - pos > MAX_PENDING:
+            print(f"[rewrite] forwarding {end - pos} bytes of incomplete packet")
+            pos = end
+        self.pending = bytes(view[pos:])
+        parts.append(view[last:pos])
+        return b''.join(parts)
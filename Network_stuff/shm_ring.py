@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to hand the packets from the proxy to a GUI running in another process,
+through a ring of records in shared memory (multiprocessing.shared_memory)
+
+The proxy is the only writer and never waits: it writes over the oldest records when the ring
+is full. Readers attach and detach at any time and keep their own cursor. A reader that falls
+behind skips ahead to the oldest record still intact.
+Positions are byte counters which only grow, the offset in the ring is position % capacity:
+    head    end of the last record written
+    tail    start of the oldest record not overwritten, moved before the bytes are reused
+A record is read, then the tail is read again: if it went past the record, the writer
+overwrote it meanwhile and the record is dropped.
+"""
+
+import os
+import time
+from multiprocessing import resource_tracker, shared_memory
+from struct import Struct
+from threading import Lock
+
+NAME = 'pwn3_proxy'
+# bytes of records, about 100k packets
+CAPACITY = 1 << 22
+MAGIC = b'PWN3RING'
+# magic, capacity, closed, head, tail
+HEADER = Struct('<8sIIQQ')
+HEADER_SIZE = 64
+HEAD_OFFSET = 16
+TAIL_OFFSET = 24
+POSITION = Struct('<Q')
+# pid of the proxy writing the ring
+PID = Struct('<I')
+PID_OFFSET = 32
+# size (header included), kind, direction, packet type, time
+RECORD = Struct('<IBBHd')
+COUNT = Struct('<I')
+
+# kinds of record
+PACKET = 0
+TEXT = 1
+STATS = 2
+# a packet received several times in a row: repeat (u32), then the packet
+REPEAT = 3
+# rest of the lap unused, the next record is at the start of the ring
+WRAP = 0xff
+
+DIRECTIONS = ('client', 'server')
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+def _untrack(shm):
+    """The ring belongs to its proxy: it must not be removed when another process attached exits"""
+    if os.name == 'posix':
+        # registered under the POSIX name, which starts with a slash
+        resource_tracker.unregister('/' + shm.name, 'shared_memory')
+
+
+def _alive(pid):
+    """True when the process pid runs"""
+    if os.name != 'posix':
+        # the memory of a dead process is freed by the system
+        return True
+    if pid == 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RingWriter:
+    """
+    Proxy side of the ring
+
+    Parameters
+    ----------
+    name : str
+        name of the shared memory, the readers attach to it
+    capacity : int
+        bytes of records, a multiple of 8
+
+    Attributes
+    ----------
+    dropped : int
+        records too big for the ring
+    """
+
+    def __init__(self, name=NAME, capacity=CAPACITY) -> None:
+        try:
+            self.shm = shared_memory.SharedMemory(name, create=True, size=HEADER_SIZE + capacity)
+        except FileExistsError:
+            self._take_over(name)
+            self.shm = shared_memory.SharedMemory(name, create=True, size=HEADER_SIZE + capacity)
+        self.name = name
+        self.capacity = capacity
+        self.buf = self.shm.buf
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        # relays of every session write
+        self.lock = Lock()
+        HEADER.pack_into(self.buf, 0, MAGIC, capacity, 0, 0, 0)
+        PID.pack_into(self.buf, PID_OFFSET, os.getpid())
+
+    @staticmethod
+    def _take_over(name):
+        """Remove the ring left by a proxy which did not exit cleanly, FileExistsError if it is in use"""
+        other = shared_memory.SharedMemory(name)
+        try:
+            ours = other.size >= HEADER_SIZE and bytes(other.buf[:len(MAGIC)]) == MAGIC
+            pid = PID.unpack_from(other.buf, PID_OFFSET)[0] if ours else 0
+        finally:
+            other.close()
+        if not ours or _alive(pid):
+            _untrack(other)
+            owner = f"the proxy {pid}" if ours else "another program"
+            raise FileExistsError(f"the shared memory {name} is used by {owner}, give another name")
+        other.unlink()
+
+    def packet(self, pkt, conn_dir, repeat=1):
+        """Write a packet parsed, as given to parse() for display, repeat times in a row"""
+        raw = pkt.raw if pkt.raw is not None else pkt.encode()
+        if repeat == 1:
+            self.write(PACKET, conn_dir, pkt.header.type, raw)
+        else:
+            self.write(REPEAT, conn_dir, pkt.header.type, COUNT.pack(repeat) + raw)
+
+    def text(self, line):
+        """Write a message of the proxy for the log of the GUI"""
+        self.write(TEXT, 'client', 0, line.encode())
+
+    def stats(self, report):
+        self.write(STATS, 'client', 0, report.encode())
+
+    def write(self, kind, conn_dir, pkt_type, data):
+        size = RECORD.size + len(data)
+        step = _align(size)
+        capacity = self.capacity
+        with self.lock:
+            if step > capacity // 4:
+                self.dropped += 1
+                return
+            pos = self.head
+            offset = pos % capacity
+            start = pos
+            if capacity - offset < step:
+                # the record does not fit before the end: next lap
+                start = pos + capacity - offset
+            if start + step - self.tail > capacity:
+                self._reclaim(start + step)
+            if start != pos and capacity - offset >= RECORD.size:
+                RECORD.pack_into(self.buf, HEADER_SIZE + offset, capacity - offset, WRAP, 0, 0, 0.0)
+            at = HEADER_SIZE + start % capacity
+            RECORD.pack_into(self.buf, at, size, kind, conn_dir == 'server', pkt_type, time.time())
+            self.buf[at + RECORD.size:at + size] = data
+            # published once the record is written
+            self.head = start + step
+            POSITION.pack_into(self.buf, HEAD_OFFSET, self.head)
+
+    def _reclaim(self, end):
+        """Move the tail past the records overwritten by writing up to end"""
+        capacity = self.capacity
+        tail = self.tail
+        while end - tail > capacity:
+            offset = tail % capacity
+            if capacity - offset < RECORD.size:
+                tail += capacity - offset
+            else:
+                tail += _align(RECORD.unpack_from(self.buf, HEADER_SIZE + offset)[0])
+        if tail != self.tail:
+            self.tail = tail
+            # published before the bytes are reused
+            POSITION.pack_into(self.buf, TAIL_OFFSET, tail)
+
+    def close(self):
+        HEADER.pack_into(self.buf, 0, MAGIC, self.capacity, 1, self.head, self.tail)
+        self.buf = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+class RingReader:
+    """
+    GUI side of the ring: attach to the ring of a running proxy
+
+    Parameters
+    ----------
+    name : str
+        name of the shared memory
+    from_start : bool
+        read the records still in the ring, instead of the new ones only
+
+    Attributes
+    ----------
+    skipped : int
+        times the reader fell behind and skipped ahead
+    """
+
+    def __init__(self, name=NAME, from_start=False) -> None:
+        self.shm = shared_memory.SharedMemory(name)
+        _untrack(self.shm)
+        self.buf = self.shm.buf
+        magic, self.capacity, _closed, head, tail = HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"{name} is not a ring of the proxy")
+        self.cursor = tail if from_start else head
+        self.skipped = 0
+
+    @property
+    def closed(self):
+        """The proxy exited"""
+        return bool(HEADER.unpack_from(self.buf)[2])
+
+    def read(self, max_records=1000):
+        """Return the next records as (kind, direction, packet type, time, bytes)"""
+        buf = self.buf
+        capacity = self.capacity
+        head = POSITION.unpack_from(buf, HEAD_OFFSET)[0]
+        records = []
+        while self.cursor < head and len(records) < max_records:
+            tail = POSITION.unpack_from(buf, TAIL_OFFSET)[0]
+            if self.cursor < tail:
+                self.skipped += 1
+                self.cursor = tail
+                continue
+            offset = self.cursor % capacity
+            if capacity - offset < RECORD.size:
+                self.cursor += capacity - offset
+                continue
+            at = HEADER_SIZE + offset
+            size, kind, server, pkt_type, date = RECORD.unpack_from(buf, at)
+            data = bytes(buf[at + RECORD.size:at + min(size, capacity - offset)]) if kind != WRAP else b''
+            # overwritten while it was read: the tail moved past it
+            if POSITION.unpack_from(buf, TAIL_OFFSET)[0] > self.cursor:
+                continue
+            if kind == WRAP:
+                self.cursor += size
+                continue
+            records.append((kind, DIRECTIONS[server], pkt_type, date, data))
+            self.cursor += _align(size)
+        return records
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
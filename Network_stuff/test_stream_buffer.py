@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to check the framing of the parser: a stream cut in chunks of any size by
+TCP gives the same packets as the whole stream framed at once, a gap drops the packet it cut,
+and whole() / frame() agree on where the packets end.
+
+Run with: python3 -m pytest test_stream_buffer.py
+"""
+
+import random
+from struct import pack
+import pytest
+from bench_parser import packet_pools, stream
+from frame_lengths import LENGTHS
+from Protocol_Parser import PacketPlayerStatePayload, PacketRegistry, StreamBuffer, frame, whole
+
+# the tests must not learn nor write lengths
+LENGTHS.learning = False
+
+
+def player_state(name):
+    """Raw PlayerState packet, its name can be long enough to span many chunks"""
+    clazz = next(c for c in PacketRegistry.TYPE_TO_CLASS.values() if c.PAYLOAD is PacketPlayerStatePayload)
+    return pack('>H', clazz.TYPE) + pack('<IH', 42, len(name)) + name + b'\x07'
+
+
+@pytest.fixture(scope='module')
+def dump():
+    rng = random.Random(2)
+    pools, weights = packet_pools(rng)
+    # a big packet in the middle: reassembled over several chunks and compactions
+    return stream(pools, weights, 2000, rng) + player_state(b'n' * 60000) + stream(pools, weights, 2000, rng)
+
+
+def raws(packets):
+    return [bytes(pkt.raw) for pkt in packets]
+
+
+def feed_chunks(buffer, data, sizes):
+    packets = []
+    pos = 0
+    for size in sizes:
+        packets += buffer.feed(data[pos:pos + size])
+        pos += size
+    return packets
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_random_chunks_frame_as_one_pass(dump, seed):
+    expected, consumed = frame(dump)
+    assert consumed == len(dump)
+    rng = random.Random(seed)
+    sizes = []
+    while sum(sizes) < len(dump):
+        sizes.append(rng.choice((1, 2, 3, rng.randrange(1, 64), rng.randrange(1, 4096), rng.randrange(1, 0x10000))))
+    assert raws(feed_chunks(StreamBuffer(), dump, sizes)) == raws(expected)
+
+
+def test_byte_by_byte(dump):
+    data = dump[:5000]
+    expected, consumed = frame(data)
+    buffer = StreamBuffer()
+    assert raws(feed_chunks(buffer, data, [1] * len(data))) == raws(expected)
+    # the tail cut by the end of data waits in the buffer
+    assert len(buffer.pending) - buffer.start == len(data) - consumed
+
+
+def test_gap_drops_the_tail(dump):
+    packets, _ = frame(dump[:3000])
+    # a partial packet, then data of the stream dropped (forwarded unparsed)
+    partial = player_state(b'abc')[:7]
+    buffer = StreamBuffer()
+    assert buffer.feed(partial) == []
+    buffer.gap = True
+    after = b''.join(raws(packets))
+    assert raws(buffer.feed(after)) == raws(packets)
+    assert not buffer.gap
+
+
+def test_without_gap_the_tail_is_joined():
+    packet = player_state(b'abc')
+    buffer = StreamBuffer()
+    assert buffer.feed(packet[:7]) == []
+    assert raws(buffer.feed(packet[7:] + packet)) == [packet, packet]
+
+
+def test_whole_and_frame_agree(dump):
+    packets, _ = frame(dump)
+    ends = []
+    pos = 0
+    for raw in raws(packets):
+        pos += len(raw)
+        ends.append(pos)
+    assert whole(dump)
+    for end in ends[:50]:
+        assert whole(dump[:end])
+        assert not whole(dump[:end - 1])
+        assert frame(dump[:end - 1])[1] < end
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Authors: Dvorhack & K8pl3r
+
+This file is aimed to keep a model of the world from the packets: entity id -> name, position, HP
+
+Tracking is opt-in (proxy.py --world): it decodes the payloads of most of the traffic. Each
+session has its own World, its packets reach it through WORLDS.sink().
+
+Entities are in a dict and in a uniform grid of the (X, Y) plane, so a position update is O(1)
+and the queries (nearest entity, entities within a radius) only look at the cells around the point.
+Packets are recognized by the name of their class: the classes of a hot reloaded parser work too.
+Positions which are not finite or beyond LIMIT (garbage, a packet misframed) are ignored. A query
+covering more cells than the grid holds walks the occupied cells instead of the area.
+"""
+
+import math
+from threading import Lock
+
+# side of a cell of the grid, in game units
+CELL_SIZE = 2000.0
+# largest coordinate taken as a position, the maps span about 1e5
+LIMIT = 1e7
+
+
+def _valid(X, Y, Z):
+    """Position usable by the grid: finite and within LIMIT"""
+    return abs(X) <= LIMIT and abs(Y) <= LIMIT and abs(Z) <= LIMIT
+
+
+class Entity:
+    """
+    Entity of the world
+
+    Attributes
+    ----------
+    id : int
+        id of the entity
+    name : str
+        name, None until a NewElmt packet is seen
+    X, Y, Z : float
+        position, None until a position is seen
+    hp : int
+        last value of a HPmodif packet, None until one is seen
+    cell : tuple
+        cell of the grid holding the entity
+    """
+    __slots__ = ('id', 'name', 'X', 'Y', 'Z', 'hp', 'cell')
+
+    def __init__(self, id, name=None):
+        self.id = id
+        self.name = name
+        self.X = self.Y = self.Z = None
+        self.hp = None
+        self.cell = None
+
+    def __str__(self) -> str:
+        return f"{self.id}:{self.name} {self.X} / {self.Y} / {self.Z} HP:{self.hp}"
+
+
+class World:
+    """
+    World model updated by the packets
+
+    Parameters
+    ----------
+    cell_size : float
+        side of a cell of the grid
+
+    Attributes
+    ----------
+    entities : dict
+        id -> Entity
+    grid : dict
+        cell (x, y) -> set of the entities with a position in the cell
+    me : Entity
+        the player, from the Position packets of the client
+    """
+
+    def __init__(self, cell_size=CELL_SIZE) -> None:
+        self.cell_size = cell_size
+        self.entities = {}
+        self.grid = {}
+        self.me = Entity(None, 'me')
+        # cells ever used: bounds of the search of nearest()
+        self.bounds = None
+        # packets are parsed by several threads, queries come from the prompt or the GUI
+        self.lock = Lock()
+
+    def update(self, pkt, conn_dir):
+        """Update the model with a packet, the packets of other types are ignored"""
+        handler = World.HANDLERS.get(type(pkt).__name__)
+        if handler is not None:
+            payload = pkt.payload
+            if type(payload) is not pkt.PAYLOAD:
+                # not decoded as its type: the raw bytes of the fallback payload
+                return
+            with self.lock:
+                handler(self, payload, conn_dir)
+
+    def _entity(self, id):
+        entity = self.entities.get(id)
+        if entity is None:
+            entity = self.entities[id] = Entity(id)
+        return entity
+
+    def _move(self, entity, X, Y, Z):
+        # NaN fails the comparison of _valid too
+        if not _valid(X, Y, Z):
+            return
+        entity.X, entity.Y, entity.Z = X, Y, Z
+        cell = (int(X // self.cell_size), int(Y // self.cell_size))
+        if cell == entity.cell:
+            return
+        self._unplace(entity)
+        entity.cell = cell
+        self.grid.setdefault(cell, set()).add(entity)
+        if self.bounds is None:
+            self.bounds = [cell[0], cell[1], cell[0], cell[1]]
+        else:
+            bounds = self.bounds
+            bounds[0], bounds[1] = min(bounds[0], cell[0]), min(bounds[1], cell[1])
+            bounds[2], bounds[3] = max(bounds[2], cell[0]), max(bounds[3], cell[1])
+
+    def _unplace(self, entity):
+        if entity.cell is None:
+            return
+        cell = self.grid[entity.cell]
+        cell.discard(entity)
+        if not cell:
+            del self.grid[entity.cell]
+        entity.cell = None
+
+    def _new_elmt(self, payload, _conn_dir):
+        entity = self._entity(payload.id)
+        entity.name = payload.name
+        self._move(entity, payload.X, payload.Y, payload.Z)
+
+    def _enemy_pos(self, payload, _conn_dir):
+        self._move(self._entity(payload.id), payload.X, payload.Y, payload.Z)
+
+    def _position(self, payload, conn_dir):
+        # position of the player, sent by the client
+        if conn_dir == 'client' and _valid(payload.X, payload.Y, payload.Z):
+            self.me.X, self.me.Y, self.me.Z = payload.X, payload.Y, payload.Z
+
+    def _remove(self, payload, _conn_dir):
+        entity = self.entities.pop(payload.id, None)
+        if entity is not None:
+            self._unplace(entity)
+
+    def _hp(self, payload, _conn_dir):
+        self._entity(payload.id).hp = payload.level
+
+    HANDLERS = {
+        'NewElmtPacket': _new_elmt,
+        'EnemyPosPacket': _enemy_pos,
+        'PositionPacket': _position,
+        'RemoveElmtPacket': _remove,
+        'HPmodifPacket': _hp,
+    }
+
+    def _cells(self, cx, cy, ring):
+        """Cells at the distance ring (in cells) of (cx, cy)"""
+        if ring == 0:
+            yield (cx, cy)
+            return
+        for x in range(cx - ring, cx + ring + 1):
+            yield (x, cy - ring)
+            yield (x, cy + ring)
+        for y in range(cy - ring + 1, cy + ring):
+            yield (cx - ring, y)
+            yield (cx + ring, y)
+
+    @staticmethod
+    def _distance(entity, X, Y, Z):
+        return math.sqrt((entity.X - X) ** 2 + (entity.Y - Y) ** 2 + (entity.Z - Z) ** 2)
+
+    def _occupied(self, x0, y0, x1, y1):
+        """Entities of the cells from (x0, y0) to (x1, y1), walking the grid when it is smaller"""
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.grid):
+            for (cx, cy), entities in self.grid.items():
+                if x0 <= cx <= x1 and y0 <= cy <= y1:
+                    yield from entities
+            return
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                yield from self.grid.get((cx, cy), ())
+
+    def within(self, X, Y, Z, radius, predicate=None):
+        """Return the (distance, entity) within radius of (X, Y, Z), nearest first"""
+        if not _valid(X, Y, Z):
+            return []
+        size = self.cell_size
+        # beyond the limit there is no entity
+        radius = min(radius, 4 * LIMIT)
+        found = []
+        with self.lock:
+            for entity in self._occupied(int((X - radius) // size), int((Y - radius) // size),
+                                         int((X + radius) // size), int((Y + radius) // size)):
+                distance = self._distance(entity, X, Y, Z)
+                if distance <= radius and (predicate is None or predicate(entity)):
+                    found.append((distance, entity))
+        found.sort(key=lambda item: item[0])
+        return found
+
+    def nearest(self, X, Y, Z, max_radius=None, predicate=None):
+        """Return (distance, entity) of the entity nearest to (X, Y, Z), None if there is none"""
+        if not _valid(X, Y, Z):
+            return None
+        size = self.cell_size
+        cx, cy = int(X // size), int(Y // size)
+        best = None
+        with self.lock:
+            if self.bounds is None:
+                return None
+            # rings beyond this one only hold empty cells
+            last = max(cx - self.bounds[0], cy - self.bounds[1], self.bounds[2] - cx, self.bounds[3] - cy, 0)
+            if max_radius is not None:
+                last = min(last, int(max_radius // size) + 1)
+            if (2 * last + 1) ** 2 > 4 * len(self.grid):
+                # the rings would visit more empty cells than the grid holds: every entity is checked
+                rings = ()
+                for entities in self.grid.values():
+                    for entity in entities:
+                        if predicate is not None and not predicate(entity):
+                            continue
+                        distance = self._distance(entity, X, Y, Z)
+                        if best is None or distance < best[0]:
+                            best = (distance, entity)
+            else:
+                rings = range(last + 1)
+            for ring in rings:
+                # the entities of this ring and beyond are at least (ring - 1) cells away
+                if best is not None and best[0] <= (ring - 1) * size:
+                    break
+                for cell in self._cells(cx, cy, ring):
+                    for entity in self.grid.get(cell, ()):
+                        if predicate is not None and not predicate(entity):
+                            continue
+                        distance = self._distance(entity, X, Y, Z)
+                        if best is None or distance < best[0]:
+                            best = (distance, entity)
+        if best is not None and max_radius is not None and best[0] > max_radius:
+            return None
+        return best
+
+    def around_me(self, radius):
+        """Entities within radius of the player"""
+        if self.me.X is None:
+            return []
+        return self.within(self.me.X, self.me.Y, self.me.Z, radius)
+
+    def nearest_to_me(self, max_radius=None):
+        """Entity nearest to the player"""
+        if self.me.X is None:
+            return None
+        return self.nearest(self.me.X, self.me.Y, self.me.Z, max_radius)
+
+
+class Worlds:
+    """
+    World of each session
+
+    Attributes
+    ----------
+    enabled : bool
+        when unset, sink() hands the packets straight to the sink
+    worlds : dict
+        session -> World, in the order the sessions started
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.worlds = {}
+        # the relays of every session open and close worlds
+        self.lock = Lock()
+
+    def sink(self, sink, session):
+        """packet_sink of parse(): the packets update the world of session, then go to sink"""
+        if not self.enabled or session is None:
+            return sink
+        world = self.worlds.get(session)
+        if world is None:
+            with self.lock:
+                world = self.worlds.setdefault(session, World())
+
+        def update(pkt, conn_dir, repeat=1):
+            world.update(pkt, conn_dir)
+            sink(pkt, conn_dir, repeat)
+        return update
+
+    def get(self, session=None):
+        """World of session, of the last session started when None; None if there is none"""
+        with self.lock:
+            if session is None:
+                return next(reversed(self.worlds.values()), None)
+            return self.worlds.get(session)
+
+    def close(self, session):
+        """The session is over: its world is removed"""
+        with self.lock:
+            self.worlds.pop(session, None)
+
+
+WORLDS = Worlds()